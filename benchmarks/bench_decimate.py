@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+bench_decimate.py
+-----------------
+
+Benchmarks a DVS page for a `K2` short cadence light curve (about 120,000
+cadences per panel) plotted in full, decimated to the resolution of the 
+cells (see :py:func:`everest3.dvs.decimate`), and decimated and 
+rasterized. Reports the render time and the size of the PDF.
+
+'''
+
+from __future__ import division, print_function, absolute_import
+from everest3.dvs import template, plot
+import numpy as np
+import tempfile
+import time
+import os
+
+def main(ncads = 120000):
+    '''
+    
+    '''
+    
+    np.random.seed(42)
+    t = np.arange(ncads) * 0.000681
+    flux = 1e5 + 50 * np.random.randn(ncads)
+    flux[(t % 9.3) < 0.1] -= 500.
+    sap = flux + 300 * ((t % 0.245) / 0.245)
+    file = os.path.join(tempfile.mkdtemp(), 'dvs.pdf')
+    print("%d cadences per panel" % ncads)
+    for label, kwargs in (('Full', dict(decimate = False)), 
+                          ('Decimated', dict()),
+                          ('Rasterized', dict(rasterized = True))):
+        tstart = time.time()
+        page = template()
+        lines = plot(page.detrended, t, flux, 'k.', ms = 2, alpha = 0.3, 
+                     **kwargs)
+        plot(page.raw, t, sap, 'k.', ms = 2, alpha = 0.3, **kwargs)
+        page.fig.savefig(file)
+        elapsed = time.time() - tstart
+        print("%-12s %7d points, %6.2f s, %8.1f kB" % (label, 
+              len(lines[0].get_xdata()), elapsed, 
+              os.path.getsize(file) / 1e3))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+bench_dvs.py
+------------
+
+Benchmarks rendering data validation summaries for a sequence of targets,
+creating a new :py:mod:`matplotlib.pyplot` page for each one (the original
+behavior, in which the figures are never closed) and reusing the page 
+:py:func:`everest3.dvs.template`. Reports the time per page and the growth
+in the peak memory of the process.
+
+'''
+
+from __future__ import division, print_function, absolute_import
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as pl
+from everest3.dvs import DVS, template
+import numpy as np
+import resource
+import tempfile
+import time
+import os
+
+def draw(page, t, flux):
+    '''
+    Draws the light curve plots of a page.
+    
+    '''
+    
+    page.header.annotate('EPIC 201367065', xy = (0.5, 0.5), 
+                         xycoords = 'axes fraction', ha = 'center')
+    page.detrended.plot(t, flux, 'k.', alpha = 0.3, ms = 2)
+    page.raw.plot(t, flux + np.sin(t), 'k.', alpha = 0.3, ms = 2)
+
+def maxrss():
+    '''
+    The peak resident memory of the process in MB.
+    
+    '''
+    
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1e3 if os.uname()[0] == 'Linux' else rss / 1e6
+
+def main(npages = 20, ncads = 3853, ext = 'pdf'):
+    '''
+    
+    '''
+    
+    np.random.seed(42)
+    t = np.arange(ncads) * 0.0204
+    file = os.path.join(tempfile.mkdtemp(), 'dvs.' + ext)
+    print("%d pages of %d cadences (%s)" % (npages, ncads, ext))
+    
+    def fresh():
+        page = DVS(fig = pl.figure(figsize = (8.5, 11)))
+        draw(page, t, np.random.randn(ncads))
+        page.fig.savefig(file)
+    
+    def reused():
+        page = template()
+        draw(page, t, np.random.randn(ncads))
+        page.fig.savefig(file)
+    
+    for label, func in (('Template', reused), ('New pyplot page', fresh)):
+        rss = maxrss()
+        tstart = time.time()
+        for n in range(npages):
+            func()
+        elapsed = (time.time() - tstart) / npages
+        print("%-16s %7.3f s per page, peak memory +%6.1f MB" % 
+              (label, elapsed, maxrss() - rss))
+
+if __name__ == '__main__':
+    main()
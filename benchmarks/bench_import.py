@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+bench_import.py
+---------------
+
+Measures the import time of :py:obj:`everest3` and its submodules with
+`python -X importtime`, in fresh interpreters. Pass `--max-ms` to exit 
+with an error if the median cumulative import time of any module exceeds 
+a budget, e.g. as a regression check in CI::
+
+    python benchmarks/bench_import.py --max-ms 250
+
+'''
+
+from __future__ import division, print_function, absolute_import
+import subprocess
+import argparse
+import sys
+import numpy as np
+
+def import_time(module, repeat = 5):
+    '''
+    Returns the median cumulative import time of `module` in milliseconds,
+    and the three slowest modules it imports on the last run.
+    
+    '''
+    
+    times = []
+    for n in range(repeat):
+        out = subprocess.check_output([sys.executable, '-X', 'importtime', 
+                                       '-c', 'import %s' % module],
+                                      stderr = subprocess.STDOUT).decode()
+        rows = []
+        for line in out.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            self_us, cumul_us, name = line[12:].split('|')
+            rows.append((int(cumul_us), name.strip()))
+        times.append([c for c, name in rows if name == module][0] / 1e3)
+    slowest = sorted([r for r in rows if r[1] != module], reverse = True)[:3]
+    return np.median(times), slowest
+
+def main():
+    '''
+    
+    '''
+    
+    parser = argparse.ArgumentParser(description = __doc__.split('\n\n')[1])
+    parser.add_argument('--max-ms', type = float, default = None)
+    parser.add_argument('--repeat', type = int, default = 5)
+    args = parser.parse_args()
+    
+    failed = False
+    for module in ['everest3', 'everest3.containers', 'everest3.pld', 
+                   'everest3.k2', 'everest3.dvs']:
+        t, slowest = import_time(module, repeat = args.repeat)
+        print("%-22s %8.1f ms   (slowest: %s)" % (module, t, ', '.join(
+              ['%s %.0f ms' % (name, c / 1e3) for c, name in slowest])))
+        if (args.max_ms is not None) and (module != 'everest3.dvs') \
+           and (t > args.max_ms):
+            failed = True
+    if failed:
+        print("Import time budget of %.0f ms exceeded." % args.max_ms)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
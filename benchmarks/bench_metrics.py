@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+bench_metrics.py
+----------------
+
+Benchmarks the overhead of the per-stage instrumentation of the
+:py:class:`Target` pipeline (see :py:attr:`Target.metrics`) on a synthetic
+`K2` stamp, de-trended with the metrics off, on, with :py:mod:`tracemalloc`
+and with :py:mod:`cProfile`, and prints the metrics of each stage.
+
+'''
+
+from __future__ import division, print_function, absolute_import
+from bench_pld_pca import synthetic_stamp
+from everest3.containers import Target
+import numpy as np
+import tempfile
+import time
+
+class _Target(Target):
+    '''
+    An offline target backed by a synthetic stamp.
+    
+    '''
+    
+    path = tempfile.mkdtemp()
+    
+    def get_raw_data(self):
+        self.raw = synthetic_stamp()
+        self.mag = np.nan
+    
+    def get_aperture(self):
+        x, y = np.meshgrid(np.arange(self.raw.nrows), 
+                           np.arange(self.raw.ncols))
+        self.aperture = (((x - self.raw.nrows / 2.) ** 2 + 
+                          (y - self.raw.ncols / 2.) ** 2) < 7.) \
+                        .astype('int32')
+
+def main(order = 3, repeats = 3):
+    '''
+    
+    '''
+    
+    # Warm up
+    star = _Target(1, quiet = True, checkpoint = False)
+    star.detrend(order = order)
+    
+    print("%-12s %10s" % ('Metrics', 'Time (s)'))
+    for label, kwargs in (('Off', dict(record_metrics = False)),
+                          ('On', dict()),
+                          ('tracemalloc', dict(trace_memory = True)),
+                          ('cProfile', dict(profile = True))):
+        times = []
+        for i in range(repeats):
+            star = _Target(1, quiet = True, checkpoint = False)
+            for key, value in kwargs.items():
+                setattr(star, key, value)
+            tstart = time.time()
+            star.run(until = 'design')
+            star.detrend(order = order)
+            times.append(time.time() - tstart)
+        print("%-12s %10.3f" % (label, min(times)))
+    
+    print()
+    print("%-10s %10s %10s %12s %12s %12s %12s" % ('Stage', 'Wall (s)', 
+          'CPU (s)', 'RSS change', 'Process peak', 'Traced peak', 
+          'Arrays (MB)'))
+    star = _Target(1, quiet = True, checkpoint = False)
+    star.trace_memory = True
+    star.run(until = 'design')
+    star.detrend(order = order)
+    for stage, m in sorted(star.metrics.items(), key = lambda item: 
+                           ['raw', 'aperture', 'design', 'model'].index(
+                           item[0])):
+        print("%-10s %10.3f %10.3f %+9.1f MB %9.1f MB %9.1f MB %12.2f" % 
+              (stage, m['wall'], m['cpu'], m['rss_delta'], m['max_rss'], 
+               m['traced_peak'], sum(m['arrays'].values()) / 2 ** 20))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+bench_pixel_flux.py
+-------------------
+
+Benchmarks the aperture gather in :py:meth:`TimeSeries.pixel_flux` on a
+realistic `K2` long cadence postage stamp, comparing the original per-cadence
+list comprehension to the vectorized, cached gather.
+
+'''
+
+from __future__ import division, print_function, absolute_import
+from everest3.containers import TimeSeries
+import numpy as np
+import timeit
+
+def legacy_pixel_flux(flux, aperture):
+    '''
+    The original implementation of :py:meth:`TimeSeries.pixel_flux`.
+    
+    '''
+    
+    ap = np.where(aperture & 1)
+    return np.array([p[ap] for p in flux])
+
+def main(ncads = 3853, ncols = 14, nrows = 16, number = 20):
+    '''
+    
+    '''
+    
+    # A synthetic stamp with a roughly circular aperture
+    np.random.seed(42)
+    flux = np.random.randn(ncads, ncols, nrows) + 1000.
+    x, y = np.meshgrid(np.arange(nrows), np.arange(ncols))
+    aperture = (((x - nrows / 2.) ** 2 + (y - ncols / 2.) ** 2) < 16.) \
+               .astype('int32')
+    ts = TimeSeries(np.arange(ncads, dtype = 'float64'), flux)
+    
+    # Sanity check
+    assert np.array_equal(legacy_pixel_flux(flux, aperture), 
+                          ts.pixel_flux(aperture))
+    
+    def cold():
+        ts.flux = flux
+        ts.pixel_flux(aperture)
+    
+    t_legacy = timeit.timeit(lambda: legacy_pixel_flux(flux, aperture), 
+                             number = number) / number
+    t_cold = timeit.timeit(cold, number = number) / number
+    t_warm = timeit.timeit(lambda: ts.pixel_flux(aperture), 
+                           number = number) / number
+    
+    print("Stamp: %d cadences, %d x %d pixels, %d in aperture" % 
+          (ncads, ncols, nrows, aperture.sum()))
+    print("Legacy list comprehension: %8.3f ms" % (1e3 * t_legacy))
+    print("Vectorized gather:         %8.3f ms (%.0fx)" % 
+          (1e3 * t_cold, t_legacy / t_cold))
+    print("Cached gather:             %8.3f ms (%.0fx)" % 
+          (1e3 * t_warm, t_legacy / t_warm))
+
+if __name__ == '__main__':
+    main()
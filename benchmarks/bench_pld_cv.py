@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+bench_pld_cv.py
+---------------
+
+Benchmarks the cross-validation of the PLD prior in 
+:py:func:`everest3.pld.cross_validate` on a synthetic `K2` stamp, comparing
+the eigendecomposition/block down-date engine to brute-force refits for
+every prior variance and fold.
+
+'''
+
+from __future__ import division, print_function, absolute_import
+from bench_pld_pca import synthetic_stamp, _Target
+from everest3.utils import Scatter
+from everest3 import pld
+import numpy as np
+import time
+
+def brute_force(target, order, lambda_arr, nfolds, form):
+    '''
+    Cross-validates the PLD prior by refitting the model for every prior 
+    variance and fold.
+    
+    '''
+    
+    fpix, y, var, good, fit_mask = pld._prepare(target)
+    solver = pld.Solver(fpix, y, var, order, good = good, form = form)
+    lam = [np.var(y[good]) / sqnorm for sqnorm in solver.sqnorm]
+    folds = np.array_split(np.flatnonzero(good), nfolds)
+    f0 = np.nanmedian(target.sap_flux)
+    for k in range(order):
+        scatter = np.zeros((len(lambda_arr[k]), nfolds))
+        for i, l in enumerate(lambda_arr[k]):
+            for j, v in enumerate(folds):
+                mask = np.zeros_like(good)
+                mask[v] = True
+                model, _ = solver.solve(lam[:k] + [l] + lam[k + 1:], 
+                                        mask = mask)
+                scatter[i, j] = Scatter(f0 + y[v] - model[v])
+        lam[k] = lambda_arr[k][np.argmin(np.median(scatter, axis = 1))]
+    return lam
+
+def main(ncads = 1500, order = 3, nfolds = 5):
+    '''
+    
+    '''
+    
+    ts = synthetic_stamp(ncads = ncads)
+    x, y = np.meshgrid(np.arange(ts.nrows), np.arange(ts.ncols))
+    print("Stamp: %d cadences, order %d, %d folds" % (ncads, order, nfolds))
+    print("%-8s %8s %8s %14s %14s %8s" % ('Form', 'Columns', 'Lambdas', 
+                                          'Brute (s)', 'Engine (s)', 
+                                          'Speedup'))
+    for form, radius2 in [('primal', 3.), ('dual', 7.)]:
+        aperture = (((x - ts.nrows / 2.) ** 2 + 
+                     (y - ts.ncols / 2.) ** 2) < radius2).astype('int32')
+        target = _Target(ts, aperture)
+        
+        # The engine (including the solver build)
+        tstart = time.time()
+        cv = pld.cross_validate(target, order = order, nfolds = nfolds, 
+                                form = form)
+        t_engine = time.time() - tstart
+        
+        # Brute force
+        tstart = time.time()
+        lam = brute_force(target, order, cv['lambda_arr'], nfolds, form)
+        t_brute = time.time() - tstart
+        assert np.allclose(lam, cv['lam'])
+        
+        print("%-8s %8d %8d %14.3f %14.3f %7.1fx" % 
+              (form, sum([len(pld._combinations(aperture.sum(), n)) 
+                          for n in range(1, order + 1)]),
+               len(cv['lambda_arr'][0]), t_brute, t_engine, 
+               t_brute / t_engine))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+bench_pld_gp.py
+---------------
+
+Benchmarks the :py:mod:`everest3.gp` semiseparable factorization used by
+the GP noise model in :py:func:`everest3.pld.detrend` against a dense 
+Cholesky factorization of the same covariance, for increasing numbers of 
+`K2` long cadences, and times a full GP + PLD fit (with hyperparameter 
+optimization) on a synthetic stamp.
+
+'''
+
+from __future__ import division, print_function, absolute_import
+from bench_pld_pca import synthetic_stamp
+from bench_pld_segments import _Target
+from everest3 import gp, pld
+from scipy.linalg import cho_factor, cho_solve
+import numpy as np
+import time
+
+def main(sizes = (500, 1000, 2000, 4000, 8000), nrhs = 100):
+    '''
+    
+    '''
+    
+    kernel = gp.Kernel(gp.Matern32Term(1e3, 2.))
+    print("%8s %14s %14s %14s" % ('Cadences', 'Celerite (s)', 'Dense (s)', 
+                                  'Max rel. err.'))
+    for N in sizes:
+        t = np.arange(N) * 0.0204
+        var = 1e4 * np.ones(N)
+        y = np.random.randn(N, nrhs)
+        
+        tstart = time.time()
+        x1 = gp.Factor(kernel, t, var).solve(y)
+        t_celerite = time.time() - tstart
+        
+        if N <= 4000:
+            tstart = time.time()
+            C = kernel(t[:, None] - t[None, :]) + np.diag(var)
+            x2 = cho_solve(cho_factor(C), y)
+            t_dense = time.time() - tstart
+            err = np.max(np.abs(x1 - x2)) / np.max(np.abs(x2))
+            print("%8d %14.3f %14.3f %14.2e" % (N, t_celerite, t_dense, err))
+        else:
+            print("%8d %14.3f %14s %14s" % (N, t_celerite, '-', '-'))
+    
+    # A full fit
+    ts = synthetic_stamp()
+    x, y = np.meshgrid(np.arange(ts.nrows), np.arange(ts.ncols))
+    aperture = (((x - ts.nrows / 2.) ** 2 + (y - ts.ncols / 2.) ** 2) < 3.) \
+               .astype('int32')
+    target = _Target(ts, aperture)
+    tstart = time.time()
+    pld.detrend(target, order = 2, kernel = kernel)
+    print("Order 2 PLD + GP fit to %d cadences: %.3f s, %s" % 
+          (ts.ncads, time.time() - tstart, target.kernels[0]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+bench_pld_pca.py
+----------------
+
+Benchmarks the principal component reduction of the PLD regressors in
+:py:func:`everest3.pld.detrend` on synthetic `K2` long cadence postage 
+stamps, comparing the accuracy and the speed of the reduced fits to the 
+full solve.
+
+'''
+
+from __future__ import division, print_function, absolute_import
+from everest3.containers import TimeSeries
+from everest3.utils import Scatter
+from everest3 import pld
+import numpy as np
+import time
+
+def synthetic_stamp(ncads = 3853, ncols = 12, nrows = 12, seed = 42):
+    '''
+    A synthetic `K2` postage stamp of a star whose PSF drifts and jitters 
+    across the pixels as the spacecraft rolls, with thruster firings every 
+    six hours and photon noise.
+    
+    '''
+    
+    np.random.seed(seed)
+    t = np.arange(ncads) * 0.0204
+    roll = (t % 0.245) / 0.245
+    x0 = ncols / 2. + 0.4 * roll + 0.05 * np.sin(2 * np.pi * t / 11.) + \
+         0.02 * np.random.randn(ncads)
+    y0 = nrows / 2. - 0.3 * roll + 0.02 * np.random.randn(ncads)
+    i, j = np.meshgrid(np.arange(ncols), np.arange(nrows), indexing = 'ij')
+    psf = np.exp(-((i[None] - x0[:, None, None]) ** 2 + 
+                   (j[None] - y0[:, None, None]) ** 2) / (2 * 1.1 ** 2))
+    flux = 2e6 * psf / (2 * np.pi * 1.1 ** 2) + 50.
+    error = np.sqrt(flux)
+    flux += error * np.random.randn(*flux.shape)
+    return TimeSeries(t, flux, error)
+
+class _Target(object):
+    '''
+    The minimal target interface used by :py:func:`everest3.pld.detrend`.
+    
+    '''
+    
+    def __init__(self, ts, aperture):
+        self.raw = ts
+        self.aperture = aperture
+        fpix = ts.pixel_flux(aperture)
+        self.design = fpix / fpix.sum(axis = 1)[:, None]
+        self.sap_flux = fpix.sum(axis = 1)
+        self.sap_error = np.sqrt(np.sum(ts.pixel_error(aperture) ** 2, 
+                                        axis = 1))
+
+def main(order = 3, ranks = (10, 25, 50, 100), thresholds = (0.999, 0.9999)):
+    '''
+    
+    '''
+    
+    ts = synthetic_stamp()
+    x, y = np.meshgrid(np.arange(ts.nrows), np.arange(ts.ncols))
+    aperture = (((x - ts.nrows / 2.) ** 2 + (y - ts.ncols / 2.) ** 2) < 7.) \
+               .astype('int32')
+    
+    def fit(**kwargs):
+        target = _Target(ts, aperture)
+        tstart = time.time()
+        pld.detrend(target, order = order, **kwargs)
+        return target, time.time() - tstart
+    
+    full, t_full = fit()
+    cdpp_full = Scatter(target_flux(full))
+    print("Stamp: %d cadences, %d pixels in aperture, %d order %d "
+          "regressors" % (ts.ncads, aperture.sum(), full.weights.shape[0], 
+                          order))
+    print("Raw CDPP: %8.2f ppm" % Scatter(full.sap_flux))
+    print("%-16s %8s %10s %12s %10s" % ('Fit', 'Columns', 'Time (s)', 
+                                        'CDPP (ppm)', 'Model RMS'))
+    print("%-16s %8d %10.3f %12.2f %10s" % ('Full', full.weights.shape[0], 
+                                            t_full, cdpp_full, '-'))
+    for pca in list(ranks) + list(thresholds):
+        target, t = fit(pca = pca)
+        rms = np.nanstd(target.model - full.model) / np.nanstd(full.model)
+        print("%-16s %8d %10.3f %12.2f %10.2e" % 
+              ('pca = %s' % pca, target.weights.shape[0], t, 
+               Scatter(target_flux(target)), rms))
+
+def target_flux(target):
+    '''
+    The de-trended flux of a benchmark target.
+    
+    '''
+    
+    return target.sap_flux - target.model
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+bench_pld_segments.py
+---------------------
+
+Benchmarks the segment-parallel de-trending in 
+:py:func:`everest3.pld.detrend` on a synthetic `K2` stamp with a 
+mid-campaign data downlink, comparing a single fit over the whole light 
+curve to per-segment fits in one or more threads.
+
+'''
+
+from __future__ import division, print_function, absolute_import
+from bench_pld_pca import synthetic_stamp
+from everest3.containers import TimeSeries
+from everest3.utils import Scatter
+from everest3 import pld
+from multiprocessing import cpu_count
+import numpy as np
+import time
+
+class _Target(object):
+    '''
+    The minimal target interface used by :py:func:`everest3.pld.detrend`.
+    
+    '''
+    
+    def __init__(self, ts, aperture):
+        self.raw = ts
+        fpix = ts.pixel_flux(aperture)
+        self.design = fpix / fpix.sum(axis = 1)[:, None]
+        self.sap_flux = fpix.sum(axis = 1)
+        self.sap_error = np.sqrt(np.sum(ts.pixel_error(aperture) ** 2, 
+                                        axis = 1))
+
+def main(ncads = 3853, order = 3, nsegments = 4):
+    '''
+    
+    '''
+    
+    # A stamp with `nsegments - 1` data downlinks
+    ts = synthetic_stamp(ncads = ncads)
+    t = np.array(ts.time)
+    for b in np.linspace(0, ncads, nsegments + 1)[1:-1].astype(int):
+        t[b:] += 1.
+    ts = TimeSeries(t, ts.flux, ts.error)
+    x, y = np.meshgrid(np.arange(ts.nrows), np.arange(ts.ncols))
+    aperture = (((x - ts.nrows / 2.) ** 2 + (y - ts.ncols / 2.) ** 2) < 7.) \
+               .astype('int32')
+    
+    print("Stamp: %d cadences, %d segments, order %d, %d CPUs" % 
+          (ncads, nsegments, order, cpu_count()))
+    print("%-24s %10s %12s" % ('Fit', 'Time (s)', 'CDPP (ppm)'))
+    for name, kwargs in [('Single fit', dict(gap = None)),
+                         ('Segments, serial', dict(threads = 1)),
+                         ('Segments, %d thread(s)' % min(nsegments, 
+                                                       cpu_count()), {})]:
+        target = _Target(ts, aperture)
+        tstart = time.time()
+        pld.detrend(target, order = order, **kwargs)
+        elapsed = time.time() - tstart
+        print("%-24s %10.3f %12.2f" % (name, elapsed, 
+                                       Scatter(target.sap_flux - 
+                                               target.model)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+bench_prefetch.py
+-----------------
+
+Benchmarks the throughput of :py:func:`everest3.k2.prefetch` against a
+local stand-in for the `K2` archive that adds a fixed latency to every
+request, for several levels of concurrency.
+
+'''
+
+from __future__ import division, print_function, absolute_import
+from six.moves.BaseHTTPServer import HTTPServer
+from six.moves.SimpleHTTPServer import SimpleHTTPRequestHandler
+from six.moves.socketserver import ThreadingMixIn
+import everest3
+import numpy as np
+import threading
+import tempfile
+import shutil
+import time
+import os
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def main(ntargets = 200, size = 500000, latency = 0.05, 
+         concurrency = (1, 4, 16, 32)):
+    '''
+    
+    '''
+    
+    # Build the mirror
+    mirror = tempfile.mkdtemp()
+    everest3.k2.archive_url = mirror + '/'
+    ids = list(range(201000000, 201000000 + ntargets))
+    data = np.random.bytes(size)
+    for ID in ids:
+        file = everest3.k2._tpf_url(ID, 1)
+        if not os.path.exists(os.path.dirname(file)):
+            os.makedirs(os.path.dirname(file))
+        with open(file, 'wb') as f:
+            f.write(data)
+    
+    # Serve it with a fixed per-request latency
+    class Handler(SimpleHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        def translate_path(self, path):
+            time.sleep(latency)
+            return os.path.join(mirror, path.lstrip('/'))
+        def log_message(self, *args):
+            pass
+    server = _Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    everest3.k2.archive_url = 'http://127.0.0.1:%d/' % server.server_port
+    
+    print("%d targets, %.1f MB each, %d ms latency per request" % 
+          (ntargets, size / 1e6, 1e3 * latency))
+    try:
+        for n in concurrency:
+            everest3.k2.KPLR_ROOT = tempfile.mkdtemp()
+            res = everest3.k2.prefetch(ids, 1, max_concurrency = n)
+            assert len(res['downloaded']) == ntargets
+            print("Concurrency %3d: %6.2f s, %7.1f targets/s, %7.1f MB/s" % 
+                  (n, res['time'], ntargets / res['time'], 
+                   res['bytes'] / 1e6 / res['time']))
+            shutil.rmtree(everest3.k2.KPLR_ROOT)
+    finally:
+        server.shutdown()
+        shutil.rmtree(mirror)
+
+if __name__ == '__main__':
+    main()
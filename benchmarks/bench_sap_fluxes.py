@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+bench_sap_fluxes.py
+-------------------
+
+Benchmarks the SAP fluxes of the candidate apertures of an optimal aperture
+search on a realistic `K2` long cadence postage stamp, computed one at a 
+time with :py:meth:`TimeSeries.sap_flux` and all at once with 
+:py:meth:`TimeSeries.sap_fluxes`.
+
+'''
+
+from __future__ import division, print_function, absolute_import
+from everest3.k2 import candidate_apertures
+from bench_pld_pca import synthetic_stamp
+import numpy as np
+import time
+
+def main(nlevels = 150):
+    '''
+    
+    '''
+    
+    ts = synthetic_stamp()
+    ts.flux[100:110, 3, 4] = np.nan
+    apertures = candidate_apertures(np.nanmedian(ts.flux, axis = 0), 
+                                    nlevels = nlevels)
+    
+    tstart = time.time()
+    loop = np.array([ts.sap_flux(ap) for ap in apertures]).T
+    t_loop = time.time() - tstart
+    ts.flux = ts.flux
+    tstart = time.time()
+    batch, _ = ts.sap_fluxes(apertures)
+    t_batch = time.time() - tstart
+    assert np.allclose(loop, batch)
+    
+    print("Stamp: %d cadences, %d x %d pixels; %d candidate apertures" % 
+          (ts.ncads, ts.ncols, ts.nrows, len(apertures)))
+    print("One at a time: %8.3f ms" % (1e3 * t_loop))
+    print("Batched:       %8.3f ms (%.0fx)" % (1e3 * t_batch, 
+                                              t_loop / t_batch))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+bench_shared.py
+---------------
+
+Benchmarks sending a `K2` short cadence postage stamp to the workers of a
+process pool, with the :py:class:`TimeSeries` arrays in private memory 
+(pickled in full for every task) and in shared memory (see 
+:py:meth:`TimeSeries.share`).
+
+'''
+
+from __future__ import division, print_function, absolute_import
+from everest3.containers import TimeSeries
+from multiprocessing import Pool
+import numpy as np
+import pickle
+import time
+
+def sap(args):
+    '''
+    A task that sums the flux in an aperture.
+    
+    '''
+    
+    ts, aperture = args
+    return ts.sap_flux(aperture).sum()
+
+def main(ncads = 100000, ncols = 14, nrows = 16, ntasks = 16, workers = 4):
+    '''
+    
+    '''
+    
+    np.random.seed(42)
+    ts = TimeSeries(np.arange(ncads, dtype = 'float64'), 
+                    np.random.randn(ncads, ncols, nrows) + 1000.,
+                    np.ones((ncads, ncols, nrows)))
+    apertures = [np.random.randint(0, 2, (ncols, nrows)) 
+                 for i in range(ntasks)]
+    print("Stamp: %d cadences, %d x %d pixels (%.0f MB); %d tasks, "
+          "%d workers" % (ncads, ncols, nrows, 2 * ts.flux.nbytes / 1e6, 
+                          ntasks, workers))
+    pool = Pool(workers)
+    try:
+        for label in ('Private', 'Shared'):
+            if label == 'Shared':
+                ts.share()
+            size = len(pickle.dumps(ts, -1))
+            tstart = time.time()
+            res = pool.map(sap, [(ts, ap) for ap in apertures])
+            elapsed = time.time() - tstart
+            print("%-8s pickle: %10d bytes, pool: %7.3f s" % (label, size, 
+                                                             elapsed))
+    finally:
+        pool.close()
+        pool.join()
+        ts.unshare()
+
+if __name__ == '__main__':
+    main()
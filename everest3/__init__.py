@@ -12,14 +12,46 @@ try:
 except NameError:
   __EVEREST3_SETUP__ = False
 
+#: The :py:obj:`everest3` submodules
+__submodules__ = [
+                  # Main modules
+                  'batch', 'cli', 'constants', 'containers', 'dvs', 'gp', 
+                  'pld', 'report', 'utils',
+                  
+                  # Mission modules
+                  'k2'
+                 ]
+
 if not __EVEREST3_SETUP__:
     
-    # Main modules
-    from . import constants
-    from . import containers
-    from . import dvs
-    from . import pld
-    from . import utils
+    import sys
+    if sys.version_info >= (3, 7):
+    
+        # Import the submodules lazily, on first attribute access, so 
+        # that `import everest3` doesn't pull in matplotlib, kplr, etc.
+        import importlib
+        
+        def __getattr__(name):
+            if name in __submodules__:
+                return importlib.import_module('.' + name, __name__)
+            raise AttributeError("module %r has no attribute %r" % 
+                                 (__name__, name))
+        
+        def __dir__():
+            return sorted(list(globals().keys()) + __submodules__)
     
-    # Mission modules
-    from . import k2
\ No newline at end of file
+    else:
+        
+        # Main modules
+        from . import batch
+        from . import cli
+        from . import constants
+        from . import containers
+        from . import dvs
+        from . import gp
+        from . import pld
+        from . import report
+        from . import utils
+        
+        # Mission modules
+        from . import k2
\ No newline at end of file
@@ -0,0 +1,560 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+batch.py
+--------
+
+Batch de-trending of many targets (e.g., a whole `K2` campaign) in a pool
+of worker processes. The state of every target is kept in a persistent job
+:py:class:`Ledger`, an :py:mod:`sqlite3` database, so that interrupted runs
+resume where they left off, failed targets are retried, and several nodes
+can work through the same list of targets by sharing one ledger file.
+
+'''
+
+from __future__ import division, print_function, absolute_import, \
+                       unicode_literals
+from .constants import EVEREST_DATA_DIR
+from .utils import BatchLogging, BatchLoggingActive, StopBatchLogging, \
+                   BLASThreads
+from multiprocessing import Pool, cpu_count
+import errno
+import glob
+import importlib
+import os
+import socket
+import sqlite3
+import time
+import traceback
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+import logging
+log = logging.getLogger(__name__)
+
+__all__ = ['Ledger', 'run']
+
+#: The job states
+PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+
+class _Lock(object):
+    '''
+    An exclusive advisory lock on a file, shared by all processes on all
+    nodes that can see it. This serializes the transactions on the ledger,
+    since :py:mod:`sqlite3`'s own locking is unreliable on network file
+    systems. A no-op on platforms without :py:mod:`fcntl`.
+    
+    '''
+    
+    def __init__(self, file):
+        '''
+        
+        '''
+        
+        self.file = file
+        self._fd = None
+    
+    def __enter__(self):
+        '''
+        
+        '''
+        
+        if fcntl is not None:
+            self._fd = os.open(self.file, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        return self
+    
+    def __exit__(self, *args):
+        '''
+        
+        '''
+        
+        if self._fd is not None:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+class Ledger(object):
+    '''
+    A persistent ledger of de-trending jobs. Each job is a target of a
+    given mission and season, and is `pending`, `running` (claimed by a
+    worker on some host), `done` or `failed`. The number of attempts, the
+    host and process that ran the job, its start and end times, its
+    duration and the last error are recorded.
+    
+    :param str file: The path to the ledger database. Default \
+           `batch/<name>.db` in the :py:obj:`everest3` data directory.
+    :param str name: The name of the ledger. Default `default`.
+    
+    '''
+    
+    def __init__(self, file = None, name = 'default'):
+        '''
+        
+        '''
+        
+        if file is None:
+            file = os.path.join(EVEREST_DATA_DIR, 'batch', '%s.db' % name)
+        self.file = file
+        self._db = {}
+        self._lock = _Lock(file + '.lock')
+        if not os.path.exists(os.path.dirname(os.path.abspath(file))):
+            os.makedirs(os.path.dirname(os.path.abspath(file)))
+        with self._lock:
+            with self.db as db:
+                db.execute('CREATE TABLE IF NOT EXISTS jobs '
+                           '(mission TEXT, id INTEGER, season INTEGER, '
+                           'status TEXT, attempts INTEGER, host TEXT, '
+                           'pid INTEGER, started REAL, finished REAL, '
+                           'time REAL, error TEXT, '
+                           'PRIMARY KEY (mission, id, season))')
+    
+    def __repr__(self):
+        '''
+        
+        '''
+        
+        return "<Ledger %s: %s>" % (self.file, ", ".join(["%d %s" % (n, s)
+                                    for s, n in sorted(self.summary()
+                                                       .items())]))
+    
+    def __getstate__(self):
+        '''
+        Connections can't be pickled; they are re-opened on first use.
+        
+        '''
+        
+        state = dict(self.__dict__)
+        state['_db'] = {}
+        return state
+    
+    @property
+    def db(self):
+        '''
+        The connection to the ledger database, opened once per process.
+        
+        '''
+        
+        pid = os.getpid()
+        if pid not in self._db:
+            self._db[pid] = sqlite3.connect(self.file, timeout = 60.)
+        return self._db[pid]
+    
+    def add(self, mission, ids, season = None):
+        '''
+        Adds targets to the ledger as `pending` jobs. Targets already in the
+        ledger are left untouched.
+        
+        :param str mission: The mission name, e.g. `k2`.
+        :param ids: An iterable of target IDs.
+        :param int season: The season (campaign) of the targets. Default \
+               :py:obj:`None` (the mission's default season).
+        
+        :returns: The number of jobs added.
+        
+        '''
+        
+        season = -1 if season is None else int(season)
+        with self._lock:
+            with self.db as db:
+                n = db.total_changes
+                db.executemany('INSERT OR IGNORE INTO jobs VALUES '
+                               '(?, ?, ?, ?, 0, NULL, NULL, NULL, NULL, '
+                               'NULL, NULL)', [(mission, int(ID), season,
+                                                PENDING) for ID in ids])
+                return db.total_changes - n
+    
+    def reset(self, mission, ids, season = None):
+        '''
+        Resets jobs to `pending`, with no attempts, so that they are run
+        again from scratch.
+        
+        :returns: The number of jobs reset.
+        
+        '''
+        
+        season = -1 if season is None else int(season)
+        with self._lock:
+            with self.db as db:
+                n = db.total_changes
+                db.executemany('UPDATE jobs SET status = ?, attempts = 0, '
+                               'error = NULL WHERE mission = ? AND id = ? '
+                               'AND season = ?', [(PENDING, mission, int(ID),
+                                                   season) for ID in ids])
+                return db.total_changes - n
+    
+    def recover(self):
+        '''
+        Resets the `running` jobs of this host whose process no longer
+        exists (e.g., after the run was interrupted) to `pending`.
+        
+        :returns: The number of jobs recovered.
+        
+        '''
+        
+        host = socket.gethostname()
+        with self._lock:
+            with self.db as db:
+                rows = db.execute('SELECT rowid, pid FROM jobs WHERE '
+                                  'status = ? AND host = ?',
+                                  (RUNNING, host)).fetchall()
+                dead = [(PENDING, rowid) for rowid, pid in rows
+                        if not _alive(pid)]
+                db.executemany('UPDATE jobs SET status = ? WHERE rowid = ?',
+                               dead)
+        if len(dead):
+            log.info('Recovered %d interrupted job(s).' % len(dead))
+        return len(dead)
+    
+    def claim(self, mission = None, max_attempts = 3, stale = 21600.):
+        '''
+        Atomically claims the next job: a `pending` job, a `failed` job
+        with fewer than `max_attempts` attempts, or a job that has been
+        `running` for longer than `stale` seconds (presumably on a node that
+        died). The job is marked `running` on this host and process. Jobs
+        that went stale on their last attempt are marked `failed`.
+        
+        :param str mission: Only claim jobs of this mission. Default \
+               :py:obj:`None` (any mission).
+        :param int max_attempts: The maximum number of attempts per job. \
+               Default `3`.
+        :param float stale: The time in seconds after which a `running` \
+               job is considered abandoned. Default `21600` (6 hours).
+        
+        :returns: A `(mission, ID, season)` tuple, where `season` is \
+                  :py:obj:`None` for the default season, or \
+                  :py:obj:`None` if there are no jobs left.
+        
+        '''
+        
+        now = time.time()
+        query = 'SELECT rowid, mission, id, season FROM jobs WHERE ' \
+                '((status = ?) OR (status = ? AND attempts < ?) OR ' \
+                '(status = ? AND started < ? AND attempts < ?))'
+        args = [PENDING, FAILED, max_attempts, RUNNING, now - stale,
+                max_attempts]
+        if mission is not None:
+            query += ' AND mission = ?'
+            args.append(mission)
+        with self._lock:
+            with self.db as db:
+                db.execute('UPDATE jobs SET status = ?, finished = ?, '
+                           'error = ? WHERE status = ? AND started < ? AND '
+                           'attempts >= ?', (FAILED, now, 'The worker died '
+                           '(no result after %.0f s).' % stale, RUNNING, 
+                           now - stale, max_attempts))
+                row = db.execute(query + ' ORDER BY attempts, rowid LIMIT 1',
+                                 args).fetchone()
+                if row is None:
+                    return None
+                db.execute('UPDATE jobs SET status = ?, attempts = '
+                           'attempts + 1, host = ?, pid = ?, started = ?, '
+                           'finished = NULL WHERE rowid = ?',
+                           (RUNNING, socket.gethostname(), os.getpid(), now,
+                            row[0]))
+        return row[1], row[2], None if row[3] < 0 else row[3]
+    
+    def finish(self, mission, ID, season, error = None):
+        '''
+        Marks a job as `done`, or as `failed` if an `error` message is
+        given, and records its duration.
+        
+        '''
+        
+        season = -1 if season is None else int(season)
+        now = time.time()
+        with self._lock:
+            with self.db as db:
+                db.execute('UPDATE jobs SET status = ?, finished = ?, '
+                           'time = ? - started, error = ? WHERE mission = ? '
+                           'AND id = ? AND season = ?',
+                           (DONE if error is None else FAILED, now, now,
+                            error, mission, int(ID), season))
+    
+    def summary(self, mission = None):
+        '''
+        Returns a :py:obj:`dict` of the number of jobs in each state.
+        
+        '''
+        
+        query = 'SELECT status, COUNT(*) FROM jobs'
+        args = ()
+        if mission is not None:
+            query += ' WHERE mission = ?'
+            args = (mission,)
+        return dict(self.db.execute(query + ' GROUP BY status',
+                                    args).fetchall())
+    
+    def jobs(self, status = None):
+        '''
+        Returns the jobs in the ledger (optionally, only those with a given
+        `status`) as a list of :py:obj:`dict`.
+        
+        '''
+        
+        query = 'SELECT mission, id, season, status, attempts, host, pid, ' \
+                'started, finished, time, error FROM jobs'
+        args = ()
+        if status is not None:
+            query += ' WHERE status = ?'
+            args = (status,)
+        keys = ('mission', 'ID', 'season', 'status', 'attempts', 'host',
+                'pid', 'started', 'finished', 'time', 'error')
+        return [dict(zip(keys, row)) for row in
+                self.db.execute(query + ' ORDER BY rowid', args)]
+
+def _alive(pid):
+    '''
+    Returns :py:obj:`True` if the process `pid` exists on this host.
+    
+    '''
+    
+    if pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+def _mission(mission):
+    '''
+    Imports a mission module, e.g. `k2`, or any module that defines a
+    :py:class:`Target` class.
+    
+    '''
+    
+    try:
+        return importlib.import_module('.' + mission, 'everest3')
+    except ImportError:
+        return importlib.import_module(mission)
+
+def _keep_profile(star, profile, path):
+    '''
+    Saves the :py:mod:`cProfile` statistics of the target `star` in the
+    directory `path`, and deletes all but the `profile` slowest targets'
+    statistics there.
+    
+    '''
+    
+    import pstats
+    if star is None or star.profiler is None:
+        return
+    if not os.path.exists(path):
+        os.makedirs(path)
+    file = os.path.join(path, '%s.prof' % star.ID)
+    star.profiler.dump_stats(file + '.tmp')
+    os.rename(file + '.tmp', file)
+    times = []
+    for file in glob.glob(os.path.join(path, '*.prof')):
+        try:
+            times.append((pstats.Stats(file).total_tt, file))
+        except Exception:
+            
+            # Deleted or being replaced by another worker
+            continue
+    for _, file in sorted(times, reverse = True)[profile:]:
+        try:
+            os.remove(file)
+        except OSError:
+            pass
+
+def _initialize(queue, blas_threads):
+    '''
+    Initializes a worker process: its records go to the batch logging 
+    `queue`, and its BLAS libraries use at most `blas_threads` threads.
+    
+    '''
+    
+    BatchLogging(queue)
+    BLASThreads(blas_threads)
+
+def _work(ledger, mission, until, save, max_attempts, stale, resume, 
+          metrics_file, profile, profile_dir, kwargs, callback = None):
+    '''
+    The worker loop: claims and de-trends targets until there are none
+    left, calling `callback()` after each one. Returns the number of 
+    targets processed.
+    
+    '''
+    
+    Target = _mission(mission).Target
+    n = 0
+    while True:
+        job = ledger.claim(mission = mission, max_attempts = max_attempts,
+                           stale = stale)
+        if job is None:
+            return n
+        _, ID, season = job
+        error = None
+        star = None
+        try:
+            star = Target(ID, season = season, quiet = True)
+            if metrics_file is not None:
+                star.metrics_file = metrics_file
+            if profile:
+                star.profile = True
+            if not resume:
+                star.clear_checkpoints()
+            star.run(until = until, **kwargs)
+            if save:
+                star.save()
+        except Exception:
+            error = traceback.format_exc()
+            log.error('Target %d failed:\n%s' % (ID, error))
+        if profile:
+            _keep_profile(star, profile, profile_dir)
+        ledger.finish(mission, ID, season, error = error)
+        n += 1
+        if callback is not None:
+            callback()
+
+def run(ids = None, campaign = None, mission = 'k2', workers = None,
+        ledger = None, until = 'dvs', save = True, max_attempts = 3,
+        stale = 21600., resume = True, progress = None, interval = 10., 
+        log_file = None, metrics_file = None, profile = 0, 
+        profile_dir = None, **kwargs):
+    '''
+    De-trends a list of targets, or all targets in a campaign, in a pool of
+    worker processes. The targets are added to a persistent
+    :py:class:`Ledger`, from which the workers claim them one at a time.
+    Targets that are already `done` are skipped, targets left `running` by
+    an interrupted run on this host are resumed (from their pipeline
+    checkpoints), and `failed` targets are retried up to `max_attempts`
+    times. Other nodes may call this function with the same ledger file 
+    (and `resume = True`) to share the work.
+    
+    :param ids: The IDs of the targets to de-trend. Default \
+           :py:obj:`None`.
+    :param int campaign: The season (campaign) of the targets. If `ids` is \
+           :py:obj:`None`, all targets of this campaign in the mission's \
+           offline index (e.g., :py:func:`everest3.k2.build_index`) are \
+           de-trended. Default :py:obj:`None`.
+    :param str mission: The mission module. Default `k2`.
+    :param int workers: The number of worker processes. Default \
+           :py:obj:`None` (one per CPU).
+    :param ledger: The job ledger, or the path to its file. Default \
+           :py:obj:`None`, in which case a ledger named after the mission \
+           and campaign is used.
+    :type ledger: :py:class:`Ledger` or :py:obj:`str`
+    :param str until: The last pipeline stage to run for each target. \
+           Default `dvs`.
+    :param bool save: Save the de-trending results of each target with \
+           :py:meth:`Target.save`? Default :py:obj:`True`.
+    :param int max_attempts: The maximum number of attempts per target. \
+           Default `3`.
+    :param float stale: The time in seconds after which a target claimed \
+           by another node is considered abandoned. Default `21600`.
+    :param bool resume: Resume from the ledger and the pipeline \
+           checkpoints? If :py:obj:`False`, the targets are reset in the \
+           ledger and re-run from scratch. Default :py:obj:`True`.
+    :param func progress: A function called with the \
+           :py:meth:`Ledger.summary` of the jobs every `interval` seconds \
+           (or after each target, with a single worker) and at the end of \
+           the run. Default :py:obj:`None`.
+    :param float interval: The progress reporting interval in seconds. \
+           Default `10`.
+    :param str log_file: A log file for the records of all targets. \
+           Default :py:obj:`None`.
+    :param str metrics_file: A file to which the per-stage \
+           :py:attr:`Target.metrics` of all targets are appended as JSON \
+           lines. Default :py:obj:`None`.
+    :param int profile: Profile the targets with :py:mod:`cProfile`, and \
+           keep the statistics of this many of the slowest ones. Default \
+           `0`.
+    :param str profile_dir: The directory for the `<ID>.prof` statistics \
+           files. Default :py:obj:`None`, in which case a directory named \
+           after the ledger file is used.
+    
+    To avoid oversubscribing the CPUs, :py:func:`everest3.pld.detrend` 
+    runs in a single thread in each worker (unless a number of `threads` 
+    is passed to it), and the BLAS libraries of each worker are limited to
+    its share of the CPUs, if :py:mod:`threadpoolctl` is installed (see
+    :py:func:`everest3.utils.BLASThreads`).
+    
+    Logging is switched to :py:func:`everest3.utils.BatchLogging` mode for
+    the duration of the run (unless it is active already): the records of
+    all processes go through a queue to a single writer thread, tagged with
+    their target and stage, and each target's records are also written to
+    its own log file.
+    
+    Additional keyword arguments are passed to :py:meth:`Target.run` (and
+    from there to :py:func:`everest3.pld.detrend`), so that resumed or 
+    retried targets reuse the `model` checkpoints fit with the same 
+    arguments.
+    
+    :returns: The :py:meth:`Ledger.summary` of the jobs at the end of the \
+              run.
+    
+    '''
+    
+    tstart = time.time()
+    
+    # Non-blocking logging, set up once for all targets
+    stop_logging = not BatchLoggingActive()
+    queue = BatchLogging(file_name = log_file)
+    
+    # The ledger
+    if ledger is None:
+        ledger = Ledger(name = mission if campaign is None else
+                        '%s-c%02d' % (mission, campaign))
+    elif not isinstance(ledger, Ledger):
+        ledger = Ledger(ledger)
+    
+    # The targets
+    if ids is None:
+        assert campaign is not None, \
+               "Either `ids` or `campaign` must be provided."
+        ids = _mission(mission).targets(campaign)
+    n = ledger.add(mission, ids, season = campaign)
+    if not resume:
+        ledger.reset(mission, ids, season = campaign)
+    ledger.recover()
+    log.info('Added %d target(s) to %s.' % (n, ledger))
+    if profile and (profile_dir is None):
+        profile_dir = os.path.splitext(ledger.file)[0] + '-profiles'
+    
+    # Run!
+    if workers is None:
+        workers = cpu_count()
+    args = (ledger, mission, until, save, max_attempts, stale, resume, 
+            metrics_file, profile, profile_dir, kwargs)
+    if progress is None:
+        report = None
+    else:
+        report = lambda: progress(ledger.summary(mission))
+    try:
+        if workers > 1:
+            pool = Pool(workers, _initialize, 
+                        (queue, max(1, cpu_count() // workers)))
+            try:
+                results = [pool.apply_async(_work, args) 
+                           for i in range(workers)]
+                for r in results:
+                    while not r.ready():
+                        r.wait(interval)
+                        if report is not None:
+                            report()
+                n = sum([r.get() for r in results])
+                
+                # Let the workers exit cleanly, flushing their log records
+                pool.close()
+            except BaseException:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            n = _work(*args, callback = report)
+    finally:
+        if stop_logging:
+            StopBatchLogging()
+    
+    summary = ledger.summary(mission)
+    if progress is not None:
+        progress(summary)
+    log.info('Processed %d target(s) in %.1f s: %s.' % (n, time.time() -
+             tstart, ", ".join(["%d %s" % (v, k) for k, v in
+                                sorted(summary.items())])))
+    return summary
@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+cli.py
+------
+
+The :py:obj:`everest3` command line interface, installed as the `everest3`
+console script::
+    
+    everest3 download -c 5 --jobs 16
+    everest3 detrend -c 5 --jobs 32 --max-memory 512
+    everest3 dvs 201367065 201367066 --clobber
+    everest3 status -c 5
+    everest3 report -c 5 --sort improvement
+
+Targets are given as EPIC IDs and/or files listing one ID per line (or
+`K2` target list files, whose first column is the ID), or as a whole
+campaign (all its targets in the offline index, see
+:py:func:`everest3.k2.build_index`). The `detrend` and `dvs` commands run
+the :py:class:`Target` pipeline up to the `model` (:py:meth:`detrend`) and
+`dvs` (:py:meth:`plot_dvs`) stages in a pool of processes, via
+:py:func:`everest3.batch.run`, and the `report` command collects their
+saved results into a campaign report (:py:func:`everest3.report.report`).
+The interface never prompts and uses a
+non-interactive plotting backend, so it is safe to run on headless nodes.
+Commands are resumable by default: existing downloads are kept and 
+completed targets are skipped, unless `--clobber` is given.
+
+'''
+
+from __future__ import division, print_function, absolute_import, \
+                       unicode_literals
+import argparse
+import os
+import sys
+import time
+import logging
+log = logging.getLogger(__name__)
+
+__all__ = ['main']
+
+class _UsageError(Exception):
+    '''
+    An invalid command line, reported as a usage error.
+    
+    '''
+    
+    pass
+
+def _ids(args):
+    '''
+    Returns the list of target IDs given on the command line, reading any
+    files in the list, or :py:obj:`None` if there are none.
+    
+    '''
+    
+    ids = []
+    for arg in args.targets:
+        if os.path.exists(arg):
+            with open(arg, 'r') as f:
+                for line in f:
+                    try:
+                        ids.append(int(line.split(',')[0]))
+                    except ValueError:
+                        continue
+        else:
+            try:
+                ids.append(int(arg))
+            except ValueError:
+                raise _UsageError('Invalid target `%s`: not an ID or a '
+                                  'file.' % arg)
+    if len(ids):
+        return ids
+    elif args.campaign is None:
+        raise _UsageError('Please provide target IDs or a campaign.')
+    else:
+        return None
+
+class _Progress(object):
+    '''
+    Prints the progress and throughput of a run, one line at a time (so
+    the output is readable in log files as well as in terminals).
+    
+    '''
+    
+    def __init__(self, total, start = 0, stream = None):
+        '''
+        
+        '''
+        
+        self.total = total
+        self.start = start
+        self.stream = stream or sys.stdout
+        self.tstart = time.time()
+    
+    def __call__(self, done, failed = 0, nbytes = 0, total = None):
+        '''
+        Reports the number of targets `done` and `failed` so far (of which
+        `start` were already so when the run began), and the total number
+        of bytes downloaded.
+        
+        '''
+        
+        if total is not None:
+            self.total = total
+        elapsed = max(time.time() - self.tstart, 1e-6)
+        rate = 60. * (done + failed - self.start) / elapsed
+        line = "[%s] %6d / %-6d done, %4d failed, %8.1f targets/min" % \
+               (time.strftime('%H:%M:%S'), done, self.total, failed, rate)
+        if nbytes:
+            line += ", %7.2f MB/s" % (nbytes / 1e6 / elapsed)
+        print(line, file = self.stream)
+        self.stream.flush()
+
+def _ledger(args):
+    '''
+    Returns the :py:class:`everest3.batch.Ledger` of a run.
+    
+    '''
+    
+    from . import batch
+    if args.ledger is not None:
+        return batch.Ledger(args.ledger)
+    else:
+        return batch.Ledger(name = args.mission if args.campaign is None
+                            else '%s-c%02d' % (args.mission, args.campaign))
+
+def download(args):
+    '''
+    Downloads the target pixel files of the targets.
+    
+    '''
+    
+    from . import k2
+    if args.campaign is None:
+        raise _UsageError('Please provide the campaign to download.')
+    ids = _ids(args)
+    if ids is None:
+        ids = k2.targets(args.campaign)
+    progress = _Progress(len(ids))
+    state = dict(done = 0, failed = 0, bytes = 0, last = 0.)
+    
+    def callback(ID, nbytes, error):
+        state['failed' if error else 'done'] += 1
+        state['bytes'] += nbytes
+        if time.time() - state['last'] > args.interval:
+            state['last'] = time.time()
+            progress(state['done'], state['failed'], state['bytes'])
+    
+    res = k2.prefetch(ids, args.campaign, max_concurrency = args.jobs,
+                      clobber = args.clobber, callback = callback)
+    progress(len(res['downloaded']), len(res['failed']), res['bytes'],
+             total = len(res['downloaded']) + len(res['failed']))
+    if len(res['skipped']):
+        print("Skipped %d existing file(s)." % len(res['skipped']))
+    return 1 if len(res['failed']) else 0
+
+def _run(args, until):
+    '''
+    Runs the pipeline up to the stage `until` for the targets.
+    
+    '''
+    
+    from . import batch
+    ids = _ids(args)
+    kwargs = {}
+    if args.max_memory is not None:
+        kwargs['max_memory'] = int(args.max_memory * 2 ** 20)
+    if args.order is not None:
+        kwargs['order'] = args.order
+    ledger = _ledger(args)
+    if args.clobber:
+        start = 0
+    else:
+        summary = ledger.summary(args.mission)
+        start = summary.get('done', 0) + summary.get('failed', 0)
+    progress = _Progress(None, start = start)
+    summary = batch.run(ids = ids, campaign = args.campaign,
+                        mission = args.mission, workers = args.jobs,
+                        ledger = ledger, until = until,
+                        resume = not args.clobber,
+                        max_attempts = args.max_attempts,
+                        interval = args.interval, log_file = args.log_file,
+                        metrics_file = args.metrics_file, 
+                        profile = args.profile, progress = lambda s:
+                        progress(s.get('done', 0), s.get('failed', 0),
+                                 total = sum(s.values())), **kwargs)
+    return 1 if summary.get('failed', 0) else 0
+
+def detrend(args):
+    '''
+    De-trends the targets.
+    
+    '''
+    
+    return _run(args, 'model')
+
+def dvs(args):
+    '''
+    De-trends the targets and plots their data validation summaries.
+    
+    '''
+    
+    return _run(args, 'dvs')
+
+def report(args):
+    '''
+    Writes a campaign report of the saved results of the targets.
+    
+    '''
+    
+    from .report import report as write_report
+    index = write_report(ids = _ids(args), campaign = args.campaign, 
+                         mission = args.mission, path = args.output, 
+                         sort = args.sort, 
+                         pages_per_file = args.pages_per_file)
+    print("Report: %s" % index)
+    return 0
+
+def status(args):
+    '''
+    Prints the state of the jobs in a ledger.
+    
+    '''
+    
+    from . import batch
+    ledger = _ledger(args)
+    jobs = ledger.jobs()
+    print("Ledger: %s" % ledger.file)
+    for s in (batch.PENDING, batch.RUNNING, batch.DONE, batch.FAILED):
+        print("%-8s %8d" % (s, len([j for j in jobs if j['status'] == s])))
+    times = [j['time'] for j in jobs if j['status'] == batch.DONE]
+    if len(times):
+        print("Mean time per target: %.1f s" % (sum(times) / len(times)))
+    if args.failed:
+        for j in jobs:
+            if j['status'] == batch.FAILED:
+                error = (j['error'] or '').strip().split('\n')[-1]
+                print("%d (%d attempts): %s" % (j['ID'], j['attempts'],
+                                                error))
+    return 0
+
+def main(argv = None):
+    '''
+    The entry point of the `everest3` console script.
+    
+    :param list argv: The command line arguments. Default \
+           :py:obj:`None` (:py:obj:`sys.argv`).
+    
+    '''
+    
+    # No displays on compute nodes. This must happen before `pyplot` is
+    # imported, here or in the worker processes.
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    
+    parser = argparse.ArgumentParser(prog = 'everest3',
+                                     description = 'EVEREST 3.0 '
+                                     'de-trending pipeline.')
+    subparsers = parser.add_subparsers(dest = 'command')
+    subparsers.required = True
+    
+    def add(name, func, help):
+        sub = subparsers.add_parser(name, help = help,
+                                    description = func.__doc__.strip())
+        sub.set_defaults(func = func)
+        if func is status:
+            sub.add_argument('--failed', action = 'store_true',
+                             help = 'List the failed targets.')
+        elif func is report:
+            sub.add_argument('targets', nargs = '*',
+                             help = 'EPIC IDs, or files listing them.')
+            sub.add_argument('-o', '--output', default = None,
+                             help = 'The output directory (default: one '
+                             'per campaign in the data directory).')
+            sub.add_argument('--sort', default = 'scatter', 
+                             choices = ('scatter', 'improvement', 'mag', 
+                                        'ID'),
+                             help = 'The order of the targets (default: '
+                             'scatter).')
+            sub.add_argument('--pages-per-file', type = int, default = 500,
+                             help = 'The maximum number of pages per PDF '
+                             '(default: 500).')
+        else:
+            sub.add_argument('targets', nargs = '*',
+                             help = 'EPIC IDs, or files listing them.')
+            sub.add_argument('-j', '--jobs', type = int, default = None,
+                             help = 'The number of parallel jobs (default: '
+                             'one per CPU; 8 downloads).')
+            sub.add_argument('--clobber', action = 'store_true',
+                             help = 'Re-download existing files, or reset '
+                             'the ledger and re-run completed targets from '
+                             'scratch (default: skip and resume them).')
+            sub.add_argument('--interval', type = float, default = 10.,
+                             help = 'The progress reporting interval in '
+                             'seconds (default: 10).')
+        sub.add_argument('-c', '--campaign', type = int, default = None,
+                         help = 'The campaign.')
+        if func in (detrend, dvs, status):
+            sub.add_argument('--ledger', default = None,
+                             help = 'The job ledger file (default: one per '
+                             'campaign in the data directory).')
+        if func in (detrend, dvs, status, report):
+            sub.add_argument('--mission', default = 'k2',
+                             help = 'The mission module (default: k2).')
+        if func in (detrend, dvs):
+            sub.add_argument('--max-memory', type = float, default = None,
+                             help = 'The maximum memory in MB for the PLD '
+                             'regressors of each job.')
+            sub.add_argument('--order', type = int, default = None,
+                             help = 'The PLD order.')
+            sub.add_argument('--max-attempts', type = int, default = 3,
+                             help = 'The maximum number of attempts per '
+                             'target (default: 3).')
+            sub.add_argument('--log-file', default = None,
+                             help = 'A log file for the records of all '
+                             'targets, tagged with their ID and stage.')
+            sub.add_argument('--metrics-file', default = None,
+                             help = 'A file to which the time and memory '
+                             'use of each stage are appended as JSON lines.')
+            sub.add_argument('--profile', type = int, default = 0, 
+                             metavar = 'N',
+                             help = 'Profile the targets and keep the '
+                             'statistics of the N slowest ones.')
+        return sub
+    
+    add('download', download, 'Download target pixel files.')
+    add('detrend', detrend, 'De-trend targets.')
+    add('dvs', dvs, 'De-trend targets and plot their DVS.')
+    add('status', status, 'Show the state of a batch run.')
+    add('report', report, 'Write a campaign report.')
+    
+    args = parser.parse_args(argv)
+    if (args.func is download) and (args.jobs is None):
+        args.jobs = 8
+    logging.basicConfig(level = logging.WARNING,
+                        format = '%(asctime)s %(name)s %(levelname)s: '
+                                 '%(message)s')
+    try:
+        return args.func(args)
+    except _UsageError as e:
+        parser.error(str(e))
+    except KeyboardInterrupt:
+        print("Interrupted. Run again to continue.",
+              file = sys.stderr)
+        return 130
+
+if __name__ == '__main__':
+    sys.exit(main())
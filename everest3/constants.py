@@ -23,10 +23,9 @@ EVEREST_VERSION = __version__
 #: The major.minor version number
 EVEREST_MAJOR_MINOR = ".".join(EVEREST_VERSION.split(".")[:-1])
 
-#: The top-level :py:obj:`everest` data directory
+#: The top-level :py:obj:`everest` data directory. This is created on
+#: first write, not on import.
 EVEREST_DATA_DIR = os.path.expanduser(os.environ.get("EVEREST3_DATA_DIR", os.path.join("~", ".everest3")))                               
-if not os.path.exists(EVEREST_DATA_DIR):
-    os.mkdir(EVEREST_DATA_DIR)
 
 #: The :py:mod:`everest3` source code directory
 EVEREST_SRC_DIR = os.path.dirname(os.path.abspath(__file__))
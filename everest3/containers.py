@@ -12,46 +12,321 @@ from __future__ import division, print_function, absolute_import, \
                        unicode_literals
 from . import __version__
 from .constants import *
-from .dvs import DVS, default_layout
-from .utils import InitializeLogging
+from .utils import InitializeLogging, LogContext, Scatter, SaveArrays, \
+                   LoadArrays
+from six import string_types
 import numpy as np
+import contextlib
+import functools
+import hashlib
+import json
+import sys
+import time
+import weakref
 import logging
 log = logging.getLogger(__name__)
 
 __all__ = [ 'TimeSeries',
-            'Target' ]
+            'Target',
+            'STAGES' ]
+
+#: The stages of the de-trending pipeline, in order
+STAGES = ('raw', 'aperture', 'design', 'model', 'dvs')
+
+#: The :py:func:`everest3.pld.detrend` arguments that only affect how the 
+#: model is computed, not the model itself
+_RUNTIME_KWARGS = ('max_memory', 'threads')
+
+def _memoized(*deps):
+    '''
+    A decorator that turns a :py:class:`Target` method into a read-only
+    property whose value is cached until one of the attributes named in
+    `deps` is reassigned through its property setter. Note that in-place
+    modification of those attributes is **not** detected.
+    
+    '''
+    
+    def decorator(func):
+        
+        name = func.__name__
+        
+        @functools.wraps(func)
+        def wrapper(self):
+            try:
+                value = self._cache[name]
+            except KeyError:
+                self._cache_misses += 1
+                value = func(self)
+                if isinstance(value, np.ndarray):
+                    value.flags.writeable = False
+                self._cache[name] = value
+            else:
+                self._cache_hits += 1
+            return value
+        
+        wrapper._deps = deps
+        return property(wrapper)
+    
+    return decorator
+
+def _no_scatter(timeseries, *args, **kwargs):
+    '''
+    The default scatter metric of a :py:class:`TimeSeries`.
+    
+    '''
+    
+    return np.nan
+
+def _unlink(shm):
+    '''
+    Destroys a shared memory block. The memory itself is freed once the 
+    last process mapping it closes it.
+    
+    '''
+    
+    try:
+        shm.unlink()
+    except (OSError, AttributeError):
+        pass
+
+#: Whether each process inherited its resource tracker from its parent
+_inherited_tracker = {}
+
+def _attach(shared_memory, name):
+    '''
+    Attaches to the existing shared memory block `name` without letting 
+    the resource tracker of this process destroy it at exit, which it 
+    would otherwise do if the process wasn't started by the block's owner
+    after the block was created (e.g., a worker of an older pool).
+    
+    '''
+    
+    try:
+        return shared_memory.SharedMemory(name = name, track = False)
+    except TypeError:
+        pass
+    
+    # Python < 3.13: the block is tracked on attach. That's harmless if we
+    # share the owner's tracker (which tracks it anyway), but not otherwise
+    from multiprocessing import resource_tracker
+    pid = os.getpid()
+    if pid not in _inherited_tracker:
+        tracker = getattr(resource_tracker, '_resource_tracker', None)
+        _inherited_tracker[pid] = getattr(tracker, '_fd', None) is not None
+    shm = shared_memory.SharedMemory(name = name)
+    if not _inherited_tracker[pid]:
+        try:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        except Exception:
+            pass
+    return shm
+
+class _SharedArray(object):
+    '''
+    A :py:obj:`numpy` array in a named shared memory block. Pickling a 
+    :py:class:`_SharedArray` sends only the name, shape and dtype of the 
+    block, and unpickling it attaches to the block without copying the data.
+    
+    The process that created the block owns it, and destroys it when the
+    handle is :py:meth:`release`-d or garbage collected, or at exit. If the
+    owner is killed before it can do so, the block is destroyed by the
+    :py:obj:`multiprocessing` resource tracker instead, once the owner and 
+    the worker processes it started have all exited. Attached (worker) 
+    copies are read-only and never destroy the block, so a worker crash 
+    leaks nothing.
+    
+    :param tuple shape: The shape of the array.
+    :param dtype: The data type of the array.
+    :param str name: The name of an existing block to attach to. Default \
+           :py:obj:`None`, in which case a new block is created.
+    
+    '''
+    
+    def __init__(self, shape, dtype, name = None):
+        '''
+        
+        '''
+        
+        try:
+            from multiprocessing import shared_memory
+        except ImportError:
+            raise Exception('Shared memory requires Python 3.8 or later.')
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.owner = name is None
+        if self.owner:
+            size = max(1, int(np.prod(self.shape)) * self.dtype.itemsize)
+            shm = shared_memory.SharedMemory(create = True, size = size)
+        else:
+            shm = _attach(shared_memory, name)
+        self.name = shm.name
+        
+        # The array holds a reference to the block (through its `base`), so
+        # the mapping outlives the handle for as long as the array is used
+        address = np.frombuffer(shm.buf, dtype = 'uint8').ctypes.data
+        self.array = np.asarray(_SharedBuffer(shm, self.shape, self.dtype, 
+                                              address, not self.owner))
+        if self.owner:
+            self._finalizer = weakref.finalize(self, _unlink, shm)
+    
+    @classmethod
+    def copy(cls, array):
+        '''
+        Returns a new shared copy of `array`.
+        
+        '''
+        
+        array = np.asarray(array)
+        shared = cls(array.shape, array.dtype)
+        shared.array[...] = array
+        return shared
+    
+    def release(self):
+        '''
+        Destroys the block if this process owns it. Arrays that are already
+        attached to it remain valid.
+        
+        '''
+        
+        if self.owner:
+            self._finalizer()
+    
+    def __reduce__(self):
+        '''
+        
+        '''
+        
+        return (_SharedArray, (self.shape, self.dtype.str, self.name))
+
+class _SharedBuffer(object):
+    '''
+    Exposes a shared memory block to :py:obj:`numpy` through the array 
+    interface, keeping the block alive for as long as the array is.
+    
+    '''
+    
+    def __init__(self, shm, shape, dtype, address, readonly):
+        '''
+        
+        '''
+        
+        self.shm = shm
+        self.__array_interface__ = dict(shape = shape, typestr = dtype.str,
+                                        descr = dtype.descr, version = 3,
+                                        data = (address, readonly))
+
+def _rss():
+    '''
+    Returns the current resident set size of this process in MB, from 
+    :py:mod:`psutil` if it is installed or from `/proc` on Linux, or 
+    :py:obj:`None` if neither is available.
+    
+    '''
+    
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 2 ** 20
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        return None
+
+def _max_rss():
+    '''
+    Returns the peak resident set size of this process over its lifetime 
+    in MB, or :py:obj:`None` on platforms without :py:mod:`resource`.
+    
+    '''
+    
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss / 2 ** 20
+    else:
+        return rss / 2 ** 10
+
+def _json_default(obj):
+    '''
+    Serializes the :py:obj:`numpy` scalars and arrays (as a hash of their 
+    contents) and other objects (as their attributes) in the metrics 
+    records and the checkpoint keys.
+    
+    '''
+    
+    if isinstance(obj, np.ndarray):
+        data = np.ascontiguousarray(obj).tobytes()
+        return dict(dtype = obj.dtype.str, shape = list(obj.shape),
+                    sha1 = hashlib.sha1(data).hexdigest())
+    elif hasattr(obj, 'item'):
+        return obj.item()
+    elif hasattr(obj, '__dict__'):
+        return dict(vars(obj), __class__ = type(obj).__name__)
+    return str(obj)
+
+def _kwargs_key(kwargs):
+    '''
+    Returns a hash of the :py:func:`everest3.pld.detrend` arguments that
+    determine the model, on which its checkpoint is keyed.
+    
+    '''
+    
+    params = dict([(key, value) for key, value in kwargs.items() 
+                   if key not in _RUNTIME_KWARGS])
+    return hashlib.sha1(json.dumps(params, sort_keys = True, 
+                                   default = _json_default)
+                        .encode('utf-8')).hexdigest()
 
 class TimeSeries(object):
     '''
     A data container for a generic photometric timeseries defined on a postage
-    stamp.
+    stamp. Any of the arrays may instead be given as the path to a `.npy`
+    file, in which case it is memory-mapped (read-only) the first time it is
+    accessed. The shape of the postage stamp is read from the file header,
+    so :py:attr:`ncads`, :py:attr:`ncols` and :py:attr:`nrows` never touch 
+    the data pages. The arrays may also be moved to named shared memory 
+    with :py:meth:`share`, after which pickling the timeseries (e.g., to
+    send it to the workers of a process pool) sends only the names of the
+    memory blocks.
     
     :param array_like time: The time array.
     :param array_like flux: The flux array, shape `(ncads, ncols, nrows)`.
     :param array_like error: The flux errors array, shape \
-           `(ncads, ncols, nrows)`.
+           `(ncads, ncols, nrows)`. Default is an array of zeros.
     :param func scatter: The scatter metric, a function that accepts a \
            :py:class:`TimeSeries` instance (plus arbitrary `args` and \
            `kwargs`) and returns a :py:obj:`float`.
+    :param array_like quality: The integer data quality flags array, shape \
+           `(ncads)`. Default is an array of zeros.
     
     '''
     
+    #: The maximum number of cached pixel matrices
+    _pixel_cache_size = 8
+    
     def __init__(self, time = np.empty((0,), dtype = 'float64'), 
                  flux = np.empty((0,0,0,), dtype = 'float64'), 
-                 error = None, scatter = None):
+                 error = None, scatter = None, quality = None):
         '''
         
         '''
         
+        # The cache of `(ncads, npix)` pixel matrices, keyed by aperture
+        self._pixel_cache = {}
+        
         # Store the arrays
         self.time = time
         self.flux = flux
-        if error is not None:
-            self.error = error
-        else:
-            self.error = np.zeros_like(self.flux)
+        self.error = error
+        self.quality = quality
         if scatter is None:
-            self._scatter = lambda self: np.nan
+            self._scatter = _no_scatter
         else:
             self._scatter = scatter
         
@@ -62,6 +337,129 @@ class TimeSeries(object):
         
         return "<Timeseries of %d fluxes on a %d x %d pixel postage stamp>" % (self.ncads, self.ncols, self.nrows)
     
+    def __getstate__(self):
+        '''
+        The cached pixel matrices are not pickled.
+        
+        '''
+        
+        state = dict(self.__dict__)
+        state['_pixel_cache'] = {}
+        return state
+    
+    @classmethod
+    def from_npy(cls, path, **kwargs):
+        '''
+        Returns a lazily loaded, memory-mapped :py:class:`TimeSeries` backed
+        by the `time.npy`, `flux.npy`, `error.npy` and (if present) 
+        `quality.npy` files in the directory `path` (see :py:meth:`to_npy`).
+        Additional keyword arguments are passed to the constructor.
+        
+        '''
+        
+        quality = os.path.join(path, 'quality.npy')
+        if os.path.exists(quality):
+            kwargs['quality'] = quality
+        return cls(*[os.path.join(path, '%s.npy' % name) 
+                     for name in ('time', 'flux', 'error')], **kwargs)
+    
+    def to_npy(self, path):
+        '''
+        Saves the time, flux, error and quality arrays as `.npy` files in the 
+        directory `path`. Each file is written to a temporary file first and
+        then renamed, so readers never see a partially written array.
+        
+        '''
+        
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for name in ('time', 'flux', 'error', 'quality'):
+            file = os.path.join(path, '%s.npy' % name)
+            with open(file + '.tmp', 'wb') as f:
+                np.save(f, getattr(self, name))
+            os.rename(file + '.tmp', file)
+    
+    @property
+    def shared(self):
+        '''
+        Are the arrays in shared memory? See :py:meth:`share`.
+        
+        '''
+        
+        return all([isinstance(getattr(self, '_' + name), _SharedArray)
+                    for name in ('time', 'flux', 'error', 'quality')])
+    
+    def share(self):
+        '''
+        Moves the time, flux, error and quality arrays into named shared 
+        memory blocks, so that pickling the timeseries sends only the names
+        of the blocks, and processes that unpickle it attach to the same 
+        memory with no copy. The attached arrays are read-only. The blocks 
+        are owned by this process, and are destroyed when the arrays are
+        reassigned, when :py:meth:`unshare` is called, when the timeseries
+        is garbage collected, or at exit (see :py:class:`_SharedArray`).
+        Requires Python 3.8 or later.
+        
+        :returns: The timeseries itself.
+        
+        '''
+        
+        for name in ('time', 'flux', 'error', 'quality'):
+            if not isinstance(getattr(self, '_' + name), _SharedArray):
+                setattr(self, '_' + name, 
+                        _SharedArray.copy(getattr(self, name)))
+        return self
+    
+    def unshare(self):
+        '''
+        Copies the arrays back into private memory, and destroys the shared
+        memory blocks owned by this process (see :py:meth:`share`).
+        
+        :returns: The timeseries itself.
+        
+        '''
+        
+        for name in ('time', 'flux', 'error', 'quality'):
+            val = getattr(self, '_' + name)
+            if isinstance(val, _SharedArray):
+                setattr(self, '_' + name, np.array(val.array))
+                val.release()
+        return self
+    
+    def _load(self, name):
+        '''
+        Returns the array `name`, memory-mapping it if it is backed by
+        a file that hasn't been accessed yet.
+        
+        '''
+        
+        val = getattr(self, '_' + name)
+        if isinstance(val, _SharedArray):
+            return val.array
+        elif isinstance(val, string_types):
+            val = np.load(val, mmap_mode = 'r')
+            setattr(self, '_' + name, val)
+        return val
+    
+    @staticmethod
+    def _shape(val):
+        '''
+        Returns the shape of an array or of a `.npy` file, reading only its
+        header in the latter case.
+        
+        '''
+        
+        if isinstance(val, string_types):
+            with open(val, 'rb') as f:
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    header = np.lib.format.read_array_header_1_0(f)
+                else:
+                    header = np.lib.format.read_array_header_2_0(f)
+            return header[0]
+        else:
+            return val.shape
+    
     @property
     def time(self):
         '''
@@ -69,7 +467,7 @@ class TimeSeries(object):
         
         '''
         
-        return self._time
+        return self._load('time')
     
     @time.setter
     def time(self, val):
@@ -82,12 +480,14 @@ class TimeSeries(object):
         
         '''
         
-        return self._flux  
+        return self._load('flux')
 
     @flux.setter
     def flux(self, val):
-        assert len(val.shape) == 3, "Parameter `flux` must have shape `(ncads, ncols, nrows)`."
+        self._flux_shape = self._shape(val)
+        assert len(self._flux_shape) == 3, "Parameter `flux` must have shape `(ncads, ncols, nrows)`."
         self._flux = val
+        self._clear_pixel_cache('flux')
     
     @property
     def error(self):
@@ -96,13 +496,32 @@ class TimeSeries(object):
         
         '''
         
-        return self._error
+        if self._error is None:
+            self._error = np.zeros(self._flux_shape)
+        return self._load('error')
 
     @error.setter
     def error(self, val):
-        assert len(val.shape) == 3, "Parameter `error` must have shape `(ncads, ncols, nrows)`."
+        if val is not None:
+            assert len(self._shape(val)) == 3, "Parameter `error` must have shape `(ncads, ncols, nrows)`."
         self._error = val
+        self._clear_pixel_cache('error')
 
+    @property
+    def quality(self):
+        '''
+        The integer data quality flags array, shape `(ncads)`.
+        
+        '''
+        
+        if self._quality is None:
+            self._quality = np.zeros(self.ncads, dtype = 'int32')
+        return self._load('quality')
+    
+    @quality.setter
+    def quality(self, val):
+        self._quality = val
+    
     @property
     def ncols(self):
         '''
@@ -110,7 +529,7 @@ class TimeSeries(object):
         
         '''
         
-        return self._flux.shape[1]
+        return self._flux_shape[1]
     
     @property
     def nrows(self):
@@ -119,17 +538,69 @@ class TimeSeries(object):
         
         '''
         
-        return self._flux.shape[2]
+        return self._flux_shape[2]
 
     @property
     def ncads(self):
         '''
-        The number of columns in the postage stamp.
+        The number of cadences in the time series.
         
         '''
         
-        return self._flux.shape[0]
+        return self._flux_shape[0]
     
+    def _clear_pixel_cache(self, name):
+        '''
+        Drops all cached pixel matrices gathered from the array `name`.
+        
+        '''
+        
+        for key in [k for k in self._pixel_cache if k[0] == name]:
+            del self._pixel_cache[key]
+    
+    def _aperture_mask(self, aperture):
+        '''
+        Returns a boolean mask of shape `(ncols, nrows)` for `aperture`.
+        
+        '''
+        
+        # If no aperture, assume it's entire postage stamp
+        if aperture is None:
+            return np.ones((self.ncols, self.nrows), dtype = bool)
+        mask = (np.asarray(aperture) & 1).astype(bool)
+        assert mask.shape == (self.ncols, self.nrows), \
+               "Parameter `aperture` must have shape `(ncols, nrows)`."
+        return mask
+        
+    def _pixel_matrix(self, name, aperture):
+        '''
+        Gathers the pixels inside `aperture` from the `(ncads, ncols, nrows)`
+        array `name` into a cached `(ncads, npix)` matrix. The cache is keyed
+        on the aperture *contents*, so modifying an aperture array in place
+        results in a new entry, and is cleared whenever the :py:attr:`flux`
+        or :py:attr:`error` array is reassigned.
+        
+        '''
+        
+        mask = self._aperture_mask(aperture)
+        key = (name, mask.tobytes())
+        matrix = self._pixel_cache.get(key, None)
+        if matrix is None:
+        
+            # A single boolean gather over the whole cube. The pixel
+            # ordering is the same as that of `np.where(aperture & 1)`
+            matrix = getattr(self, name)[:, mask]
+            
+            # Protect the cached matrix from in-place modification
+            matrix.flags.writeable = False
+            
+            # Keep the cache bounded when searching over many apertures
+            if len(self._pixel_cache) >= self._pixel_cache_size:
+                del self._pixel_cache[next(iter(self._pixel_cache))]
+            self._pixel_cache[key] = matrix
+            
+        return matrix
+        
     def pixel_flux(self, aperture = None):
         '''
         The array of pixel fluxes within an aperture.
@@ -138,19 +609,12 @@ class TimeSeries(object):
                dimensions `(ncols, nrows)` with 1's corresponding  to pixels \
                included in the aperture and 0's to pixels outside the aperture.
         
-        :returns: A 2D pixel flux array of shape `(ncads, npix)`
+        :returns: A 2D pixel flux array of shape `(ncads, npix)`. This array \
+                  is cached and is therefore read-only.
         
         '''
         
-        # If no aperture, assume it's entire postage stamp
-        if aperture is None:
-            aperture = np.ones((self.ncols, self.nrows), dtype = 'int32')
-        
-        # Get the indices
-        ap = np.where(aperture & 1)
-        
-        # Collapse the flux array
-        return np.array([p[ap] for p in self.flux])
+        return self._pixel_matrix('flux', aperture)
 
     def pixel_error(self, aperture = None):
         '''
@@ -160,19 +624,12 @@ class TimeSeries(object):
                dimensions `(ncols, nrows)` with 1's corresponding  to pixels \
                included in the aperture and 0's to pixels outside the aperture.
         
-        :returns: A 2D pixel flux errors array of shape `(ncads, npix)`
+        :returns: A 2D pixel flux errors array of shape `(ncads, npix)`. \
+                  This array is cached and is therefore read-only.
         
         '''
         
-        # If no aperture, assume it's entire postage stamp
-        if aperture is None:
-            aperture = np.ones((self.ncols, self.nrows), dtype = 'int32')
-        
-        # Get the indices
-        ap = np.where(aperture & 1)
-        
-        # Collapse the flux array
-        return np.array([p[ap] for p in self.error])
+        return self._pixel_matrix('error', aperture)
    
     def sap_flux(self, aperture = None):
         '''
@@ -204,6 +661,82 @@ class TimeSeries(object):
         # Sum the errors in quadrature
         return np.sqrt(np.nansum(self.pixel_error(aperture) ** 2, axis = 1))      
     
+    def sap_fluxes(self, apertures):
+        '''
+        The simple aperture photometry fluxes and errors for a stack of
+        apertures, e.g. the candidates of an optimal aperture search. The
+        pixels in the union of the apertures are gathered once, and the
+        fluxes of all apertures are computed with a single matrix product
+        of the `(ncads, npix)` pixel matrix and the `(npix, napertures)`
+        aperture weights. NaN pixels are given zero weight, so the results
+        are the same as those of :py:meth:`sap_flux` and
+        :py:meth:`sap_error`.
+        
+        :param ndarray apertures: A 3D :py:obj:`numpy` array of integers of \
+               dimensions `(napertures, ncols, nrows)` with 1's corresponding \
+               to pixels included in each aperture and 0's to pixels outside.
+        
+        :returns: The SAP flux and the SAP flux errors arrays, each of \
+                  shape `(ncads, napertures)`.
+        
+        '''
+        
+        masks = (np.asarray(apertures) & 1).astype(bool)
+        assert masks.ndim == 3 and masks.shape[1:] == (self.ncols,
+               self.nrows), "Parameter `apertures` must have shape " + \
+               "`(napertures, ncols, nrows)`."
+        union = masks.any(axis = 0)
+        weights = masks[:, union].T.astype('float64')
+        
+        # Mask the NaN pixels in the gathered matrices
+        fpix = self.pixel_flux(union)
+        epix = self.pixel_error(union) ** 2
+        fpix = np.where(np.isnan(fpix), 0., fpix)
+        epix[np.isnan(epix)] = 0.
+        
+        return np.dot(fpix, weights), np.sqrt(np.dot(epix, weights))
+    
+    def segments(self, gap = 20., breakpoints = None, min_length = 100):
+        '''
+        Splits the timeseries into contiguous segments at data gaps and at
+        user-supplied breakpoints, e.g. the `K2` mid-campaign downlinks.
+        
+        :param float gap: The minimum length of a data gap, in units of the \
+               median cadence, at which to split the timeseries. Set to \
+               :py:obj:`None` to disable gap detection. Default `20`.
+        :param list breakpoints: The indices of the first cadence of \
+               additional segments. Default :py:obj:`None`.
+        :param int min_length: The minimum number of cadences per segment. \
+               Shorter segments are merged with the previous (or next) \
+               one. Default `100`.
+        
+        :returns: A list of :py:obj:`slice` objects covering all cadences.
+        
+        '''
+        
+        starts = set([int(b) for b in (breakpoints or []) 
+                      if 0 < b < self.ncads])
+        if gap is not None:
+            t = np.asarray(self.time)
+            inds = np.flatnonzero(np.isfinite(t))
+            if len(inds) > 1:
+                dt = np.diff(t[inds])
+                starts |= set(inds[1:][dt > gap * np.median(dt)].tolist())
+        
+        # Merge the short segments
+        bounds = [0] + sorted(starts) + [self.ncads]
+        i = 1
+        while (i < len(bounds) - 1) and (len(bounds) > 2):
+            if bounds[i] - bounds[i - 1] < min_length:
+                del bounds[i]
+            elif (i == len(bounds) - 2) and \
+                 (bounds[i + 1] - bounds[i] < min_length):
+                del bounds[i]
+            else:
+                i += 1
+        
+        return [slice(a, b) for a, b in zip(bounds[:-1], bounds[1:])]
+    
     def scatter(self, *args, **kwargs):
         '''
         Returns the scatter metric for the light curve.
@@ -217,14 +750,99 @@ class Target(object):
     A class that stores all the information, data, attributes, etc. for a star
     de-trended with :py:obj:`everest3`.
     
+    The de-trending is a lazy pipeline of named stages (see 
+    :py:obj:`STAGES`): `raw` (:py:meth:`get_raw_data`), `aperture` 
+    (:py:meth:`get_aperture`), `design` (:py:meth:`get_design`), `model` 
+    (:py:meth:`detrend`) and `dvs` (:py:meth:`plot_dvs`). Each stage runs
+    the first time one of its outputs is accessed, and its outputs are 
+    kept in memory. The `aperture`, `model` and `dvs` stages are also 
+    checkpointed to disk under :py:attr:`path`, so that a new 
+    :py:class:`Target` instance resumes from the last completed stage 
+    instead of recomputing it. The `raw` stage is cached by the mission 
+    module and the `design` stage is cheap to rebuild, so neither is 
+    checkpointed. The checkpoints are keyed on the 
+    :py:attr:`raw_fingerprint` of the raw data, and those of the `model` 
+    and `dvs` stages also on the :py:attr:`detrend_kwargs`, so they are 
+    discarded when the raw data change or ignored when the model is 
+    requested with different arguments.
+    
+    :param tuple stages: The stages to run (or load from their \
+           checkpoints) when the target is instantiated. All other stages \
+           run on demand. Default `()`.
+    :param bool checkpoint: Load and save stage checkpoints? Default \
+           :py:obj:`True`.
+    
+    Every run of a stage is timed, and its wall and CPU time, the resident
+    memory of the process before and after it (`rss_start`, `rss_end` 
+    and `rss_delta`), the sizes of the stage's output arrays and the peak
+    resident memory of the process are kept in :py:attr:`metrics` (see 
+    :py:attr:`record_metrics`, :py:attr:`trace_memory`, 
+    :py:attr:`metrics_file` and :py:attr:`profile`). The latter, 
+    `max_rss`, is the high-water mark over the whole lifetime of the 
+    process, so it only grows from stage to stage and from target to 
+    target in the same process; the peak memory of the stage itself is 
+    the `traced_peak` recorded with :py:attr:`trace_memory`. These 
+    switches may be set on the class or on individual instances at any 
+    time.
+    
     '''
     
+    #: Decimate the DVS light curves to the resolution of their cells 
+    #: (see :py:func:`everest3.dvs.decimate`)?
+    dvs_decimate = True
+    
+    #: Rasterize the DVS light curves?
+    dvs_rasterize = False
+    
+    #: Record the wall and CPU time, memory and output array sizes of each
+    #: pipeline stage in :py:attr:`metrics`?
+    record_metrics = True
+    
+    #: Also trace the peak memory allocated during each stage with 
+    #: :py:mod:`tracemalloc`? This slows down allocation-heavy stages.
+    trace_memory = False
+    
+    #: A file to which the :py:attr:`metrics` of each stage are appended as
+    #: JSON lines
+    metrics_file = None
+    
+    #: Profile the stages with :py:mod:`cProfile`? The statistics of all
+    #: the stages accumulate in :py:attr:`profiler`.
+    profile = False
+    
     def __init__(self, ID, season = None, mag = None, 
-                 cadence = KEPLER_LONG_CADENCE, quiet = False):
+                 cadence = KEPLER_LONG_CADENCE, quiet = False, 
+                 stages = (), checkpoint = True):
         '''
         
         '''
         
+        # Memoized light curve products
+        self._cache = {}
+        self._cache_hits = 0
+        self._cache_misses = 0
+        
+        # Pipeline state
+        self._raw = None
+        self._aperture = None
+        self._design = None
+        self._model = None
+        self.weights = None
+        self.cv = None
+        self.kernels = None
+        self.outliers = None
+        self.clip_history = []
+        self._completed = set()
+        self.checkpoint = checkpoint
+        
+        #: The keyword arguments of :py:func:`everest3.pld.detrend` for the
+        #: `model` stage (see :py:meth:`run`)
+        self.detrend_kwargs = {}
+        
+        # Instrumentation
+        self.metrics = {}
+        self.profiler = None
+        
         # User params
         self.ID = ID
         self.season = season
@@ -232,17 +850,14 @@ class Target(object):
         self.cadence = cadence
         
         # Initialize logging
-        InitializeLogging(self.logfile, quiet = quiet)
+        InitializeLogging(self.logfile, quiet = quiet, ID = self.ID, 
+                          season = self.season)
         log.info('Initializing everest3...')
         
-        # Download the raw data
-        self.get_raw_data()
-        
-        # Get the aperture
-        self.get_aperture()
-        
-        # Initialize the linear model
-        self.model = np.zeros_like(self.time)
+        # Run the requested stages
+        for stage in STAGES:
+            if stage in stages:
+                self._require(stage)
         
     def __repr__(self):
         '''
@@ -345,6 +960,16 @@ class Target(object):
     
         return os.path.join(self.path, '%s.pdf' % self.ID)
     
+    @property
+    def resfile(self):
+        '''
+        The full path to the saved de-trending results for this target 
+        (see :py:meth:`save`).
+        
+        '''
+    
+        return os.path.join(self.path, '%s.ev3' % self.ID)
+    
     @property
     def dvs_layout(self):
         '''
@@ -352,6 +977,7 @@ class Target(object):
         
         '''
         
+        from .dvs import default_layout
         return default_layout
     
     # ------------------
@@ -366,11 +992,15 @@ class Target(object):
         
         '''
         
+        self._require('raw')
         return self._raw
     
     @raw.setter
     def raw(self, value):
         self._raw = value
+        self._completed.add('raw')
+        self._discard_after('raw')
+        self._invalidate('raw')
 
     @property
     def aperture(self):
@@ -381,11 +1011,34 @@ class Target(object):
         
         '''
         
+        self._require('aperture')
         return self._aperture
     
     @aperture.setter
     def aperture(self, value):
         self._aperture = value
+        self._completed.add('aperture')
+        self._discard_after('aperture')
+        self._invalidate('aperture')
+    
+    @property
+    def design(self):
+        '''
+        The PLD design matrix, shape `(ncads, npix)`. This is the matrix of
+        normalized (fractional) pixel fluxes in the aperture, from which 
+        the regressors of all PLD orders are built.
+        
+        '''
+        
+        self._require('design')
+        return self._design
+    
+    @design.setter
+    def design(self, value):
+        self._design = value
+        self._completed.add('design')
+        self._discard_after('design')
+        self._invalidate('design')
     
     @property
     def time(self):
@@ -396,14 +1049,69 @@ class Target(object):
         
         return self.raw.time
     
-    @property
+    @_memoized('raw', 'aperture')
+    def sap_flux(self):
+        '''
+        The raw simple aperture photometry flux array.
+        
+        '''
+        
+        return self.raw.sap_flux(self.aperture)
+    
+    @_memoized('raw', 'aperture')
+    def sap_error(self):
+        '''
+        The raw simple aperture photometry flux errors array.
+        
+        '''
+        
+        return self.raw.sap_error(self.aperture)
+    
+    @_memoized('raw', 'aperture')
+    def norm_pixel_flux(self):
+        '''
+        The normalized (fractional) pixel flux matrix, shape `(ncads, npix)`,
+        i.e., the pixel fluxes in the aperture divided by the SAP flux.
+        
+        '''
+        
+        return self.raw.pixel_flux(self.aperture) / self.sap_flux[:, None]
+    
+    @_memoized('raw', 'aperture', 'model')
     def flux(self):
         '''
         The de-trended flux array.
         
         '''
         
-        return self.raw.sap_flux(self.aperture) - self.model
+        return self.sap_flux - self.model
+    
+    @property
+    def _scatter_win(self):
+        '''
+        The scatter window in cadences, corresponding to six hours.
+        
+        '''
+        
+        return max(2, int(round(13 * KEPLER_LONG_CADENCE / self.cadence)))
+    
+    @_memoized('raw', 'aperture')
+    def raw_scatter(self):
+        '''
+        The scatter in the raw SAP flux in parts per million.
+        
+        '''
+        
+        return Scatter(self.sap_flux, win = self._scatter_win)
+    
+    @_memoized('raw', 'aperture', 'model')
+    def scatter(self):
+        '''
+        The scatter in the de-trended flux in parts per million.
+        
+        '''
+        
+        return Scatter(self.flux, win = self._scatter_win)
 
     @property
     def model(self):
@@ -412,11 +1120,487 @@ class Target(object):
         
         '''
         
+        self._require('model')
         return self._model
     
     @model.setter
     def model(self, value):
-        self._model = value   
+        self._model = value
+        self._completed.add('model')
+        self._discard_after('model')
+        self._invalidate('model')
+    
+    # ------------------
+    # Caching
+    # ------------------
+    
+    def _discard_after(self, stage):
+        '''
+        Marks the stages after `stage` as not completed, since their 
+        outputs in memory were computed from its previous outputs. The 
+        cached PLD solvers are dropped too if the design matrix may have
+        changed.
+        
+        '''
+        
+        self._completed.difference_update(STAGES[STAGES.index(stage) + 1:])
+        if STAGES.index(stage) < STAGES.index('model'):
+            self.__dict__.pop('_pld_cache', None)
+            self.__dict__.pop('_pld_segments', None)
+    
+    def _invalidate(self, dep):
+        '''
+        Drops all memoized products that depend on the attribute `dep`.
+        
+        '''
+        
+        for name in list(self._cache.keys()):
+            if dep in getattr(type(self), name).fget._deps:
+                del self._cache[name]
+    
+    @property
+    def cache_info(self):
+        '''
+        A :py:obj:`dict` with the number of `hits` and `misses` of the 
+        memoized light curve products, and the number of products 
+        currently cached (`size`).
+        
+        '''
+        
+        return dict(hits = self._cache_hits, misses = self._cache_misses,
+                    size = len(self._cache))
+    
+    # ------------------
+    # Pipeline
+    # ------------------
+    
+    @property
+    def raw_fingerprint(self):
+        '''
+        A string that changes whenever the raw data of the target change 
+        (e.g., when the mission module rebuilds them from a new target 
+        pixel file), or :py:obj:`None` if unknown. It must be cheap to 
+        compute without loading the raw data. The stage checkpoints are 
+        keyed on it. The base class returns :py:obj:`None`; mission 
+        modules whose raw data can change should override it.
+        
+        '''
+        
+        return None
+    
+    @property
+    def checkpoint_path(self):
+        '''
+        The directory where the pipeline stage checkpoints are stored.
+        
+        '''
+        
+        return os.path.join(self.path, 'stages')
+    
+    @property
+    def completed(self):
+        '''
+        The pipeline stages whose outputs are currently in memory, in order.
+        
+        '''
+        
+        return tuple([stage for stage in STAGES if stage in self._completed])
+    
+    def _load_manifest(self):
+        '''
+        Returns the checkpoint manifest, or an empty :py:obj:`dict` if 
+        there is none.
+        
+        '''
+        
+        try:
+            with open(os.path.join(self.checkpoint_path, 'stages.json'), 
+                      'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+    
+    def _read_manifest(self):
+        '''
+        Returns the list of valid checkpointed stages: none if the 
+        checkpoints were written by another version of :py:obj:`everest3`
+        or for different raw data, and only those before the `model` stage
+        if the model was computed with different :py:attr:`detrend_kwargs`.
+        
+        '''
+        
+        manifest = self._load_manifest()
+        if (manifest.get('version') != __version__) or \
+           (manifest.get('raw') != self.raw_fingerprint):
+            return []
+        completed = manifest['completed']
+        if manifest.get('model') != _kwargs_key(self.detrend_kwargs):
+            completed = [s for s in completed 
+                         if STAGES.index(s) < STAGES.index('model')]
+        return completed
+    
+    def _write_manifest(self, completed):
+        '''
+        Atomically writes the list of checkpointed stages and their keys.
+        
+        '''
+        
+        if not os.path.exists(self.checkpoint_path):
+            os.makedirs(self.checkpoint_path)
+        file = os.path.join(self.checkpoint_path, 'stages.json')
+        with open(file + '.tmp', 'w') as f:
+            json.dump(dict(version = __version__, raw = self.raw_fingerprint,
+                           model = _kwargs_key(self.detrend_kwargs),
+                           completed = completed), f)
+        os.rename(file + '.tmp', file)
+    
+    def _load_checkpoint(self, stage):
+        '''
+        Loads the outputs of `stage` from its checkpoint. Returns 
+        :py:obj:`True` on success.
+        
+        '''
+        
+        if (not self.checkpoint) or (stage not in ('aperture', 'model', 
+                                                   'dvs')):
+            return False
+        if stage not in self._read_manifest():
+            return False
+        if stage == 'dvs':
+            if not os.path.exists(self.dvsfile):
+                return False
+            self._completed.add('dvs')
+        else:
+            file = os.path.join(self.checkpoint_path, '%s.npy' % stage)
+            try:
+                value = np.load(file)
+                if stage == 'model':
+                    self._load_fit()
+            except (IOError, OSError, ValueError, KeyError):
+                return False
+            
+            # Not through the setter: the later stages are still valid
+            setattr(self, '_' + stage, value)
+            self._completed.add(stage)
+            self._invalidate(stage)
+        log.info('Loaded the `%s` stage from its checkpoint.' % stage)
+        return True
+    
+    def _save_checkpoint(self, stage):
+        '''
+        Checkpoints the outputs of `stage`. Since these were (re)computed, 
+        the checkpoints of all the later stages are now stale and are 
+        discarded. The `raw` and `design` stages are not checkpointed, but
+        if the :py:attr:`raw_fingerprint` changed when the `raw` stage was
+        recomputed, all the checkpoints are discarded.
+        
+        '''
+        
+        if not self.checkpoint:
+            return
+        if stage == 'raw':
+            manifest = self._load_manifest()
+            if manifest and (manifest.get('raw') != self.raw_fingerprint):
+                log.info('The raw data changed. Discarding the checkpoints.')
+                self.clear_checkpoints()
+            return
+        elif stage == 'design':
+            return
+        index = STAGES.index(stage)
+        completed = [s for s in self._read_manifest() 
+                     if STAGES.index(s) < index]
+        for s in STAGES[index:]:
+            for ext in ('npy', 'npz'):
+                file = os.path.join(self.checkpoint_path, '%s.%s' % (s, ext))
+                if os.path.exists(file):
+                    os.remove(file)
+        if stage in ('aperture', 'model'):
+            if not os.path.exists(self.checkpoint_path):
+                os.makedirs(self.checkpoint_path)
+            if stage == 'model':
+                self._save_fit()
+            file = os.path.join(self.checkpoint_path, '%s.npy' % stage)
+            with open(file + '.tmp', 'wb') as f:
+                np.save(f, getattr(self, '_' + stage))
+            os.rename(file + '.tmp', file)
+        self._write_manifest(completed + [stage])
+    
+    def _save_fit(self):
+        '''
+        Checkpoints the results of the fit that accompany the model: the
+        regression :py:attr:`weights`, the :py:attr:`outliers` and the
+        :py:attr:`clip_history`.
+        
+        '''
+        
+        arrays = dict(clip_history = np.array(json.dumps(
+                      self.clip_history, default = _json_default)))
+        for name in ('weights', 'outliers'):
+            if getattr(self, name) is not None:
+                arrays[name] = getattr(self, name)
+        file = os.path.join(self.checkpoint_path, 'model.npz')
+        with open(file + '.tmp', 'wb') as f:
+            np.savez(f, **arrays)
+        os.rename(file + '.tmp', file)
+    
+    def _load_fit(self):
+        '''
+        Loads the results of the fit checkpointed by :py:meth:`_save_fit`.
+        
+        '''
+        
+        with np.load(os.path.join(self.checkpoint_path, 'model.npz')) as f:
+            clip_history = json.loads(str(f['clip_history']))
+            weights = f['weights'] if 'weights' in f else None
+            outliers = f['outliers'] if 'outliers' in f else None
+        self.clip_history = clip_history
+        self.weights = weights
+        self.outliers = outliers
+    
+    def _run_stage(self, stage):
+        '''
+        Computes the outputs of `stage` (after making sure all the previous 
+        stages are available) and checkpoints them.
+        
+        '''
+        
+        for s in STAGES[:STAGES.index(stage)]:
+            self._require(s)
+        with LogContext(stage = stage), self._measure(stage):
+            getattr(self, {'raw': 'get_raw_data', 
+                           'aperture': 'get_aperture', 
+                           'design': 'get_design', 
+                           'model': '_detrend', 
+                           'dvs': '_plot_dvs'}[stage])()
+            self._completed.add(stage)
+            self._discard_after(stage)
+            self._save_checkpoint(stage)
+    
+    def _stage_arrays(self, stage):
+        '''
+        Returns the sizes in bytes of the output arrays of `stage`. Arrays
+        backed by files that haven't been accessed are not loaded.
+        
+        '''
+        
+        if stage == 'raw':
+            arrays = dict([(name, getattr(self._raw, '_' + name, None)) 
+                           for name in ('time', 'flux', 'error', 'quality')])
+        elif stage in ('aperture', 'design', 'model'):
+            arrays = {stage: getattr(self, '_' + stage)}
+        else:
+            arrays = {}
+        sizes = {}
+        for name, val in arrays.items():
+            if isinstance(val, _SharedArray):
+                val = val.array
+            if isinstance(val, string_types):
+                sizes[name] = os.path.getsize(val)
+            elif hasattr(val, 'nbytes'):
+                sizes[name] = int(val.nbytes)
+        return sizes
+    
+    @contextlib.contextmanager
+    def _measure(self, stage):
+        '''
+        Records the :py:attr:`metrics` of a run of `stage`, and profiles it
+        if :py:attr:`profile` is set.
+        
+        '''
+        
+        record = self.record_metrics
+        trace = record and self.trace_memory
+        if trace:
+            import tracemalloc
+            started = not tracemalloc.is_tracing()
+            if started:
+                tracemalloc.start()
+            elif hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+        profiling = False
+        if self.profile:
+            import cProfile
+            if self.profiler is None:
+                self.profiler = cProfile.Profile()
+            try:
+                self.profiler.enable()
+                profiling = True
+            except ValueError as e:
+                log.warning('Unable to profile the `%s` stage: %s' % 
+                            (stage, e))
+        failed = True
+        rss = _rss() if record else None
+        wall = time.time()
+        cpu = time.process_time()
+        try:
+            yield
+            failed = False
+        finally:
+            wall = time.time() - wall
+            cpu = time.process_time() - cpu
+            if profiling:
+                self.profiler.disable()
+            if record:
+                metrics = dict(wall = wall, cpu = cpu, rss_start = rss, 
+                               rss_end = _rss(), rss_delta = None,
+                               max_rss = _max_rss(), traced_peak = None, 
+                               failed = failed, 
+                               arrays = self._stage_arrays(stage))
+                if (rss is not None) and (metrics['rss_end'] is not None):
+                    metrics['rss_delta'] = metrics['rss_end'] - rss
+                if trace:
+                    metrics['traced_peak'] = \
+                        tracemalloc.get_traced_memory()[1] / 2 ** 20
+                    if started:
+                        tracemalloc.stop()
+                self.metrics[stage] = metrics
+                mb = lambda x: '?' if x is None else '%.1f' % x
+                log.info('Stage `%s`: %.3f s wall, %.3f s CPU, RSS %s -> %s '
+                         'MB (process peak %s MB).' % (stage, wall, cpu, 
+                         mb(rss), mb(metrics['rss_end']), 
+                         mb(metrics['max_rss'])))
+                if self.metrics_file is not None:
+                    self._write_metrics(stage)
+    
+    def _write_metrics(self, stage):
+        '''
+        Appends the :py:attr:`metrics` of `stage` to the 
+        :py:attr:`metrics_file` as a line of JSON. Each record is written 
+        in a single call, so many processes can share the file.
+        
+        '''
+        
+        record = dict(self.metrics[stage], ID = self.ID, 
+                      season = self.season, stage = stage, 
+                      time = time.time(), pid = os.getpid())
+        line = json.dumps(record, sort_keys = True, 
+                          default = _json_default) + '\n'
+        try:
+            path = os.path.dirname(os.path.abspath(self.metrics_file))
+            if not os.path.exists(path):
+                os.makedirs(path)
+            with open(self.metrics_file, 'a') as f:
+                f.write(line)
+        except (IOError, OSError) as e:
+            log.warning('Unable to write the metrics of the `%s` stage: %s' 
+                        % (stage, e))
+    
+    def _require(self, stage):
+        '''
+        Makes sure the outputs of `stage` are available, loading them from
+        the checkpoint or running the stage if necessary.
+        
+        '''
+        
+        if stage in self._completed:
+            return
+        if not self._load_checkpoint(stage):
+            self._run_stage(stage)
+    
+    def run(self, until = 'dvs', force = False, **kwargs):
+        '''
+        Runs the pipeline up to and including the stage `until`, resuming 
+        from the last completed stage. Stages whose outputs are in memory 
+        or checkpointed are not re-run, unless `force` is :py:obj:`True`.
+        
+        :param str until: The last stage to run. Default `dvs`.
+        :param bool force: Re-run all the stages (except `raw`)? Default \
+               :py:obj:`False`.
+        
+        Additional keyword arguments replace the :py:attr:`detrend_kwargs`,
+        the arguments of :py:func:`everest3.pld.detrend` for the `model` 
+        stage. A model (in memory or checkpointed) computed with different
+        arguments is not reused, except for differences in the arguments 
+        that don't change the model (`max_memory` and `threads`).
+        
+        '''
+        
+        if kwargs:
+            if _kwargs_key(kwargs) != _kwargs_key(self.detrend_kwargs):
+                self._completed.difference_update(('model', 'dvs'))
+            self.detrend_kwargs = dict(kwargs)
+        if force:
+            for stage in STAGES[:STAGES.index(until) + 1]:
+                if stage == 'raw':
+                    self._require(stage)
+                else:
+                    self._run_stage(stage)
+        else:
+            self._require(until)
+    
+    def clear_checkpoints(self):
+        '''
+        Deletes all the stage checkpoints for this target.
+        
+        '''
+        
+        if os.path.exists(self.checkpoint_path):
+            for file in os.listdir(self.checkpoint_path):
+                os.remove(os.path.join(self.checkpoint_path, file))
+    
+    # ------------------
+    # Saving and loading
+    # ------------------
+    
+    def save(self):
+        '''
+        Saves the de-trending results, i.e., the raw data, the aperture, the
+        model and the regression :py:attr:`weights` (if any), together with
+        the target metadata and scatter, to a single binary file 
+        (:py:attr:`resfile`) written with :py:func:`everest3.utils.SaveArrays`. 
+        The scalar metadata can be read without loading any of the arrays 
+        with :py:func:`everest3.utils.ReadHeader`.
+        
+        '''
+        
+        log.info('Saving the de-trending results...')
+        
+        # The raw data first, since they may set the magnitude
+        arrays = dict(time = self.raw.time, flux = self.raw.flux, 
+                      error = self.raw.error, quality = self.raw.quality, 
+                      aperture = self.aperture, model = self.model)
+        meta = dict(version = __version__, mission = self.mission.name, 
+                    ID = self.ID, season = self.season, 
+                    mag = np.nan if self.mag is None else float(self.mag), 
+                    cadence = self.cadence, scatter = float(self.scatter), 
+                    raw_scatter = float(self.raw_scatter), 
+                    clip_history = self.clip_history)
+        if self.weights is not None:
+            arrays['weights'] = self.weights
+        if self.outliers is not None:
+            arrays['outliers'] = self.outliers
+        SaveArrays(self.resfile, meta, **arrays)
+    
+    @classmethod
+    def load(cls, ID, season, **kwargs):
+        '''
+        Returns a fully usable :py:class:`Target` from the results saved by
+        :py:meth:`save`, without touching the raw data files or the network.
+        The arrays are memory-mapped, so they are only read from disk when 
+        (and if) they are accessed. Additional keyword arguments are passed
+        to the constructor.
+        
+        :param ID: The target ID.
+        :param int season: The season of the target. This is required \
+               (pass :py:obj:`None` for missions without seasons), since \
+               it locates the results file, and looking it up may require \
+               the network.
+        
+        '''
+        
+        star = cls(ID, season = season, **kwargs)
+        meta, arrays = LoadArrays(star.resfile)
+        star.season = meta['season']
+        star.mag = meta['mag']
+        star.cadence = meta['cadence']
+        star.raw = TimeSeries(arrays['time'], arrays['flux'], 
+                              arrays['error'], quality = arrays['quality'])
+        star.aperture = arrays['aperture']
+        star.model = arrays['model']
+        star.weights = arrays.get('weights', None)
+        star.outliers = arrays.get('outliers', None)
+        star.clip_history = meta.get('clip_history', [])
+        return star
     
     # ------------------
     # Main functions
@@ -442,24 +1626,71 @@ class Target(object):
         
         raise NotImplementedError('Must be implemented via subclasses.')
     
+    def get_design(self):
+        '''
+        Computes the PLD design matrix for this target, i.e., the 
+        fractional pixel fluxes in the aperture, and assigns it to the
+        :py:attr:`design` attribute of this class.
+        
+        '''
+        
+        self.design = self.norm_pixel_flux
+    
     def detrend(self, **kwargs):
         '''
-        De-trend the light curve via :py:func:`everest3.pld.detrend()`.
+        De-trend the light curve via :py:func:`everest3.pld.detrend()`. This
+        (re-)runs the `model` stage of the pipeline, with the keyword 
+        arguments `kwargs` (which replace the :py:attr:`detrend_kwargs`).
+        
+        '''
+        
+        self.detrend_kwargs = dict(kwargs)
+        self._run_stage('model')
+    
+    def _detrend(self):
+        '''
         
         '''
         
         log.info('Initializing de-trending...')
         from . import pld
-        pld.detrend(self, **kwargs)    
+        pld.detrend(self, **self.detrend_kwargs)    
     
     def plot_dvs(self):
         '''
         Plots the raw and de-trended data in the data validation summary.
+        This (re-)runs the `dvs` stage of the pipeline.
+        
+        '''
+        
+        self._run_stage('dvs')
+    
+    def _plot_dvs(self):
+        '''
         
         '''
         
         log.info('Plotting the data validation summary...')
-        dvs = DVS(layout = self.dvs_layout)
+        from .dvs import template
+        tstart = time.time()
+        dvs = template(layout = self.dvs_layout)
+        try:
+            self._draw_dvs(dvs)
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            dvs.fig.savefig(self.dvsfile)
+        finally:
+            
+            # Don't hold on to this target's data until the next page
+            dvs.clear()
+        log.info('Rendered the data validation summary in %.2f s.' % 
+                 (time.time() - tstart))
+    
+    def _draw_dvs(self, dvs):
+        '''
+        Draws the plots of the data validation summary on the page `dvs`.
+        
+        '''
         
         # Header
         dvs.header.annotate('%s %s' % (self.mission.ID_str, self.ID), 
@@ -479,7 +1710,9 @@ class Target(object):
                             ha = 'center', va = 'center')
         
         # De-trended data
-        dvs.detrended.plot(self.time, self.flux, 'k.', alpha = 0.3, ms = 2)
+        from .dvs import plot
+        plot(dvs.detrended, self.time, self.flux, 'k.', alpha = 0.3, ms = 2,
+             decimate = self.dvs_decimate, rasterized = self.dvs_rasterize)
         dvs.detrended.set_xlabel('Time [%s]' % self.mission.time_unit, 
                                  fontsize = 5)
         dvs.detrended.set_ylabel('Detrended Flux [%s]' 
@@ -487,12 +1720,9 @@ class Target(object):
                                  fontsize = 5)
                                  
         # Raw data
-        dvs.raw.plot(self.time, self.raw.sap_flux(self.aperture), 
-                     'k.', alpha = 0.3, ms = 2)
+        plot(dvs.raw, self.time, self.sap_flux, 'k.', alpha = 0.3, ms = 2,
+             decimate = self.dvs_decimate, rasterized = self.dvs_rasterize)
         dvs.raw.set_xlabel('Time [%s]' % self.mission.time_unit, 
                            fontsize = 5)
         dvs.raw.set_ylabel('Raw Flux [%s]' % self.mission.flux_unit, 
-                           fontsize = 5)
-                                                     
-        # Save
-        dvs.fig.savefig(self.dvsfile)
\ No newline at end of file
+                           fontsize = 5)
\ No newline at end of file
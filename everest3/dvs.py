@@ -6,14 +6,29 @@ dvs.py
 
 The :py:mod:`everest3` data validation summary (DVS)-related functions.
 
+The DVS figures are created directly, without :py:mod:`matplotlib.pyplot`,
+so they never touch an interactive backend and are freed as soon as they 
+are no longer referenced. Each process (and thread) keeps a single page 
+:py:func:`template` per layout, whose cells are cleared and reused for 
+every target, and :py:func:`render` spreads the pages of many targets over
+a pool of processes.
+
 '''
 
 from __future__ import division, print_function, absolute_import
-import matplotlib.pyplot as pl
+from matplotlib.figure import Figure
+from matplotlib.gridspec import GridSpec
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from multiprocessing import Pool
+from .utils import BatchLogging, BatchLoggingActive
 import numpy as np
+import threading
+import time
 import logging
 log = logging.getLogger(__name__)
 
+__all__ = ['DVS', 'decimate', 'plot', 'template', 'render']
+
 #: The default DVS page layout
 default_layout = (  "  0  0  0  0  0  0  0  0  0  0  0  0"
                     "  1  1  1  1  1  1  1  1  6  6  7  7"
@@ -38,6 +53,36 @@ default_layout = (  "  0  0  0  0  0  0  0  0  0  0  0  0"
                     "  5  5  5  5  5  5  5  5 15 15 15 15"
                     " 16 16 16 16 16 16 16 16 16 16 16 16"  )
 
+#: The parsed page layouts
+_layouts = {}
+
+#: The per-thread page templates
+_templates = threading.local()
+
+def _parse_layout(layout):
+    '''
+    Returns the `(n, x, y, dx, dy)` extents of the cells of a page layout
+    string. The result is cached.
+    
+    '''
+    
+    layout = str(layout)
+    if layout not in _layouts:
+        grid = np.array(layout.split(), dtype = int).reshape(22, 12)
+        cells = []
+        for n in range(99):
+            
+            # Get the indices of this cell
+            y, x = np.where(grid == n)
+            if len(y) == 0:
+                break
+            
+            # The upper left position and the extent of the cell
+            cells.append((n, np.min(x), np.min(y), np.max(x) - np.min(x) + 1,
+                          np.max(y) - np.min(y) + 1))
+        _layouts[layout] = cells
+    return _layouts[layout]
+
 class _Cell(object):
     '''
     A simple cell object containing an axis instance. Called from
@@ -45,14 +90,41 @@ class _Cell(object):
     
     '''
     
-    def __init__(self, n, x = 0, y = 0, dx = 10, dy = 10, labels = False):
+    def __init__(self, n, fig, grid, x = 0, y = 0, dx = 10, dy = 10, 
+                 labels = False):
         '''
         
         '''
         
         self.n = n
-        self.ax = pl.subplot2grid((22, 12), (y, x), colspan = dx, rowspan = dy)
-        if labels:
+        self.labels = labels
+        self.ax = fig.add_subplot(grid[y:y + dy, x:x + dx])
+        self.style()
+        self._pristine = self._state()
+    
+    def _state(self):
+        '''
+        A cheap summary of the state of the axis, used to tell whether it
+        was drawn on.
+        
+        '''
+        
+        ax = self.ax
+        return (ax.get_xlim(), ax.get_ylim(), ax.get_xlabel(), 
+                ax.get_ylabel(), ax.get_title(), ax.get_xscale(), 
+                ax.get_yscale(), len(ax.get_children()), ax.axison,
+                id(ax.xaxis.get_major_locator()), 
+                id(ax.yaxis.get_major_locator()),
+                id(ax.xaxis.get_major_formatter()),
+                id(ax.yaxis.get_major_formatter()))
+    
+    def style(self):
+        '''
+        Styles the (empty) axis.
+        
+        '''
+        
+        if self.labels:
             self.ax.annotate('Cell #%02d' % self.n, xy = (0.5, 0.5), ha = 'center', 
                              va = 'center', fontsize = 14, alpha = 0.5,
                              fontweight = 'bold')
@@ -65,6 +137,17 @@ class _Cell(object):
             for tick in self.ax.get_xticklabels() + self.ax.get_yticklabels():
                 tick.set_fontsize(5)
             self.ax.tick_params(direction = 'in')
+    
+    def clear(self):
+        '''
+        Clears the axis and restores its style, unless it is untouched.
+        
+        '''
+        
+        if self._state() != self._pristine:
+            self.ax.cla()
+            self.style()
+            self._pristine = self._state()
             
 class DVS(object):
     '''
@@ -93,13 +176,17 @@ class DVS(object):
            curve. Default `1`.
     :param int raw: The cell index corresponding the raw light curve. \
            Default `2`.
+    :param fig: The figure to draw on. Default :py:obj:`None`, in which \
+           case a new letter-sized figure is created outside of \
+           :py:mod:`matplotlib.pyplot`.
+    :type fig: :py:class:`matplotlib.figure.Figure`
            
     .. plot::
          :align: center
      
          from everest3.dvs import DVS
          import matplotlib.pyplot as pl
-         DVS(labels = True)
+         DVS(labels = True, fig = pl.figure(figsize = (8.5, 11)))
          pl.show()
     
     '''
@@ -107,13 +194,16 @@ class DVS(object):
     def __init__(self, layout = None, margin_left = 0.5, margin_right = 0.5,
                  margin_top = 0.25, margin_bottom = 0.1, labels = False,
                  hspace = 1.25, wspace = 1.25, header = 0, footer = -1,
-                 detrended = 1, raw = 2):
+                 detrended = 1, raw = 2, fig = None):
         '''
                 
         '''
 
         # Letter-sized DVS
-        self._fig = pl.figure(figsize = (8.5, 11))
+        if fig is None:
+            fig = Figure(figsize = (8.5, 11))
+            FigureCanvasAgg(fig)
+        self._fig = fig
         
         # Set the margins
         self._fig.subplots_adjust(left = margin_left / 8.5, 
@@ -127,29 +217,12 @@ class DVS(object):
         # Get the layout
         if layout is None:
             layout = default_layout
-            
-        # Convert to a 2D array
-        layout = np.array(np.matrix(str(layout))).reshape(-22,12)
                 
         # Create the cells
-        self._cell = []
-        for n in range(99):
-            
-            # Get the indices of this cell
-            y, x = np.where(layout == n)
-            if len(y) == 0:
-                break
-            
-            # The extent of the cell
-            dx = np.max(x) - np.min(x) + 1
-            dy = np.max(y) - np.min(y) + 1
-            
-            # The upper left position of the cell
-            x = np.min(x)
-            y = np.min(y)
-            
-            # Create the cell
-            self._cell.append(_Cell(n, x, y, dx, dy, labels).ax)
+        grid = GridSpec(22, 12, figure = self._fig)
+        self._cells = [_Cell(n, self._fig, grid, x, y, dx, dy, labels) 
+                       for n, x, y, dx, dy in _parse_layout(layout)]
+        self._cell = [cell.ax for cell in self._cells]
         
         # Special cell indices
         self._header = header
@@ -158,6 +231,26 @@ class DVS(object):
         self._detrended = detrended
         self.header.axis('off')
         self.footer.axis('off')
+        for cell in self._cells:
+            cell._pristine = cell._state()
+    
+    def clear(self):
+        '''
+        Clears all cells, and removes any other axes and text added to the
+        figure, so that the page can be reused for another target.
+        
+        '''
+        
+        for ax in list(self._fig.axes):
+            if ax not in self._cell:
+                self._fig.delaxes(ax)
+        for text in list(self._fig.texts):
+            text.remove()
+        for cell in self._cells:
+            cell.clear()
+            if cell.ax in (self.header, self.footer):
+                cell.ax.axis('off')
+                cell._pristine = cell._state()
         
     @property
     def fig(self):
@@ -212,4 +305,178 @@ class DVS(object):
         
         '''
         
-        return self._cell[self._detrended]
\ No newline at end of file
+        return self._cell[self._detrended]
+
+def decimate(x, y, width, height = None, xlim = None, ylim = None):
+    '''
+    Decimates a light curve to the resolution at which it is plotted. The
+    plot area is divided into `width` columns and, if `height` is given,
+    `height` rows of pixels, and one point is kept in each pixel that 
+    contains any points, so that a scatter plot of the decimated points
+    covers exactly the same pixels as one of all the points. If `height` is
+    :py:obj:`None`, the points with the minimum and maximum `y` in each 
+    column are kept instead, which preserves the envelope of a line plot.
+    Either way, outliers and transits remain visible. Non-finite points are
+    dropped.
+    
+    :param ndarray x: The `x` coordinates (e.g., the time).
+    :param ndarray y: The `y` coordinates (e.g., the flux).
+    :param int width: The number of pixel columns.
+    :param int height: The number of pixel rows. Default :py:obj:`None`.
+    :param tuple xlim: The `x` limits of the plot. Default :py:obj:`None` \
+           (the range of `x`).
+    :param tuple ylim: The `y` limits of the plot. Default :py:obj:`None` \
+           (the range of `y`).
+    
+    :returns: The sorted indices of the points to plot.
+    
+    '''
+    
+    x = np.asarray(x, dtype = 'float64')
+    y = np.asarray(y, dtype = 'float64')
+    inds = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+    width = max(1, int(width))
+    if len(inds) <= 2 * width:
+        return inds
+    x, y = x[inds], y[inds]
+    
+    def pixel(z, lim, n):
+        lo, hi = lim if lim is not None else (np.min(z), np.max(z))
+        if not hi > lo:
+            return np.zeros(len(z), dtype = 'int64')
+        return np.clip(((z - lo) * (n / (hi - lo))).astype('int64'), 
+                       0, n - 1)
+    
+    col = pixel(x, xlim, width)
+    if height is None:
+        
+        # The extrema of each column
+        order = np.lexsort((y, col))
+        col = col[order]
+        edge = np.flatnonzero(np.diff(col)) + 1
+        keep = order[np.concatenate([[0], edge, edge - 1, [len(col) - 1]])]
+    else:
+        
+        # One point per occupied pixel
+        row = pixel(y, ylim, max(1, int(height)))
+        _, keep = np.unique(col * int(height) + row, return_index = True)
+    
+    return inds[np.unique(keep)]
+
+def plot(ax, x, y, *args, **kwargs):
+    '''
+    Plots a light curve in a DVS cell, decimated (see :py:func:`decimate`)
+    to the resolution of the cell. Marker-only formats are decimated to 
+    one point per pixel, and other formats to the extrema of each pixel 
+    column. Additional arguments are passed to :py:meth:`ax.plot`, except
+    for the following keywords:
+    
+    :param bool decimate: Decimate the light curve? Default :py:obj:`True`.
+    :param float dpi: The resolution of the decimation grid in dots per \
+           inch. Default `150`.
+    
+    Pass `rasterized = True` to rasterize the points, which keeps vector
+    output small and fast to view even when there are many of them.
+    
+    '''
+    
+    dpi = kwargs.pop('dpi', 150.)
+    if kwargs.pop('decimate', True):
+        bbox = ax.get_position()
+        w, h = ax.figure.get_size_inches()
+        width = int(np.ceil(bbox.width * w * dpi))
+        height = int(np.ceil(bbox.height * h * dpi))
+        markers = len(args) and isinstance(args[0], str) and \
+                  not any([c in args[0] for c in '-:']) and \
+                  kwargs.get('ls', kwargs.get('linestyle', 'None')) in \
+                  ('None', 'none', '', ' ')
+        inds = decimate(x, y, width, height if markers else None)
+        x, y = np.asarray(x)[inds], np.asarray(y)[inds]
+    return ax.plot(x, y, *args, **kwargs)
+
+def template(layout = None):
+    '''
+    Returns a cleared :py:class:`DVS` page with the given layout. The page
+    is created once per process (and thread) and reused by later calls, 
+    which saves creating the figure and all its cells for every target.
+    Note that the page returned by the previous call is cleared, so it
+    must be saved before calling this function again.
+    
+    :param str layout: The page layout. Default :py:obj:`None` \
+           (:py:obj:`default_layout`).
+    
+    '''
+    
+    if layout is None:
+        layout = default_layout
+    pages = getattr(_templates, 'pages', None)
+    if pages is None:
+        pages = _templates.pages = {}
+    layout = str(layout)
+    if layout not in pages:
+        pages[layout] = DVS(layout = layout)
+    else:
+        pages[layout].clear()
+    return pages[layout]
+
+def _render(args):
+    '''
+    Renders the DVS of a single target in a worker process from its saved
+    results. Returns the target ID, the render time in seconds and the 
+    error, if any.
+    
+    '''
+    
+    mission, ID, season = args
+    try:
+        from .batch import _mission
+        target = _mission(mission).Target.load(ID, season, quiet = True)
+        tstart = time.time()
+        target.plot_dvs()
+        return ID, time.time() - tstart, None
+    except Exception as e:
+        log.error('Unable to render the DVS of target %s: %s' % (ID, e))
+        return ID, None, str(e)
+
+def render(ids, mission = 'k2', season = None, workers = None):
+    '''
+    Renders the data validation summaries of many targets in a pool of 
+    processes. The targets are loaded from their saved results (see 
+    :py:meth:`everest3.containers.Target.load`), so they must have been 
+    de-trended and saved already: the pages of targets without results 
+    fail, rather than running the pipeline (or downloading anything). Each
+    worker reuses its own page :py:func:`template` for all of its 
+    targets. If batch logging is active (see 
+    :py:func:`everest3.utils.BatchLogging`), the workers log through its 
+    queue.
+    
+    :param ids: The IDs of the targets.
+    :param str mission: The mission module. Default `k2`.
+    :param int season: The season (campaign) of the targets. Default \
+           :py:obj:`None`.
+    :param int workers: The number of worker processes. Default \
+           :py:obj:`None` (one per CPU).
+    
+    :returns: A :py:obj:`dict` of the render time of each page in seconds \
+              (:py:obj:`None` for the pages that failed).
+    
+    '''
+    
+    tstart = time.time()
+    times = {}
+    if BatchLoggingActive():
+        pool = Pool(workers, BatchLogging, (BatchLogging(),))
+    else:
+        pool = Pool(workers)
+    try:
+        for ID, t, error in pool.imap_unordered(_render, [(mission, ID, 
+                                                season) for ID in ids]):
+            times[ID] = t
+    finally:
+        pool.close()
+        pool.join()
+    done = [t for t in times.values() if t is not None]
+    if len(done):
+        log.info('Rendered %d DVS page(s) in %.1f s (%.3f s per page).' % 
+                 (len(done), time.time() - tstart, np.mean(done)))
+    return times
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+gp.py
+-----
+
+Gaussian process noise models for the :py:mod:`everest3.pld` de-trending.
+
+The kernels are sums of `celerite` terms (Foreman-Mackey et al. 2017),
+
+.. math::
+    
+    k(\\tau) = \\sum_j e^{-c_j \\tau} \\left[a_j \\cos(d_j \\tau) +
+               b_j \\sin(d_j \\tau)\\right],
+
+whose covariance matrices (plus a diagonal) are semiseparable.
+:py:class:`Factor` computes their Cholesky factorization, log-determinant,
+solves and whitening transforms in time linear in the number of cadences
+`N`, instead of the :math:`O(N^3)` of a dense factorization.
+
+'''
+
+from __future__ import division, print_function, absolute_import, \
+                       unicode_literals
+from scipy.linalg import cholesky, solve_triangular
+import numpy as np
+import logging
+log = logging.getLogger(__name__)
+
+__all__ = ['ExpTerm', 'Matern32Term', 'Kernel', 'Factor']
+
+class ExpTerm(object):
+    '''
+    An exponential (Ornstein-Uhlenbeck) kernel term,
+    :math:`k(\\tau) = \\sigma^2 e^{-\\tau / \\rho}`.
+    
+    :param float amp: The amplitude :math:`\\sigma`, in flux units.
+    :param float tau: The timescale :math:`\\rho`, in days.
+    
+    '''
+    
+    #: The names of the parameters
+    names = ('amp', 'tau')
+    
+    def __init__(self, amp, tau):
+        '''
+        
+        '''
+        
+        self.log_params = np.log([amp, tau])
+    
+    def coefficients(self):
+        '''
+        Returns the `(a, b, c, d)` coefficients of the term.
+        
+        '''
+        
+        amp, tau = np.exp(self.log_params)
+        return amp ** 2, 0., 1. / tau, 0.
+
+class Matern32Term(object):
+    '''
+    A Matern-3/2 kernel term,
+    :math:`k(\\tau) = \\sigma^2 (1 + \\sqrt{3}\\tau / \\rho)
+    e^{-\\sqrt{3}\\tau / \\rho}`, in the `celerite` approximation (which
+    is exact in the limit :math:`\\epsilon \\rightarrow 0`).
+    
+    :param float amp: The amplitude :math:`\\sigma`, in flux units.
+    :param float tau: The timescale :math:`\\rho`, in days.
+    :param float eps: The approximation parameter. Default `0.01`.
+    
+    '''
+    
+    #: The names of the parameters
+    names = ('amp', 'tau')
+    
+    def __init__(self, amp, tau, eps = 0.01):
+        '''
+        
+        '''
+        
+        self.log_params = np.log([amp, tau])
+        self.eps = eps
+    
+    def coefficients(self):
+        '''
+        Returns the `(a, b, c, d)` coefficients of the term.
+        
+        '''
+        
+        amp, tau = np.exp(self.log_params)
+        w = np.sqrt(3.) / tau
+        return amp ** 2, amp ** 2 * w / self.eps, w, self.eps
+
+class Kernel(object):
+    '''
+    A sum of `celerite` kernel terms.
+    
+    :param terms: One or more :py:class:`ExpTerm` or \
+           :py:class:`Matern32Term` instances.
+    
+    '''
+    
+    def __init__(self, *terms):
+        '''
+        
+        '''
+        
+        self.terms = list(terms)
+    
+    def __repr__(self):
+        '''
+        
+        '''
+        
+        return "<Kernel: %s>" % ", ".join(["%s(%s)" % (term.__class__.__name__,
+               ", ".join(["%s = %.3e" % (n, p) for n, p in
+                          zip(term.names, np.exp(term.log_params))]))
+               for term in self.terms])
+    
+    @property
+    def log_params(self):
+        '''
+        The natural log of the parameters of all terms, concatenated.
+        
+        '''
+        
+        return np.concatenate([term.log_params for term in self.terms])
+    
+    @log_params.setter
+    def log_params(self, value):
+        '''
+        
+        '''
+        
+        value = np.array(value, dtype = 'float64')
+        i = 0
+        for term in self.terms:
+            n = len(term.log_params)
+            term.log_params = value[i:i + n]
+            i += n
+    
+    def coefficients(self):
+        '''
+        Returns the coefficients of the real terms (those with `b = d = 0`)
+        and of the complex terms, as arrays `ar, cr, ac, bc, cc, dc`.
+        
+        '''
+        
+        coeffs = [term.coefficients() for term in self.terms]
+        real = [c for c in coeffs if (c[1] == 0) and (c[3] == 0)]
+        cplx = [c for c in coeffs if not ((c[1] == 0) and (c[3] == 0))]
+        ar, _, cr, _ = np.array(real).reshape(-1, 4).T
+        ac, bc, cc, dc = np.array(cplx).reshape(-1, 4).T
+        return ar, cr, ac, bc, cc, dc
+    
+    def __call__(self, tau):
+        '''
+        Evaluates the kernel at the lags `tau`.
+        
+        '''
+        
+        tau = np.abs(tau)
+        k = np.zeros_like(tau, dtype = 'float64')
+        for a, b, c, d in [term.coefficients() for term in self.terms]:
+            k += np.exp(-c * tau) * (a * np.cos(d * tau) + b * np.sin(d * tau))
+        return k
+
+class Factor(object):
+    '''
+    The semiseparable :math:`LDL^\\top` factorization of the covariance
+    matrix :math:`C = \\mathrm{diag}(\\sigma^2) + K`, where `K` is the
+    covariance of a :py:class:`Kernel` evaluated at the (sorted) times `t`.
+    With :math:`K_{nm} = U_n \\left(\\prod_{k=m+1}^{n} P_k\\right) V_m^\\top`
+    for :math:`n > m`, the unit lower triangular factor is
+    :math:`L_{nm} = U_n \\left(\\prod_{k=m+1}^{n} P_k\\right) W_m^\\top`.
+    
+    Rather than stepping through the recursion for `W` and `D` one cadence
+    at a time in Python, the cadences are processed in blocks: the past 
+    enters each block only through a `(J, J)` state, so each block is a 
+    small dense Cholesky factorization and a few triangular solves, all in
+    LAPACK/BLAS. The cost is :math:`O(N B (B + J))` for blocks of `B` 
+    cadences.
+    
+    :param kernel: The GP kernel.
+    :type kernel: :py:class:`Kernel`
+    :param ndarray t: The `(N,)` array of increasing times.
+    :param ndarray diag: The `(N,)` white noise variance.
+    :param int block_size: The number of cadences `B` in each block. \
+           Default `64`.
+    
+    '''
+    
+    def __init__(self, kernel, t, diag, block_size = 64):
+        '''
+        
+        '''
+        
+        t = np.asarray(t, dtype = 'float64')
+        diag = np.asarray(diag, dtype = 'float64')
+        self.N = N = len(t)
+        self.block_size = block_size
+        ar, cr, ac, bc, cc, dc = kernel.coefficients()
+        c = np.concatenate([cr, cc, cc])
+        
+        # The semiseparable representation
+        ct, st = np.cos(np.outer(t, dc)), np.sin(np.outer(t, dc))
+        U = np.hstack([np.tile(ar, (N, 1)), ac * ct + bc * st,
+                       ac * st - bc * ct])
+        V = np.hstack([np.ones((N, len(ar))), ct, st])
+        
+        # The block recursion. For the block of cadences [s, e), `Ut` and
+        # `Wh` are `U` and `D^1/2 W` propagated to its first and last 
+        # cadences, `g` propagates from the first to the last, and `p` 
+        # from the last to the first cadence of the next block
+        self.J = J = U.shape[1]
+        S = np.zeros((J, J))
+        self.blocks = []
+        D = []
+        for s in range(0, N, self.block_size):
+            e = min(s + self.block_size, N)
+            tb = t[s:e]
+            Ut = U[s:e] * np.exp(-np.outer(tb - tb[0], c))
+            Vt = V[s:e] * np.exp(-np.outer(tb[-1] - tb, c))
+            g = np.exp(-c * (tb[-1] - tb[0]))
+            p = np.exp(-c * (t[e] - tb[-1])) if e < N else np.zeros(J)
+            US = np.dot(Ut, S)
+            Cb = kernel(tb[:, None] - tb[None, :]) - np.dot(US, Ut.T)
+            Cb[np.diag_indices_from(Cb)] += diag[s:e]
+            try:
+                R = cholesky(Cb, lower = True, check_finite = False)
+            except np.linalg.LinAlgError:
+                raise np.linalg.LinAlgError('The covariance matrix is not '
+                                            'positive definite.')
+            Wh = solve_triangular(R, Vt - US * g, lower = True,
+                                  check_finite = False)
+            S = np.outer(p, p) * (np.outer(g, g) * S + np.dot(Wh.T, Wh))
+            self.blocks.append((s, e, R, Ut, Wh, g, p))
+            D.append(np.diag(R) ** 2)
+        self.D = np.concatenate(D)
+        self.log_det = np.sum(np.log(self.D))
+    
+    def whiten(self, y, state = None):
+        '''
+        Returns :math:`D^{-1/2} L^{-1} y`, which has unit covariance if `y`
+        has covariance `C`. The rows of `y` may be passed in consecutive
+        chunks, with the `state` returned by the call for the previous
+        chunk, so that `y` need never be held in memory all at once.
+        
+        :param ndarray y: The `(n,)` or `(n, k)` array of the values at \
+               the next `n` cadences.
+        :param state: The state returned by the previous call, or \
+               :py:obj:`None` to start at the first cadence.
+        
+        :returns: The whitened array and the state.
+        
+        '''
+        
+        y = np.asarray(y, dtype = 'float64')
+        shape = y.shape
+        y = y.reshape(len(y), -1)
+        if state is None:
+            state = (0, np.zeros((self.J, y.shape[1])), 
+                     np.zeros((0, y.shape[1])))
+        
+        # `f` is the contribution of the past at the start of the current
+        # block, and `zb` the whitened cadences of the block done so far
+        i0, f, zb = state
+        z = np.empty_like(y)
+        i = 0
+        while i < len(y):
+            s, e, R, Ut, Wh, g, p = self.blocks[(i0 + i) // self.block_size]
+            j = len(zb)
+            k = min(e - s, j + len(y) - i)
+            rhs = y[i:i + k - j] - np.dot(Ut[j:k], f) - np.dot(R[j:k, :j], 
+                                                                 zb)
+            zk = solve_triangular(R[j:k, j:k], rhs, lower = True,
+                                  check_finite = False)
+            z[i:i + k - j] = zk
+            zb = np.vstack([zb, zk])
+            i += k - j
+            if k == e - s:
+                f = p[:, None] * (g[:, None] * f + np.dot(Wh.T, zb))
+                zb = zb[:0]
+        state = (i0 + len(y), f, zb)
+        return z.reshape(shape), state
+    
+    def solve(self, y):
+        '''
+        Returns :math:`C^{-1} y` for the `(N,)` or `(N, k)` array `y`.
+        
+        '''
+        
+        z, _ = self.whiten(y)
+        shape = z.shape
+        z = z.reshape(self.N, -1)
+        x = np.empty_like(z)
+        h = np.zeros((self.J, z.shape[1]))
+        for s, e, R, Ut, Wh, g, p in self.blocks[::-1]:
+            x[s:e] = solve_triangular(R, z[s:e] - np.dot(Wh, p[:, None] * h),
+                                      lower = True, trans = 'T',
+                                      check_finite = False)
+            h = p[:, None] * h
+            h = np.dot(Ut.T, x[s:e]) + g[:, None] * h
+        return x.reshape(shape)
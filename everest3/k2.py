@@ -12,23 +12,24 @@ from __future__ import division, print_function, absolute_import, \
                        unicode_literals
 from . import containers
 from .constants import *
+from .utils import Scatter
 import os
+import re
 import sys
+import six
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from six.moves.urllib.parse import urlsplit
 import numpy as np
-import kplr
-client = kplr.API()
-from kplr.config import KPLR_ROOT
-try:
-    import pyfits
-except ImportError:
-    try:
-        import astropy.io.fits as pyfits
-    except ImportError:
-        raise Exception('Please install the `pyfits` package.')
 import logging
 log = logging.getLogger(__name__)
 
-__all__ = ['path', 'name', 'time_unit', 'mag_str', 'Target']
+__all__ = ['path', 'name', 'time_unit', 'mag_str', 'Target', 'campaigns',
+           'targets', 'add_to_index', 'build_index', 'prefetch', 
+           'candidate_apertures']
 
 @property
 def _url(self):
@@ -39,7 +40,7 @@ def _url(self):
 
     '''
     
-    base_url = "http://archive.stsci.edu/pub/k2/"
+    base_url = archive_url
     if self.ktc_k2_id < 201000000:
         base_url += "{0}/c%d/200000000/{1:05d}/{2}" % self.sci_campaign
     else:
@@ -48,12 +49,65 @@ def _url(self):
     return base_url.format(self.product,
                            int(int(int(self.kepid[-5:][-5:])*1e-3)*1e3),
                            self._filename)
-kplr.api.K2TargetPixelFile.url = _url
+
+#: The :py:obj:`kplr` data directory. This is the same as 
+#: :py:obj:`kplr.config.KPLR_ROOT`, but doesn't require importing 
+#: :py:obj:`kplr`.
+KPLR_ROOT = os.path.expanduser(os.environ.get("KPLR_DATA_DIR",
+                                              os.path.join("~", ".kplr")))
+
+#: The cached :py:class:`kplr.API` client
+_kplr_client = None
+
+def _client():
+    '''
+    Returns the :py:class:`kplr.API` client. The :py:obj:`kplr` package is 
+    imported (and patched with :py:func:`_url`) the first time this is 
+    called.
+    
+    '''
+    
+    global _kplr_client
+    if _kplr_client is None:
+        import kplr
+        kplr.api.K2TargetPixelFile.url = _url
+        _kplr_client = kplr.API()
+    return _kplr_client
+
+def _pyfits():
+    '''
+    Imports and returns the FITS module, either :py:obj:`pyfits` or
+    :py:obj:`astropy.io.fits`.
+    
+    '''
+    
+    try:
+        import pyfits
+    except ImportError:
+        try:
+            import astropy.io.fits as pyfits
+        except ImportError:
+            raise Exception('Please install the `pyfits` package.')
+    return pyfits
+
+def __getattr__(name):
+    '''
+    Provides the :py:obj:`client` module attribute, which is created lazily.
+    
+    '''
+    
+    if name == 'client':
+        return _client()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+#: The base URL of the `K2` archive. Point this to a local mirror (or set
+#: the `EVEREST3_K2_ARCHIVE_URL` environment variable) to download target
+#: pixel files from there instead of MAST.
+archive_url = os.environ.get("EVEREST3_K2_ARCHIVE_URL", 
+                             "http://archive.stsci.edu/pub/k2/")
 
 #: The mission data directory
 path = os.path.join(EVEREST_DATA_DIR, 'k2')
-if not os.path.exists(path):
-    os.makedirs(path)
 
 #: The mission name
 name = 'K2'
@@ -70,6 +124,452 @@ mag_str = 'Kp'
 #: The catalog identifier for the mission
 ID_str = 'EPIC'
 
+#: The primary header keywords stored in the raw data cache
+_header_keys = ['OBJECT', 'KEPLERID', 'CAMPAIGN', 'CHANNEL', 'MODULE', 
+                'OUTPUT', 'RA_OBJ', 'DEC_OBJ', 'KEPMAG']
+
+def _header_value(value):
+    '''
+    Converts a FITS header value to a JSON-serializable type.
+    
+    '''
+    
+    if isinstance(value, (bool, int, float, six.string_types)):
+        return value
+    elif isinstance(value, (np.integer, np.floating)):
+        return value.item()
+    else:
+        return None
+
+def _checksum(file, blocksize = 2 ** 20):
+    '''
+    Returns the SHA-1 checksum of `file`.
+    
+    '''
+    
+    sha1 = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def _tpf_filename(ID, campaign):
+    '''
+    Returns the name of the long cadence target pixel file for a target.
+    
+    '''
+    
+    return 'ktwo%09d-c%02d_lpd-targ.fits.gz' % (ID, campaign)
+
+#: The cached connection to the campaign index, keyed by process and file
+_index_db = {}
+
+def _index():
+    '''
+    Returns a connection to the offline EPIC-to-campaign index, a
+    :py:mod:`sqlite3` database stored in the file `campaigns.db` in the
+    mission data directory. The connection is cached and re-opened in 
+    forked processes.
+    
+    '''
+    
+    file = os.path.join(path, 'campaigns.db')
+    key = (os.getpid(), file)
+    if key not in _index_db:
+        if not os.path.exists(path):
+            os.makedirs(path)
+        db = sqlite3.connect(file, timeout = 60.)
+        db.execute('CREATE TABLE IF NOT EXISTS campaigns '
+                   '(epic INTEGER, campaign INTEGER, filename TEXT, '
+                   'PRIMARY KEY (epic, campaign)) WITHOUT ROWID')
+        db.commit()
+        _index_db[key] = db
+    return _index_db[key]
+
+def campaigns(ID):
+    '''
+    Looks up a target in the offline campaign index.
+    
+    :param int ID: The EPIC ID of the target.
+    
+    :returns: A list of `(campaign, filename)` tuples, sorted by campaign, \
+              for each of the campaigns in which the target was observed. \
+              The list is empty if the target is not in the index.
+    
+    '''
+    
+    return _index().execute('SELECT campaign, filename FROM campaigns '
+                            'WHERE epic = ? ORDER BY campaign', 
+                            (int(ID),)).fetchall()
+
+def targets(campaign):
+    '''
+    Returns the EPIC IDs of all the targets of a campaign in the offline
+    campaign index.
+    
+    :param int campaign: The campaign number.
+    
+    '''
+    
+    return [row[0] for row in 
+            _index().execute('SELECT epic FROM campaigns WHERE campaign = ? '
+                             'ORDER BY epic', (int(campaign),))]
+
+def add_to_index(entries):
+    '''
+    Adds entries to the offline campaign index.
+    
+    :param entries: An iterable of `(ID, campaign)` or \
+           `(ID, campaign, filename)` tuples. If the filename is not \
+           provided, the standard long cadence TPF name is used.
+    
+    :returns: The number of entries added.
+    
+    '''
+    
+    rows = []
+    for entry in entries:
+        ID, campaign = int(entry[0]), int(entry[1])
+        if len(entry) > 2:
+            filename = entry[2]
+        else:
+            filename = _tpf_filename(ID, campaign)
+        rows.append((ID, campaign, filename))
+    db = _index()
+    with db:
+        db.executemany('INSERT OR REPLACE INTO campaigns VALUES (?, ?, ?)', 
+                       rows)
+    return len(rows)
+
+def build_index(target_list = None, campaign = None, scan = True):
+    '''
+    Builds (or extends) the offline EPIC-to-campaign index used by
+    :py:attr:`Target.season`, so that the campaign of a target can be 
+    found without a network round trip.
+    
+    :param str target_list: The path to a `K2` target list file, i.e., a \
+           comma-separated file whose first column is the EPIC ID. Lines \
+           whose first column is not an integer (headers, comments) are \
+           skipped. Default :py:obj:`None`.
+    :param int campaign: The campaign of the targets in `target_list`. \
+           Required if `target_list` is provided.
+    :param bool scan: Scan the :py:obj:`kplr` data directory for \
+           downloaded target pixel files? Default :py:obj:`True`.
+    
+    :returns: The number of entries added.
+    
+    '''
+    
+    entries = []
+    
+    # Read the target list
+    if target_list is not None:
+        assert campaign is not None, \
+               "Parameter `campaign` is required for a target list."
+        with open(target_list, 'r') as f:
+            for line in f:
+                try:
+                    ID = int(line.split(',')[0])
+                except ValueError:
+                    continue
+                entries.append((ID, campaign))
+    
+    # Scan the TPF tree
+    if scan:
+        tpf_dir = os.path.join(KPLR_ROOT, 'data', 'k2', 'target_pixel_files')
+        regex = re.compile(r'^ktwo(\d{9})-c(\d+)_lpd-targ\.fits(\.gz)?$')
+        for root, dirs, files in os.walk(tpf_dir):
+            for file in files:
+                match = regex.match(file)
+                if match:
+                    entries.append((int(match.group(1)), 
+                                    int(match.group(2)), file))
+    
+    n = add_to_index(entries)
+    log.info('Added %d entries to the campaign index.' % n)
+    return n
+
+def _tpf_url(ID, campaign):
+    '''
+    Returns the archive URL of the long cadence target pixel file for
+    a target. This follows the same directory layout as :py:func:`_url`.
+    
+    '''
+    
+    if ID < 201000000:
+        group = 200000000
+    else:
+        group = (ID // 100000) * 100000
+    return archive_url + 'target_pixel_files/c%d/%d/%05d/%s' % \
+           (campaign, group, ((ID % 100000) // 1000) * 1000, 
+            _tpf_filename(ID, campaign))
+
+class _Downloader(object):
+    '''
+    Downloads files over HTTP(S) from any number of threads, keeping one
+    persistent (keep-alive) connection per thread and host. Partial 
+    downloads are written to a `.part` file and resumed with a `Range`
+    request on the next attempt. Not user-facing; see :py:func:`prefetch`.
+    
+    '''
+    
+    def __init__(self, retries = 3, timeout = 60., chunksize = 2 ** 16):
+        '''
+        
+        '''
+        
+        self.retries = retries
+        self.timeout = timeout
+        self.chunksize = chunksize
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        
+    def _connection(self, scheme, netloc):
+        '''
+        Returns this thread's connection to `netloc`, opening it if needed.
+        
+        '''
+        
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+        conn = connections.get((scheme, netloc), None)
+        if conn is None:
+            from six.moves import http_client
+            if scheme == 'https':
+                conn = http_client.HTTPSConnection(netloc, 
+                                                   timeout = self.timeout)
+            else:
+                conn = http_client.HTTPConnection(netloc, 
+                                                  timeout = self.timeout)
+            connections[(scheme, netloc)] = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+    
+    def _drop(self, scheme, netloc):
+        '''
+        Closes and forgets this thread's connection to `netloc`.
+        
+        '''
+        
+        conn = self._local.connections.pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+    
+    def close(self):
+        '''
+        Closes all the connections opened by this downloader.
+        
+        '''
+        
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+    
+    def get(self, url, file):
+        '''
+        Downloads `url` to `file`, retrying with exponential backoff.
+        
+        :returns: The number of bytes transferred.
+        
+        '''
+        
+        url = urlsplit(url)
+        resource = url.path + ('?' + url.query if url.query else '')
+        part = file + '.part'
+        if not os.path.exists(os.path.dirname(file)):
+            try:
+                os.makedirs(os.path.dirname(file))
+            except OSError:
+                # Another thread got there first
+                pass
+        
+        nbytes = 0
+        for attempt in range(self.retries + 1):
+            conn = self._connection(url.scheme, url.netloc)
+            try:
+                
+                # Resume a partial download?
+                headers = {}
+                if os.path.exists(part):
+                    headers['Range'] = 'bytes=%d-' % os.path.getsize(part)
+                conn.request('GET', resource, headers = headers)
+                response = conn.getresponse()
+                
+                if response.status == 206:
+                    mode = 'ab'
+                    offset = os.path.getsize(part)
+                elif response.status == 200:
+                    mode = 'wb'
+                    offset = 0
+                elif response.status == 416:
+                    # Our partial file is bad; start over
+                    response.read()
+                    os.remove(part)
+                    continue
+                else:
+                    response.read()
+                    if response.status >= 500:
+                        raise IOError('HTTP error %d for %s.' % 
+                                      (response.status, url.geturl()))
+                    else:
+                        # Client errors (e.g. 404) are not retried
+                        raise ValueError('HTTP error %d for %s.' % 
+                                         (response.status, url.geturl()))
+                
+                # Stream the body to disk
+                with open(part, mode) as f:
+                    while True:
+                        chunk = response.read(self.chunksize)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        nbytes += len(chunk)
+                length = response.getheader('Content-Length')
+                if (length is not None) and \
+                   (os.path.getsize(part) != offset + int(length)):
+                    raise IOError('Incomplete download of %s.' % 
+                                  url.geturl())
+                if response.will_close:
+                    self._drop(url.scheme, url.netloc)
+                os.rename(part, file)
+                return nbytes
+                
+            except ValueError:
+                raise
+            except Exception as e:
+                self._drop(url.scheme, url.netloc)
+                if attempt == self.retries:
+                    raise
+                log.debug('Retrying %s (%s)...' % (url.geturl(), e))
+                time.sleep(0.5 * 2 ** attempt)
+
+def prefetch(ids, campaign, max_concurrency = 8, retries = 3, 
+             timeout = 60., clobber = False, callback = None):
+    '''
+    Downloads the long cadence target pixel files for many targets in 
+    parallel, into the same :py:obj:`kplr` directory layout that 
+    :py:meth:`Target.get_raw_data` reads from. Files that are already 
+    present are skipped, interrupted downloads are resumed, and the 
+    downloaded targets are added to the offline campaign index. Files are
+    fetched from :py:obj:`archive_url`.
+    
+    :param ids: An iterable of EPIC IDs.
+    :param int campaign: The campaign number.
+    :param int max_concurrency: The number of simultaneous downloads. \
+           Default `8`.
+    :param int retries: The number of times to retry a failed download. \
+           Default `3`.
+    :param float timeout: The connection timeout in seconds. Default `60`.
+    :param bool clobber: Re-download existing files? Default \
+           :py:obj:`False`.
+    :param func callback: A function called as `callback(ID, nbytes, \
+           error)` as each download completes (or fails). Default \
+           :py:obj:`None`.
+    
+    :returns: A :py:obj:`dict` with the lists of `downloaded`, `skipped` \
+              and `failed` IDs, the total number of `bytes` downloaded and \
+              the wall `time` in seconds.
+    
+    '''
+    
+    from multiprocessing.pool import ThreadPool
+    tstart = time.time()
+    ids = [int(ID) for ID in ids]
+    tpf_dir = os.path.join(KPLR_ROOT, 'data', 'k2', 'target_pixel_files')
+    files = [os.path.join(tpf_dir, str(ID), _tpf_filename(ID, campaign)) 
+             for ID in ids]
+    todo = [(ID, file) for ID, file in zip(ids, files) 
+            if clobber or not os.path.exists(file)]
+    skipped = sorted(set(ids) - set([ID for ID, _ in todo]))
+    
+    downloader = _Downloader(retries = retries, timeout = timeout)
+    
+    def fetch(args):
+        ID, file = args
+        try:
+            return ID, downloader.get(_tpf_url(ID, campaign), file), None
+        except Exception as e:
+            return ID, 0, e
+    
+    downloaded = []
+    failed = []
+    nbytes = 0
+    pool = ThreadPool(max(1, min(max_concurrency, len(todo))))
+    try:
+        for ID, n, error in pool.imap_unordered(fetch, todo):
+            if error is None:
+                downloaded.append(ID)
+                nbytes += n
+            else:
+                log.error('Unable to download target %d: %s' % (ID, error))
+                failed.append(ID)
+            if callback is not None:
+                callback(ID, n, error)
+    finally:
+        pool.close()
+        pool.join()
+        downloader.close()
+    add_to_index([(ID, campaign) for ID in downloaded + skipped])
+    
+    elapsed = time.time() - tstart
+    log.info('Downloaded %d target pixel files (%.1f MB) in %.1f s.' % 
+             (len(downloaded), nbytes / 1e6, elapsed))
+    return dict(downloaded = sorted(downloaded), skipped = skipped, 
+                failed = sorted(failed), bytes = nbytes, time = elapsed)
+
+def candidate_apertures(image, nlevels = 50, radius = 3.):
+    '''
+    Returns the candidate apertures for the target in a postage stamp. The
+    target is the brightest pixel within `radius` pixels of the center of
+    the stamp, and the candidates are the contiguous regions around it above
+    `nlevels` thresholds (spaced logarithmically in flux above the median 
+    background), plus each of those regions grown by one pixel.
+    
+    :param ndarray image: The `(ncols, nrows)` median image of the stamp.
+    :param int nlevels: The number of thresholds. Default `50`.
+    :param float radius: The search radius for the target in pixels. \
+           Default `3`.
+    
+    :returns: An integer array of shape `(napertures, ncols, nrows)`, \
+              which is empty if there is no valid pixel near the center.
+    
+    '''
+    
+    from scipy.ndimage import label, binary_dilation
+    image = np.asarray(image, dtype = 'float64')
+    ncols, nrows = image.shape
+    empty = np.zeros((0, ncols, nrows), dtype = 'int32')
+    
+    # The target pixel
+    i, j = np.meshgrid(np.arange(ncols), np.arange(nrows), indexing = 'ij')
+    near = ((i - (ncols - 1) / 2.) ** 2 + (j - (nrows - 1) / 2.) ** 2 <= 
+            radius ** 2) & np.isfinite(image)
+    if not np.any(near):
+        return empty
+    peak = np.unravel_index(np.argmax(np.where(near, image, -np.inf)), 
+                            image.shape)
+    bkg = np.nanmedian(image)
+    if not image[peak] > bkg:
+        return empty
+    
+    # Threshold the image
+    image = np.where(np.isfinite(image), image, -np.inf)
+    levels = bkg + (image[peak] - bkg) * np.logspace(-3, 0, nlevels, 
+                                                     endpoint = False)
+    apertures = {}
+    for level in levels[::-1]:
+        labels, _ = label(image >= level)
+        region = labels == labels[peak]
+        for aperture in (region, binary_dilation(region) & 
+                                 np.isfinite(image)):
+            apertures.setdefault(aperture.tobytes(), aperture)
+    
+    return np.array(list(apertures.values()), dtype = 'int32')
+
 class _NoWarnings():
     '''
     A context manager to temporarily disable all logging
@@ -91,8 +591,9 @@ class Target(containers.Target):
     A class that stores all the information, data, attributes, etc. for a `K2`
     target de-trended with :py:obj:`everest3`.
     
-    :param bool clobber_raw: Overwrite existing raw light curve? \
-           Default :py:obj:`False`.
+    :param bool clobber_raw: Overwrite existing raw light curve? This \
+           re-downloads the target pixel file and bypasses the processed \
+           raw data cache. Default :py:obj:`False`.
     
     '''
     
@@ -102,7 +603,7 @@ class Target(containers.Target):
         '''
         
         # User options
-        self.clobber_raw = kwargs.get('clobber_raw', False)
+        self.clobber_raw = kwargs.pop('clobber_raw', False)
         
         # Initialize parent class
         super(Target, self).__init__(*args, **kwargs)
@@ -124,11 +625,20 @@ class Target(containers.Target):
         '''
         
         # Do we need to figure out the campaign number for this target?
+        # Check the offline index first and only query the archive if
+        # the target isn't in it.
         if self._season is None:
-            with _NoWarnings():
-                star = client.k2_star(self.ID)
-                tpfs = star.get_target_pixel_files(fetch = False)
-                self._season = tpfs[0].sci_campaign
+            entries = campaigns(self.ID)
+            if len(entries):
+                self._season = entries[0][0]
+            else:
+                with _NoWarnings():
+                    star = _client().k2_star(self.ID)
+                    tpfs = star.get_target_pixel_files(fetch = False)
+                    self._season = tpfs[0].sci_campaign
+                add_to_index([(self.ID, tpf.sci_campaign, tpf._filename) 
+                              for tpf in tpfs if 
+                              tpf._filename.endswith('lpd-targ.fits.gz')])
        
         return self._season
     
@@ -143,52 +653,197 @@ class Target(containers.Target):
         
         '''
         
-        target_path = os.path.join(path, 'c%02d' % self.season, 
-                                  ('%09d' % self.ID)[:4] + '00000', 
-                                  ('%09d' % self.ID)[4:])
+        return os.path.join(path, 'c%02d' % self.season, 
+                            ('%09d' % self.ID)[:4] + '00000', 
+                            ('%09d' % self.ID)[4:])
         
-        if not os.path.exists(target_path):
-            os.makedirs(target_path)
+    @property
+    def tpf(self):
+        '''
+        The full path to the raw target pixel file for this target.
         
-        return target_path
+        '''
         
-    def get_raw_data(self):
+        return os.path.join(KPLR_ROOT, 'data', 'k2', 'target_pixel_files', 
+                            str(self.ID), _tpf_filename(self.ID, self.season))
+    
+    @property
+    def raw_cache(self):
+        '''
+        The directory holding the processed raw data cache for this target.
+        
+        '''
+        
+        return os.path.join(self.path, 'raw')
+    
+    def _raw_meta(self):
+        '''
+        Returns the manifest of the processed data cache and 
+        :py:obj:`None`, or :py:obj:`None` and the reason why the cache is 
+        invalid: it is missing, was written for a different target or 
+        :py:obj:`everest3` version, or is out of date with respect to the 
+        target pixel file.
+        
+        '''
+        
+        # Read the manifest
+        try:
+            with open(os.path.join(self.raw_cache, 'meta.json'), 'r') as f:
+                meta = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None, None
+        
+        # Check the cache key
+        if (meta.get('version') != EVEREST_VERSION) or \
+           (meta.get('ID') != self.ID) or \
+           (meta.get('campaign') != self.season):
+            return None, 'Raw data cache is stale. Rebuilding...'
+        
+        # Check the source TPF, if we still have it. The checksum is only
+        # recomputed if the file size or modification time changed.
+        if os.path.exists(self.tpf):
+            stat = os.stat(self.tpf)
+            if ([stat.st_size, stat.st_mtime] != 
+                [meta['tpf']['size'], meta['tpf']['mtime']]) and \
+               (_checksum(self.tpf) != meta['tpf']['sha1']):
+                return None, 'Target pixel file has changed. Rebuilding ' \
+                             'the raw data cache...'
+        return meta, None
+    
+    @property
+    def raw_fingerprint(self):
         '''
-        Downloads the raw data for this target.
+        The checksum of the target pixel file and the creation time of the
+        processed data cache it was extracted to, so that the stage 
+        checkpoints are discarded whenever the cache is rebuilt. This is
+        :py:obj:`None` if the cache is invalid, or is about to be rebuilt
+        because :py:attr:`clobber_raw` is set.
+        
+        '''
+        
+        if self.clobber_raw and ('raw' not in self.completed):
+            return None
+        meta, _ = self._raw_meta()
+        if meta is None:
+            return None
+        return '%s-%s' % (meta['tpf']['sha1'], meta.get('created'))
     
+    def _load_raw_cache(self):
         '''
+        Loads the raw data from the processed data cache. Returns 
+        :py:obj:`True` on success, or :py:obj:`False` if the cache is 
+        invalid (see :py:meth:`_raw_meta`).
         
-        # Get the raw target pixel file path
-        tpf = os.path.join(KPLR_ROOT, 'data', 'k2', 'target_pixel_files', 
-                           str(self.ID), 'ktwo%09d-c%02d_lpd-targ.fits.gz'
-                           % (self.ID, self.season))
+        '''
         
-        # Download the file if necessary
-        if (self.clobber_raw) or (not os.path.exists(tpf)):
-            log.info('Downloading raw data...')
-            with _NoWarnings():
-                star = client.k2_star(self.ID)
-                tpfs = star.get_target_pixel_files(fetch = True)
+        meta, reason = self._raw_meta()
+        if meta is None:
+            if reason is not None:
+                log.info(reason)
+            return False
         
-        # Read the TPF
-        with pyfits.open(tpf) as f:
-            tpf_data = f[1].data
+        # Load the memory-mapped arrays
+        self.raw = containers.TimeSeries.from_npy(self.raw_cache)
+        self.header = meta['header']
+        return True
+    
+    def _save_raw_cache(self, raw, header):
+        '''
+        Saves the raw data and header metadata to the processed data cache.
+        The manifest is written last, so an interrupted write is never 
+        mistaken for a valid cache.
         
-        # Set the magnitude (TODO)
-        self.mag = np.nan
+        '''
+        
+        raw.to_npy(self.raw_cache)
+        stat = os.stat(self.tpf)
+        meta = dict(version = EVEREST_VERSION, ID = self.ID, 
+                    campaign = self.season, header = header, 
+                    created = time.time(),
+                    tpf = dict(size = stat.st_size, mtime = stat.st_mtime,
+                               sha1 = _checksum(self.tpf)))
+        file = os.path.join(self.raw_cache, 'meta.json')
+        with open(file + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.rename(file + '.tmp', file)
+    
+    def get_raw_data(self):
+        '''
+        Downloads the raw data for this target. The time, flux, error and 
+        quality arrays and the header metadata are extracted from the target
+        pixel file once and saved to a versioned cache in the 
+        :py:attr:`raw_cache` directory, from which the arrays are
+        memory-mapped on demand. Subsequent runs therefore skip the gzip 
+        and FITS decoding entirely, and repeated loads of the same target 
+        share the page cache instead of holding private copies of the flux
+        cube in memory. The cache is bypassed if :py:attr:`clobber_raw` is
+        set, and rebuilt if the target pixel file changes.
+    
+        '''
+        
+        # Have we extracted the arrays already?
+        if (self.clobber_raw) or (not self._load_raw_cache()):
+            
+            # Download the file if necessary
+            if (self.clobber_raw) or (not os.path.exists(self.tpf)):
+                log.info('Downloading raw data...')
+                with _NoWarnings():
+                    star = _client().k2_star(self.ID)
+                    tpfs = star.get_target_pixel_files(fetch = True)
+            
+            # Read the TPF
+            log.info('Extracting the raw data...')
+            with _pyfits().open(self.tpf) as f:
+                header = dict([(key, _header_value(f[0].header.get(key))) 
+                               for key in _header_keys])
+                tpf_data = f[1].data
+                time = np.array(tpf_data.field('TIME'), dtype='float64')
+                flux = np.array(tpf_data.field('FLUX'), dtype='float64')
+                error = np.array(tpf_data.field('FLUX_ERR'), dtype='float64')
+                quality = np.array(tpf_data.field('QUALITY'), dtype='int32')
+            
+            # Save the arrays to disk and memory-map them back
+            self._save_raw_cache(containers.TimeSeries(time, flux, error, 
+                                 quality = quality), header)
+            self.raw = containers.TimeSeries.from_npy(self.raw_cache)
+            self.header = header
         
-        # Store the data in the raw light curve container
-        time = np.array(tpf_data.field('TIME'), dtype='float64')
-        flux = np.array(tpf_data.field('FLUX'), dtype='float64')
-        error = np.array(tpf_data.field('FLUX_ERR'), dtype='float64')
-        self.raw = containers.TimeSeries(time, flux, error)
+        # Set the magnitude
+        if self.header.get('KEPMAG') is not None:
+            self.mag = self.header['KEPMAG']
+        else:
+            self.mag = np.nan
         
     def get_aperture(self):
         '''
-        Computes the optimal aperture for this target.
+        Computes the optimal aperture for this target: the candidate 
+        aperture (see :py:func:`candidate_apertures`) whose raw SAP flux 
+        has the lowest scatter. The fluxes of all candidates are computed
+        at once with :py:meth:`TimeSeries.sap_fluxes`.
     
         '''
         
         log.info('Computing the optimal aperture...')
-        self.aperture = np.ones((self.raw.ncols, self.raw.nrows), 
-                                dtype = 'int32')
\ No newline at end of file
+        
+        # The median image of the good cadences
+        good = np.flatnonzero((self.raw.quality == 0) & 
+                              np.isfinite(self.raw.time))
+        with np.errstate(all = 'ignore'):
+            image = np.nanmedian(self.raw.flux[good], axis = 0)
+        apertures = candidate_apertures(image)
+        if not len(apertures):
+            log.warning('Unable to find the target in the postage stamp.')
+            self.aperture = np.ones((self.raw.ncols, self.raw.nrows), 
+                                    dtype = 'int32')
+            return
+        
+        # Rank the candidates
+        flux, _ = self.raw.sap_fluxes(apertures)
+        scatter = np.array([Scatter(f, win = self._scatter_win) 
+                            for f in flux[good].T])
+        scatter[~np.isfinite(scatter)] = np.inf
+        best = np.argmin(scatter)
+        log.info('Selected a %d-pixel aperture out of %d candidates '
+                 '(%.1f ppm).' % (apertures[best].sum(), len(apertures),
+                                  scatter[best]))
+        self.aperture = apertures[best]
\ No newline at end of file
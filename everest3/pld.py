@@ -6,24 +6,1222 @@ pld.py
 
 The :py:mod:`everest3` core PLD de-trending functions.
 
+The PLD model of order `n` is a linear combination of the products of `n`
+fractional pixel fluxes (the columns of :py:attr:`Target.design`). With a
+Gaussian prior of variance :math:`\\lambda_n` on the weights of order `n`
+and white noise of variance :math:`\\sigma^2`, the maximum a posteriori
+model can be computed in one of two equivalent forms:
+
+- the *primal* form, which solves the `(M, M)` normal equations
+  :math:`(X^\\top C^{-1} X + \\Lambda^{-1}) w = X^\\top C^{-1} y`, at a cost
+  of :math:`O(N M^2 + M^3)`, or
+- the *dual* form, which solves the `(N, N)` system
+  :math:`(X \\Lambda X^\\top + C) \\alpha = y`, at a cost of
+  :math:`O(N^2 M + N^3)`,
+
+where `N` is the number of cadences and `M` the total number of regressors.
+:py:class:`Solver` picks the cheaper of the two and caches the Gram (primal)
+or kernel (dual) matrices, so that changing the regularization strength or
+the cadence mask only requires a new Cholesky factorization.
+
+The regularization strength of each order can be chosen by cross-validation
+(:py:func:`cross_validate`). Scanning :math:`\\lambda_k` with the other
+orders fixed, the system matrix is :math:`A + \\lambda_k B_k` (dual) or
+:math:`A + \\lambda_k^{-1} B_k` (primal). A single generalized
+eigendecomposition :math:`B_k V = A V \\mathrm{diag}(\\mu)`, with
+:math:`V^\\top A V = I`, turns the inverse of the dual system into
+:math:`V \\mathrm{diag}(1 + \\lambda_k \\mu)^{-1} V^\\top`, so every value of
+:math:`\\lambda_k` is a diagonal rescaling. The held-out residuals of each
+fold `v` then follow from the full fit by a block down-date, e.g.
+:math:`r_v = [(K^{-1})_{vv}]^{-1} (K^{-1} y)_v` in the dual form, instead
+of a new fit per fold.
+
 '''
 
 from __future__ import division, print_function, absolute_import, \
                        unicode_literals
+from itertools import combinations_with_replacement
+from scipy.linalg import cho_factor, cho_solve, eigh, solve
+from .utils import Scatter, BLASThreads, DefaultThreads
+from . import gp
+from six import string_types
+from multiprocessing import cpu_count
+from copy import deepcopy
+from multiprocessing.pool import ThreadPool
 import numpy as np
+import time
 import logging
 log = logging.getLogger(__name__)
 
-def detrend(target, **kwargs):
+__all__ = ['regressors', 'regressor_blocks', 'randomized_svd', 'Solver', 
+           'detrend', 'cross_validate']
+
+def _combinations(npix, order):
+    '''
+    Returns the `(ncomb, order)` array of pixel indices whose fractional
+    fluxes are multiplied together to form the PLD regressors of `order`.
+    
+    '''
+    
+    return np.array(list(combinations_with_replacement(range(npix), order)),
+                    dtype = int).reshape(-1, order)
+
+def regressors(fpix, order):
+    '''
+    Returns the PLD regressors of a given order.
+    
+    :param ndarray fpix: The fractional pixel flux matrix, shape \
+           `(ncads, npix)`.
+    :param int order: The PLD order.
+    
+    :returns: The `(ncads, ncomb)` matrix of the products of all \
+              combinations (with replacement) of `order` columns of `fpix`.
+    
+    '''
+    
+    idx = _combinations(fpix.shape[1], order)
+    X = fpix[:, idx[:, 0]]
+    for j in range(1, order):
+        X = X * fpix[:, idx[:, j]]
+    return X
+
+def regressor_blocks(fpix, order, block_size):
+    '''
+    Generates the PLD regressors of a given order in blocks of columns, so 
+    that the full `(ncads, ncomb)` regressor matrix is never held in memory.
+    
+    :param ndarray fpix: The fractional pixel flux matrix, shape \
+           `(ncads, npix)`. This may be a memory-mapped array.
+    :param int order: The PLD order.
+    :param int block_size: The maximum number of columns per block.
+    
+    :returns: A generator of `(cols, X)` tuples, where `cols` is the \
+              :py:obj:`slice` of the columns of :py:func:`regressors` in \
+              the `(ncads, len(cols))` block `X`.
+    
+    '''
+    
+    idx = _combinations(fpix.shape[1], order)
+    for start in range(0, len(idx), block_size):
+        cols = slice(start, min(start + block_size, len(idx)))
+        X = np.array(fpix[:, idx[cols, 0]])
+        for j in range(1, order):
+            X *= fpix[:, idx[cols, j]]
+        yield cols, X
+
+def randomized_svd(blocks, nrows, ncols, rank, oversample = 10, 
+                   power = 2, seed = None):
+    '''
+    Computes the leading left singular vectors and singular values of a
+    matrix that is only available as a stream of column blocks, using the 
+    randomized range finder of Halko, Martinsson & Tropp (2011) with power
+    iterations. The matrix is never held in memory; each power iteration
+    streams over the blocks twice.
+    
+    :param func blocks: A function that returns a generator of `(cols, X)` \
+           column blocks of the `(nrows, ncols)` matrix, as in \
+           :py:func:`regressor_blocks`.
+    :param int nrows: The number of rows of the matrix.
+    :param int ncols: The number of columns of the matrix.
+    :param int rank: The number of singular vectors to return.
+    :param int oversample: The number of extra random vectors used to \
+           sample the range. Default `10`.
+    :param int power: The number of power iterations. Default `2`.
+    :param int seed: The random seed. Default :py:obj:`None`.
+    
+    :returns: The `(nrows, rank)` left singular vectors and the `(rank,)` \
+              singular values, in decreasing order.
+    
+    '''
+    
+    rng = np.random.RandomState(seed)
+    l = min(rank + oversample, nrows, ncols)
+    
+    # Sample the range of the matrix
+    Y = np.zeros((nrows, l))
+    for cols, x in blocks():
+        Y += np.dot(x, rng.randn(x.shape[1], l))
+    Q, _ = np.linalg.qr(Y)
+    
+    # Power iterations, re-orthonormalizing at each step
+    for i in range(power):
+        Y = np.zeros((nrows, l))
+        for cols, x in blocks():
+            Y += np.dot(x, np.dot(x.T, Q))
+        Q, _ = np.linalg.qr(Y)
+    
+    # The SVD of the small matrix B = Q^T X, via the eigendecomposition 
+    # of B B^T
+    BBT = np.zeros((l, l))
+    for cols, x in blocks():
+        B = np.dot(Q.T, x)
+        BBT += np.dot(B, B.T)
+    S2, V = np.linalg.eigh(BBT)
+    order = np.argsort(S2)[::-1][:rank]
+    S = np.sqrt(np.maximum(S2[order], 0))
+    return np.dot(Q, V[:, order]), S
+
+def _factorize(A):
+    '''
+    Returns the Cholesky factorization of the symmetric positive definite
+    matrix `A`, adding a tiny amount of jitter to the diagonal if needed.
+    
+    '''
+    
+    try:
+        return cho_factor(A, lower = True, check_finite = False)
+    except np.linalg.LinAlgError:
+        jitter = 1e-10 * np.mean(np.diag(A))
+        log.warning('Matrix is not positive definite. Adding jitter...')
+        return cho_factor(A + jitter * np.eye(A.shape[0]), lower = True,
+                          check_finite = False)
+
+class Solver(object):
     '''
-    De-trend a light curve with PLD.
+    A regularized least-squares PLD solver with cached normal equations.
+    
+    The regressors are never held in memory all at once. In the primal
+    form, the Gram matrix is accumulated over chunks of cadences (rows); in
+    the dual form, the kernel of each order is accumulated over blocks of 
+    regressors (columns). Each chunk or block is at most `max_memory` bytes,
+    so the peak memory is that of the cached `(M, M)` or `(norders, N, N)` 
+    matrices plus `max_memory`. The fractional pixel flux matrix may be 
+    memory-mapped.
+    
+    :param ndarray fpix: The `(ncads, npix)` fractional pixel flux matrix.
+    :param ndarray y: The `(ncads,)` flux array, centered.
+    :param ndarray var: The `(ncads,)` flux variance array.
+    :param int order: The PLD order.
+    :param ndarray good: A boolean array of the cadences at which `fpix` \
+           and `y` are finite. The regressors are centered on, and the \
+           model fit to, these cadences only. Default :py:obj:`None` (all).
+    :param str form: `primal`, `dual` or :py:obj:`None`, in which case the \
+           form with the smaller system is chosen.
+    :param int max_memory: The maximum size in bytes of a chunk or block \
+           of regressors. Default `2 ** 27` (128 MB).
+    :param pca: If an :py:obj:`int`, replace the regressors of each order \
+           by (at most) this many of their leading principal components. \
+           If a :py:obj:`float` between 0 and 1, keep as many components \
+           as needed to explain this fraction of the variance of each \
+           order, up to `pca_max_rank`. The components are computed with \
+           :py:func:`randomized_svd`. Default :py:obj:`None` (no reduction).
+    :param int pca_max_rank: The maximum number of principal components \
+           per order when `pca` is a variance threshold. Default `200`.
+    :param dict cache: A :py:obj:`dict` in which to cache the principal \
+           components, so that other solvers for the same data can reuse \
+           them. Default :py:obj:`None`.
+    :param kernel: A Gaussian process model of the correlated noise \
+           (e.g., stellar variability), added to the white noise `var`. \
+           The regression is then solved in the primal form through the \
+           matrix inversion lemma, whitening the regressors with the \
+           :math:`O(N)` semiseparable factorization \
+           :py:class:`everest3.gp.Factor`, so the cost is \
+           :math:`O(N M^2)` rather than :math:`O(N^3)`. The Gram matrix \
+           then depends on the kernel parameters and on the mask, and is \
+           computed (and cached) by each :py:meth:`solve`. Default \
+           :py:obj:`None`.
+    :type kernel: :py:class:`everest3.gp.Kernel`
+    :param ndarray t: The `(ncads,)` time array. Required if `kernel` \
+           is given.
+    
+    '''
+    
+    #: The maximum number of cached factorizations
+    _max_factors = 4
+    
+    def __init__(self, fpix, y, var, order, good = None, form = None, 
+                 max_memory = 2 ** 27, pca = None, pca_max_rank = 200, 
+                 cache = None, kernel = None, t = None):
+        '''
+        
+        '''
+        
+        tstart = time.time()
+        self.fpix = fpix
+        self.ncads, self.npix = fpix.shape
+        if good is None:
+            good = np.ones(self.ncads, dtype = bool)
+        self.good = good
+        self.y = np.where(good, y, 0.)
+        self.var = var
+        self.order = order
+        self.max_memory = max_memory
+        self.ncols = [len(_combinations(self.npix, n)) 
+                      for n in range(1, order + 1)]
+        self._factors = {}
+        self._basis = [None for n in range(order)]
+        self.kernel = kernel
+        self.t = t
+        self._systems = {}
+        self._X = None
+        
+        # The mean and mean squared (centered) norm of the regressors
+        self._mean = []
+        self.sqnorm = []
+        ngood = np.count_nonzero(good)
+        for n in range(1, order + 1):
+            mean = np.empty(self.ncols[n - 1])
+            sqnorm = 0.
+            for cols, x in regressor_blocks(self.fpix, n, self._block_size):
+                x = x[good]
+                mean[cols] = np.mean(x, axis = 0)
+                sqnorm += np.sum(x ** 2) - ngood * np.sum(mean[cols] ** 2)
+            self._mean.append(mean)
+            self.sqnorm.append(sqnorm / ngood)
+        
+        # Reduce the regressors to their principal components
+        if pca is not None:
+            if cache is None:
+                cache = {}
+            for n in range(1, order + 1):
+                key = (n, pca, pca_max_rank)
+                if key not in cache:
+                    cache[key] = self._principal_components(n, pca, 
+                                                            pca_max_rank)
+                else:
+                    log.info('Reusing the cached order %d principal '
+                             'components.' % n)
+                self._basis[n - 1] = cache[key]
+                self.ncols[n - 1] = cache[key].shape[1]
+        
+        if kernel is not None:
+            if form == 'dual':
+                raise ValueError('The GP noise model requires the primal '
+                                 'form of the solver.')
+            if t is None:
+                raise ValueError('The GP noise model requires the time '
+                                 'array.')
+            form = 'primal'
+        elif form is None:
+            form = 'primal' if sum(self.ncols) <= self.ncads else 'dual'
+        self.form = form
+        
+        if kernel is not None:
+            
+            # The Gram matrix depends on the kernel (see `_system`)
+            self._G = None
+            self._b = None
+        
+        elif self.form == 'primal':
+            
+            # The weighted Gram matrix and projection, accumulated over 
+            # chunks of cadences
+            M = sum(self.ncols)
+            self._G = np.zeros((M, M))
+            self._b = np.zeros(M)
+            for rows, x in self._row_chunks():
+                xw = x / self.var[rows][:, None]
+                self._G += np.dot(x.T, xw)
+                self._b += np.dot(xw.T, self.y[rows])
+        
+        elif self.form == 'dual':
+            
+            # The kernel matrix of each order, accumulated over blocks
+            # of regressors
+            self._K = []
+            for n in range(1, order + 1):
+                K = np.zeros((self.ncads, self.ncads))
+                for cols, x in self._col_blocks(n):
+                    K += np.dot(x, x.T)
+                self._K.append(K)
+        
+        else:
+            raise ValueError('Invalid solver form: `%s`.' % form)
+        
+        self.build_time = time.time() - tstart
+        log.info('Built %s PLD solver for %d cadences and %d regressors '
+                 'in %.3f s (%.1f MB cached).' % (self.form, self.ncads,
+                 sum(self.ncols), self.build_time, self.nbytes / 1e6))
+    
+    @property
+    def _max_downdate(self):
+        '''
+        The maximum number of cadences removed from a cached factorization
+        by a low-rank down-date, beyond which refactorizing is cheaper.
+        
+        '''
+        
+        if self.form == 'primal':
+            return sum(self.ncols) // 4
+        else:
+            return self.ncads // 8
+    
+    @property
+    def _block_size(self):
+        '''
+        The number of regressors (columns) per block.
+        
+        '''
+        
+        return max(1, int(self.max_memory // (8 * self.ncads)))
+    
+    @property
+    def _chunk_size(self):
+        '''
+        The number of cadences (rows) per chunk.
+        
+        '''
+        
+        return max(1, int(self.max_memory // (8 * sum(self.ncols))))
+    
+    def _rows(self, rows):
+        '''
+        Returns the centered regressors of all orders at the cadences 
+        `rows`, with zeros at the bad cadences.
+        
+        '''
+        
+        fpix = np.asarray(self.fpix[rows])
+        x = []
+        for n in range(1, self.order + 1):
+            if self._basis[n - 1] is not None:
+                x.append(self._basis[n - 1][rows])
+            else:
+                x.append(regressors(fpix, n) - self._mean[n - 1])
+        x = np.hstack(x)
+        x[~self.good[rows]] = 0
+        return x
+    
+    def _row_chunks(self):
+        '''
+        Generates chunks of the centered regressors of all orders.
+        
+        '''
+        
+        for start in range(0, self.ncads, self._chunk_size):
+            rows = slice(start, min(start + self._chunk_size, self.ncads))
+            yield rows, self._rows(rows)
+    
+    def _col_blocks(self, n):
+        '''
+        Generates blocks of the centered regressors of order `n`.
+        
+        '''
+        
+        if self._basis[n - 1] is not None:
+            yield slice(0, self.ncols[n - 1]), np.array(self._basis[n - 1])
+            return
+        for cols, x in regressor_blocks(self.fpix, n, self._block_size):
+            x -= self._mean[n - 1][cols]
+            x[~self.good] = 0
+            yield cols, x
+    
+    def _principal_components(self, n, pca, max_rank):
+        '''
+        Returns the `(ncads, rank)` matrix of the leading principal 
+        components of the regressors of order `n`, scaled by their singular
+        values, so that a unit-variance prior on their weights is the same 
+        as a unit-variance prior on the weights of the original regressors.
+        
+        '''
+        
+        tstart = time.time()
+        ncols = self.ncols[n - 1]
+        if isinstance(pca, float):
+            rank = min(max_rank, ncols, self.ncads)
+        else:
+            rank = min(int(pca), ncols, self.ncads)
+        
+        # The column blocks of the (unreduced) regressors
+        def blocks():
+            for cols, x in regressor_blocks(self.fpix, n, self._block_size):
+                x -= self._mean[n - 1][cols]
+                x[~self.good] = 0
+                yield cols, x
+        
+        U, S = randomized_svd(blocks, self.ncads, ncols, rank, seed = n)
+        
+        # Truncate at the requested explained variance
+        if isinstance(pca, float):
+            total = self.sqnorm[n - 1] * np.count_nonzero(self.good)
+            explained = np.cumsum(S ** 2) / total
+            rank = min(rank, np.searchsorted(explained, pca) + 1)
+            U, S = U[:, :rank], S[:rank]
+            log.info('Order %d: %d components explain %.5f of the variance.'
+                     % (n, rank, explained[rank - 1]))
+        
+        log.info('Computed %d principal components of %d order %d PLD '
+                 'regressors in %.3f s.' % (rank, ncols, n, 
+                                            time.time() - tstart))
+        return U * S
+    
+    @property
+    def nbytes(self):
+        '''
+        The number of bytes held by the cached Gram/kernel matrices and
+        factorizations.
+        
+        '''
+        
+        if self.kernel is not None:
+            n = sum([s[1].nbytes for s in self._systems.values()])
+            if self._X is not None:
+                n += self._X.nbytes
+        elif self.form == 'primal':
+            n = self._G.nbytes + self._b.nbytes
+        else:
+            n = sum([k.nbytes for k in self._K])
+        return n + sum([f[0][0].nbytes for f in self._factors.values()])
+    
+    @property
+    def _theta(self):
+        '''
+        The current kernel parameters, as a hashable key.
+        
+        '''
+        
+        if self.kernel is None:
+            return ()
+        return tuple(self.kernel.log_params)
+    
+    def _system(self, train):
+        '''
+        Returns the GP factorization of the noise covariance at the training
+        cadences `train`, and the whitened Gram matrix, projection and 
+        squared norm of the flux, for the current kernel parameters. These
+        are cached, so e.g. the final solve after an optimization reuses 
+        them. The regressors are accumulated over chunks of cadences, 
+        carrying the state of the (sequential) whitening from one chunk to
+        the next. If they fit in `max_memory`, the regressors are cached 
+        in memory, so they are not recomputed for each set of parameters.
+        
+        '''
+        
+        key = (self._theta, np.packbits(train).tobytes())
+        system = self._systems.get(key, None)
+        if system is not None:
+            return system
+        
+        # Cache the regressors if we can afford it
+        M = sum(self.ncols)
+        if (self._X is None) and (8 * self.ncads * M <= self.max_memory):
+            self._X = np.vstack([x for rows, x in self._row_chunks()])
+        
+        # Whiten the regressors and the flux together
+        factor = gp.Factor(self.kernel, self.t[train], self.var[train])
+        inds = np.flatnonzero(train)
+        A = np.zeros((M + 1, M + 1))
+        state = None
+        for start in range(0, len(inds), self._chunk_size):
+            rows = inds[start:start + self._chunk_size]
+            x = self._X[rows] if self._X is not None else self._rows(rows)
+            z, state = factor.whiten(np.hstack([x, self.y[rows][:, None]]),
+                                     state)
+            A += np.dot(z.T, z)
+        system = (factor, A[:M, :M], A[:M, M], A[M, M])
+        
+        if len(self._systems) >= self._max_factors:
+            del self._systems[next(iter(self._systems))]
+        self._systems[key] = system
+        return system
+    
+    def log_likelihood(self, lam, mask = None):
+        '''
+        Returns the log marginal likelihood of the flux under the PLD model
+        with a GP noise model, marginalized over the PLD weights. By the 
+        matrix inversion lemma and the matrix determinant lemma, this only
+        requires the `(M, M)` whitened Gram matrix and the log-determinant 
+        of the noise covariance.
+        
+        :param lam: The prior variance of the weights of each order.
+        :param ndarray mask: A boolean array of the cadences to *exclude* \
+               from the fit, or :py:obj:`None`.
+        
+        '''
+        
+        if self.kernel is None:
+            raise ValueError('The log likelihood requires a GP kernel.')
+        lam = np.atleast_1d(np.array(lam, dtype = 'float64'))
+        if mask is None:
+            mask = np.zeros(self.ncads, dtype = bool)
+        train = self.good & ~(mask & self.good)
+        factor, G, b, yy = self._system(train)
+        key = (tuple(lam), np.packbits(train).tobytes(), self._theta)
+        prior = np.concatenate([np.ones(n) / l for n, l in
+                                zip(self.ncols, lam)])
+        cf = self._cached_factor(key, lambda: _factorize(G + np.diag(prior)))
+        w = cho_solve(cf, b, check_finite = False)
+        return -0.5 * (yy - np.dot(b, w) + factor.log_det + 
+                       np.sum([n * np.log(l) for n, l in 
+                               zip(self.ncols, lam)]) +
+                       2 * np.sum(np.log(np.diag(cf[0]))) + 
+                       factor.N * np.log(2 * np.pi))
+    
+    def optimize(self, lam, mask = None, maxiter = 100):
+        '''
+        Sets the kernel parameters to those that maximize 
+        :py:meth:`log_likelihood`. The GP factorization and the whitened
+        Gram matrix are cached for each set of parameters, and the 
+        regressors for all of them, so repeated evaluations (and the final
+        :py:meth:`solve`) are cheap.
+        
+        :param lam: The prior variance of the weights of each order.
+        :param ndarray mask: A boolean array of the cadences to *exclude* \
+               from the fit, or :py:obj:`None`.
+        :param int maxiter: The maximum number of iterations. Default `100`.
+        
+        :returns: The maximum log likelihood.
+        
+        '''
+        
+        from scipy.optimize import minimize
+        
+        def nll(theta):
+            self.kernel.log_params = theta
+            try:
+                return -self.log_likelihood(lam, mask = mask)
+            except np.linalg.LinAlgError:
+                return 1e25
+        
+        tstart = time.time()
+        theta0 = self.kernel.log_params
+        bounds = [(t - 10., t + 10.) for t in theta0]
+        
+        # The log likelihood is a sum over many cadences, so finite 
+        # differences with the default step are dominated by roundoff
+        res = minimize(nll, theta0, method = 'L-BFGS-B', bounds = bounds, 
+                       options = dict(maxiter = maxiter, eps = 1e-5))
+        self.kernel.log_params = res.x
+        log.info('Optimized the GP in %.3f s (%d evaluations): %s.' % 
+                 (time.time() - tstart, res.nfev, self.kernel))
+        return -res.fun
+    
+    def noise(self, resid, mask = None):
+        '''
+        Returns the white noise component of the residuals `resid` of the
+        PLD model at the training cadences (and :py:obj:`nan` elsewhere). 
+        With a GP noise model, this is the residual after subtracting the 
+        GP prediction, :math:`\\mathrm{diag}(\\sigma^2) C^{-1} r`.
+        
+        '''
+        
+        if mask is None:
+            mask = np.zeros(self.ncads, dtype = bool)
+        train = self.good & ~(mask & self.good)
+        out = np.nan * np.empty(self.ncads)
+        if self.kernel is None:
+            out[train] = resid[train]
+        else:
+            factor = self._system(train)[0]
+            out[train] = self.var[train] * factor.solve(resid[train])
+        return out
+    
+    def _cached_factor(self, key, build):
+        '''
+        Returns the cached factorization for `key`, computing it with
+        `build()` if necessary.
+        
+        '''
+        
+        factor = self._factors.get(key, None)
+        if factor is None:
+            if len(self._factors) >= self._max_factors:
+                del self._factors[next(iter(self._factors))]
+            factor = self._factors[key] = build()
+        return factor
+    
+    def solve(self, lam, mask = None, base = None):
+        '''
+        Solves for the PLD model.
+        
+        :param lam: The prior variance of the weights of each order.
+        :param ndarray mask: A boolean array of the cadences to *exclude* \
+               from the fit, or :py:obj:`None`. The bad cadences are always \
+               excluded.
+        :param ndarray base: A boolean array of cadences, a subset of \
+               `mask`, whose (cached) factorization is reused. The \
+               remaining masked cadences are then removed from the fit with \
+               a low-rank down-date (the Woodbury identity in the primal \
+               form, a Schur complement of the inverse kernel in the dual \
+               form) at a cost of :math:`O(M^2 k)` or :math:`O(N^2 k)` for \
+               `k` down-dated cadences, instead of a new factorization. \
+               Ignored with a GP noise model, whose factorization is \
+               :math:`O(N)` anyway. Default :py:obj:`None`.
+        
+        :returns: The `(ncads,)` model evaluated at all cadences and the \
+                  list of weight vectors of each order.
+        
+        '''
+        
+        lam = np.atleast_1d(np.array(lam, dtype = 'float64'))
+        assert len(lam) == self.order, \
+               "Parameter `lam` must have one entry per PLD order."
+        if mask is None:
+            mask = np.zeros(self.ncads, dtype = bool)
+        mask = mask & self.good
+        
+        # The cadences to down-date, if it's worth it
+        if (base is None) or (self.kernel is not None):
+            base = mask
+        base = base & mask
+        extra = np.flatnonzero(mask & ~base)
+        if len(extra) > self._max_downdate:
+            base = mask
+            extra = extra[:0]
+        train = self.good & ~base
+        key = (tuple(lam), np.packbits(base).tobytes(), self._theta)
+        
+        if self.kernel is not None:
+            
+            # The whitened normal equations
+            factor, G, b, yy = self._system(train)
+            prior = np.concatenate([np.ones(n) / l for n, l in
+                                    zip(self.ncols, lam)])
+            factor = self._cached_factor(key, 
+                                         lambda: _factorize(G + 
+                                                            np.diag(prior)))
+            w = cho_solve(factor, b, check_finite = False)
+            if self._X is not None:
+                model = np.dot(self._X, w)
+            else:
+                model = np.concatenate([np.dot(x, w) for rows, x in 
+                                        self._row_chunks()])
+            weights = np.split(w, np.cumsum(self.ncols)[:-1])
+        
+        elif self.form == 'primal':
+            
+            # The regressors at the masked cadences
+            rows = np.flatnonzero(base)
+            Xm = self._rows(rows)
+            
+            def build():
+                
+                # Down-date the Gram matrix by the masked cadences
+                G = self._G
+                if len(rows):
+                    G = G - np.dot(Xm.T, Xm / self.var[rows][:, None])
+                
+                # Add the prior
+                prior = np.concatenate([np.ones(n) / l for n, l in
+                                        zip(self.ncols, lam)])
+                return _factorize(G + np.diag(prior))
+            
+            factor = self._cached_factor(key, build)
+            b = self._b - np.dot(Xm.T, self.y[rows] / self.var[rows])
+            if len(extra):
+                U = self._rows(extra)
+                b -= np.dot(U.T, self.y[extra] / self.var[extra])
+            w = cho_solve(factor, b, check_finite = False)
+            
+            # Woodbury down-date
+            if len(extra):
+                PU = cho_solve(factor, U.T, check_finite = False)
+                S = np.diag(self.var[extra]) - np.dot(U, PU)
+                w += np.dot(PU, solve(S, np.dot(U, w), check_finite = False))
+            
+            model = np.concatenate([np.dot(x, w) for rows, x in 
+                                    self._row_chunks()])
+            weights = np.split(w, np.cumsum(self.ncols)[:-1])
+        
+        else:
+            
+            def build():
+                K = sum([l * k[np.ix_(train, train)]
+                         for l, k in zip(lam, self._K)])
+                K[np.diag_indices_from(K)] += self.var[train]
+                return _factorize(K)
+            
+            factor = self._cached_factor(key, build)
+            y = self.y[train]
+            if len(extra):
+                p = np.searchsorted(np.flatnonzero(train), extra)
+                y = np.array(y)
+                y[p] = 0
+            alpha = cho_solve(factor, y, check_finite = False)
+            
+            # Schur complement down-date: the inverse of the kernel without 
+            # the extra cadences is the Schur complement of their block in 
+            # the inverse of the full kernel
+            if len(extra):
+                E = np.zeros((len(alpha), len(p)))
+                E[p, np.arange(len(p))] = 1
+                He = cho_solve(factor, E, check_finite = False)
+                alpha -= np.dot(He, solve(He[p], alpha[p], assume_a = 'pos',
+                                          check_finite = False))
+                alpha[p] = 0
+            
+            model = sum([l * np.dot(k[:, train], alpha)
+                         for l, k in zip(lam, self._K)])
+            weights = []
+            for n, l in enumerate(lam):
+                w = np.empty(self.ncols[n])
+                for cols, x in self._col_blocks(n + 1):
+                    w[cols] = l * np.dot(x[train].T, alpha)
+                weights.append(w)
+        
+        return model, weights
+    
+    def validate(self, k, lam, lambda_arr, folds, mask = None):
+        '''
+        Computes the held-out residuals of the PLD model for each of a 
+        grid of prior variances of order `k + 1`, with the prior variances
+        of the other orders fixed. The residuals at the cadences of each 
+        fold are those of the model fit to all other (unmasked) cadences.
+        
+        This costs one generalized eigendecomposition of the `(M, M)` 
+        (primal) or `(N, N)` (dual) system matrix, after which each value 
+        of the prior variance and each fold only requires a diagonal 
+        rescaling and a solve of the size of the fold.
+        
+        :param int k: The index of the PLD order to scan.
+        :param lam: The prior variance of the weights of each order. The \
+               entry `k` is ignored in the dual form and used as the \
+               reference value in the primal form.
+        :param ndarray lambda_arr: The prior variances of order `k + 1` \
+               to evaluate.
+        :param list folds: A list of arrays of the indices of the cadences \
+               in each validation fold. These should not overlap and \
+               should not include masked or bad cadences.
+        :param ndarray mask: A boolean array of the cadences to *exclude* \
+               from the fit, or :py:obj:`None`.
+        
+        :returns: The `(len(lambda_arr), ncads)` array of held-out \
+                  residuals, :py:obj:`nan` outside the folds.
+        
+        '''
+        
+        lam = np.array(lam, dtype = 'float64')
+        lambda_arr = np.atleast_1d(lambda_arr)
+        if mask is None:
+            mask = np.zeros(self.ncads, dtype = bool)
+        mask = mask & self.good
+        train = self.good & ~mask
+        resid = np.nan * np.empty((len(lambda_arr), self.ncads))
+        
+        if self.form == 'primal':
+            
+            # The normal equations of the training cadences
+            rows = np.flatnonzero(mask)
+            Xm = self._rows(rows)
+            G = self._G - np.dot(Xm.T, Xm / self.var[rows][:, None])
+            b = self._b - np.dot(Xm.T, self.y[rows] / self.var[rows])
+            
+            # The generalized eigendecomposition with respect to the
+            # prior precision of order `k`
+            s0 = 1. / lam[k]
+            prior = np.concatenate([np.ones(n) / l for n, l in
+                                    zip(self.ncols, lam)])
+            E = np.zeros_like(prior)
+            E[sum(self.ncols[:k]):sum(self.ncols[:k + 1])] = 1
+            mu, V = eigh(np.diag(E), G + np.diag(prior), check_finite = False)
+            Vb = np.dot(V.T, b)
+            
+            for v in folds:
+                Z = np.dot(self._rows(v), V)
+                for i, l in enumerate(lambda_arr):
+                    D = 1. / (1. + (1. / l - s0) * mu)
+                    r = self.y[v] - np.dot(Z, D * Vb)
+                    H = np.eye(len(v)) - np.dot(Z * D, Z.T) / self.var[v]
+                    resid[i, v] = solve(H, r, check_finite = False)
+        
+        else:
+            
+            # The kernel of the other orders plus the white noise
+            t = np.flatnonzero(train)
+            ix = np.ix_(t, t)
+            A = sum([l * K[ix] for j, (l, K) in enumerate(zip(lam, self._K))
+                     if j != k])
+            A[np.diag_indices_from(A)] += self.var[t]
+            
+            # The generalized eigendecomposition of the kernel of order `k`
+            mu, V = eigh(self._K[k][ix], A, check_finite = False)
+            Vy = np.dot(V.T, self.y[t])
+            
+            for v in folds:
+                Vv = V[np.searchsorted(t, v)]
+                for i, l in enumerate(lambda_arr):
+                    D = 1. / (1. + l * mu)
+                    Hy = np.dot(Vv, D * Vy)
+                    H = np.dot(Vv * D, Vv.T)
+                    resid[i, v] = solve(H, Hy, assume_a = 'pos', 
+                                        check_finite = False)
+        
+        return resid
+
+def _prepare(target, mask = None, t = None):
+    '''
+    Returns the fractional pixel fluxes, the centered flux, the flux
+    variance, the good cadences and the fit mask of a target. If the time
+    array `t` is given, cadences with non-finite times are also excluded.
+    
+    '''
+    
+    # The data
+    fpix = target.design
+    y = np.array(target.sap_flux)
+    var = np.array(target.sap_error) ** 2
+    
+    # Cadences we can't use
+    good = np.isfinite(y) & np.all(np.isfinite(fpix), axis = 1)
+    if t is not None:
+        good &= np.isfinite(t)
+    if not good.all():
+        fpix = np.where(good[:, None], fpix, 0.)
+    
+    # The fit mask
+    fit_mask = ~good
+    if mask is not None:
+        mask = np.asarray(mask)
+        if mask.dtype == bool:
+            fit_mask |= mask
+        else:
+            fit_mask[mask] = True
+    
+    # Well-behaved variances
+    ok = good & np.isfinite(var) & (var > 0)
+    if ok.any():
+        var[~ok] = np.median(var[ok])
+    else:
+        var[:] = 1e-3 * np.var(y[good])
+    
+    # Center the flux
+    y[good] -= np.median(y[good])
+    y[~good] = 0
+    
+    return fpix, y, var, good, fit_mask
+
+def _solver(target, fpix, y, var, good, order, form, max_memory, pca, 
+            pca_max_rank, kernel = None, t = None):
+    '''
+    Returns the PLD solver cached on the target, or a new one if the data 
+    or the settings have changed.
+    
+    '''
+    
+    # The principal component cache for this design matrix
+    cache = getattr(target, '_pld_cache', None)
+    if (cache is None) or (cache['design'] is not target.design):
+        cache = target._pld_cache = dict(design = target.design, basis = {})
+    
+    # Reuse the cached solver if possible
+    solver = cache.get('solver', None)
+    if (solver is None) or (solver.order != order) or \
+       (solver.pca != (pca, pca_max_rank)) or \
+       (solver.kernel is not kernel) or \
+       ((form is not None) and (form != solver.form)):
+        solver = Solver(fpix, y, var, order, good = good, form = form, 
+                        max_memory = max_memory, pca = pca, 
+                        pca_max_rank = pca_max_rank, cache = cache['basis'],
+                        kernel = kernel, t = t)
+        solver.pca = (pca, pca_max_rank)
+        cache['solver'] = solver
+    
+    return solver
+
+def cross_validate(target, order = 3, lambda_arr = None, nfolds = 5, 
+                   niter = 1, mask = None, form = None, max_memory = 2 ** 27,
+                   pca = None, pca_max_rank = 200):
+    '''
+    Chooses the prior variance of the PLD weights of each order by 
+    cross-validation. The unmasked cadences are split into `nfolds` 
+    contiguous folds; the prior variance of each order in turn (with the 
+    others fixed) is set to the value in `lambda_arr` that minimizes the
+    median over folds of the scatter of the held-out de-trended flux. The 
+    held-out residuals are computed by :py:meth:`Solver.validate` from one 
+    eigendecomposition per order, rather than one fit per prior variance 
+    and fold.
     
     :param target: The target to de-trend
     :type target: :py:class:`everest3.containers.Target`
+    :param int order: The PLD order. Default `3`.
+    :param lambda_arr: The grid of prior variances to try for each order, \
+           either a single array or one per order. If :py:obj:`None`, \
+           spans ten decades around the default prior of \
+           :py:func:`detrend`. Default :py:obj:`None`.
+    :param int nfolds: The number of validation folds. Default `5`.
+    :param int niter: The number of passes over the PLD orders. Default `1`.
+    :param array_like mask: The cadences to exclude from the fit and from \
+           the validation, e.g. transits. Default :py:obj:`None`.
+    
+    The remaining parameters are passed to :py:class:`Solver` as in \
+    :py:func:`detrend`.
+    
+    :returns: A :py:obj:`dict` with the chosen prior variances `lam`, the \
+              grid `lambda_arr` of each order, the `(order, nlam, nfolds)` \
+              validation scatter `scatter` in ppm, and the wall `time` in \
+              seconds.
     
     '''
     
-    # Do the de-trending here here.
+    tstart = time.time()
+    fpix, y, var, good, fit_mask = _prepare(target, mask)
+    solver = _solver(target, fpix, y, var, good, order, form, max_memory, 
+                     pca, pca_max_rank)
+    
+    # The starting prior and the grid
+    lam = [np.var(y[~fit_mask]) / sqnorm for sqnorm in solver.sqnorm]
+    if lambda_arr is None:
+        lambda_arr = [l * 10 ** np.arange(-6., 4.01, 0.5) for l in lam]
+    elif np.ndim(lambda_arr[0]) == 0:
+        lambda_arr = [np.array(lambda_arr, dtype = 'float64') 
+                      for n in range(order)]
+    
+    # The contiguous validation folds
+    folds = np.array_split(np.flatnonzero(~fit_mask), nfolds)
+    f0 = np.nanmedian(target.sap_flux)
+    
+    # Coordinate descent over the orders
+    scatter = [None for n in range(order)]
+    for it in range(niter):
+        for k in range(order):
+            resid = solver.validate(k, lam, lambda_arr[k], folds, 
+                                    mask = fit_mask)
+            scatter[k] = np.array([[Scatter(f0 + r[v]) for v in folds] 
+                                   for r in resid])
+            lam[k] = lambda_arr[k][np.argmin(np.median(scatter[k], axis = 1))]
+            log.info('Order %d: lambda = %.3e, validation scatter = %.2f '
+                     'ppm.' % (k + 1, lam[k], 
+                               np.min(np.median(scatter[k], axis = 1))))
+    
+    elapsed = time.time() - tstart
+    log.info('Cross-validated the order %d PLD model in %.3f s.' % 
+             (order, elapsed))
+    
+    return dict(lam = lam, lambda_arr = lambda_arr, 
+                scatter = np.array(scatter), time = elapsed)
+
+class _Segment(object):
+    '''
+    A view of the data of a target on one light curve segment, which 
+    :py:func:`detrend` and :py:func:`cross_validate` treat as a target in 
+    its own right (with its own cached solver).
+    
+    '''
+    
+    def __init__(self, target, cadences):
+        '''
+        
+        '''
+        
+        self.cadences = cadences
+        self.time = np.asarray(target.raw.time)[cadences]
+        self.design = target.design[cadences]
+        self.sap_flux = np.asarray(target.sap_flux)[cadences]
+        self.sap_error = np.asarray(target.sap_error)[cadences]
+        self.cv = None
+
+def _segments(target, gap, breakpoints):
+    '''
+    Returns the list of :py:class:`_Segment` views of a target, reusing the
+    cached ones (and their solvers) if the segments haven't changed.
+    
+    '''
+    
+    bounds = target.raw.segments(gap = gap, breakpoints = breakpoints)
+    cache = getattr(target, '_pld_segments', None)
+    if (cache is None) or (cache['design'] is not target.design) or \
+       (cache['bounds'] != bounds):
+        cache = target._pld_segments = dict(design = target.design, 
+                                            bounds = bounds, segments = 
+                                            [_Segment(target, b) 
+                                             for b in bounds])
+    return cache['segments']
+
+def _detrend(target, order, lam, mask, form, max_memory, pca, pca_max_rank, 
+             clip, maxiter, kernel = None, optimize = True):
+    '''
+    De-trends a single light curve segment (see :py:func:`detrend`). The 
+    model is offset by the median flux, so that the models of different 
+    segments can be stitched together. The kernel (if any) is optimized in
+    place and assigned to :py:attr:`target.kernel`.
+    
+    '''
+    
+    tstart = time.time()
+    
+    # Choose the prior by cross-validation
+    if isinstance(lam, string_types) and (lam == 'cv'):
+        target.cv = cross_validate(target, order = order, mask = mask, 
+                                   form = form, max_memory = max_memory, 
+                                   pca = pca, pca_max_rank = pca_max_rank)
+        lam = target.cv['lam']
+    
+    t = None if kernel is None else np.asarray(target.time)
+    fpix, y, var, good, fit_mask = _prepare(target, mask, t = t)
+    solver = _solver(target, fpix, y, var, good, order, form, max_memory, 
+                     pca, pca_max_rank, kernel = kernel, t = t)
+    
+    # The default prior
+    if lam is None:
+        lam = [np.var(y[~fit_mask]) / sqnorm for sqnorm in solver.sqnorm]
+    
+    # Optimize the GP
+    if (kernel is not None) and optimize:
+        solver.optimize(lam, mask = fit_mask)
+    target.kernel = kernel
+    
+    # Solve
+    tsolve = time.time()
+    model, weights = solver.solve(lam, mask = fit_mask)
+    
+    # Iteratively clip outliers, down-dating the first factorization
+    base = fit_mask
+    outliers = np.zeros_like(good)
+    history = []
+    for i in range(maxiter):
+        tclip = time.time()
+        noise = solver.noise(y - model, mask = fit_mask)
+        resid = noise[good & ~fit_mask]
+        med = np.median(resid)
+        sig = 1.4826 * np.median(np.abs(resid - med))
+        new = good & ~fit_mask & (np.abs(noise - med) > clip * sig)
+        if (sig == 0) or not new.any():
+            break
+        outliers |= new
+        fit_mask = fit_mask | new
+        if np.count_nonzero(fit_mask & ~base) > solver._max_downdate:
+            base = fit_mask
+        model, weights = solver.solve(lam, mask = fit_mask, base = base)
+        history.append(dict(iter = i + 1, 
+                            clipped = [int(c) for c in np.flatnonzero(new)], 
+                            sigma = float(sig), time = time.time() - tclip))
+        log.info('Clipping round %d: %d new outlier(s) (%d total) in %.3f s.'
+                 % (i + 1, np.count_nonzero(new), 
+                    np.count_nonzero(outliers), history[-1]['time']))
+    else:
+        if maxiter:
+            log.warning('Outlier clipping did not converge after %d rounds.'
+                        % maxiter)
+    
+    model[~good] = np.nan
+    model += np.nanmedian(target.sap_flux)
+    log.info('Solved for the order %d PLD model in %.3f s (%.3f s total, '
+             '%.1f MB cached).' % (order, time.time() - tsolve,
+             time.time() - tstart, solver.nbytes / 1e6))
+    
+    target.outliers = np.flatnonzero(outliers)
+    target.clip_history = history
+    target.weights = np.concatenate(weights)
+    target.model = model
+
+def detrend(target, order = 3, lam = None, mask = None, form = None, 
+            max_memory = 2 ** 27, pca = None, pca_max_rank = 200, 
+            clip = 5., maxiter = 10, gap = 20., breakpoints = None, 
+            threads = None, kernel = None, optimize = True):
+    '''
+    De-trend a light curve with PLD. This assigns the model to
+    :py:attr:`target.model` and the regression weights (concatenated over
+    all segments and orders) to :py:attr:`target.weights`.
+    
+    The light curve is split into segments at data gaps and breakpoints (see
+    :py:meth:`TimeSeries.segments`), which are de-trended independently, in
+    parallel threads (the linear algebra releases the GIL), and stitched
+    back together. The solver of each segment is cached on the target, so 
+    calling this function again with a different `lam` or `mask` reuses 
+    the Gram/kernel matrices.
+    
+    Outliers are removed by iterative sigma-clipping of the residuals. Each
+    round only removes the newly clipped cadences from the fit, with a
+    low-rank down-date of the cached factorization (see 
+    :py:meth:`Solver.solve`), until no new outliers are found. The indices
+    of the clipped cadences are assigned to :py:attr:`target.outliers`, and
+    the cadences clipped in, and the duration of, each round to
+    :py:attr:`target.clip_history`.
+    
+    :param target: The target to de-trend
+    :type target: :py:class:`everest3.containers.Target`
+    :param int order: The PLD order. Default `3`.
+    :param lam: The prior variance of the PLD weights of each order. If \
+           :py:obj:`None`, a weak prior is set by scaling the variance of \
+           the flux by the mean squared norm of the regressors of each \
+           order. If `cv`, the prior is chosen by \
+           :py:func:`cross_validate` for each segment and the results \
+           are assigned to :py:attr:`target.cv` (a list with one entry \
+           per segment). Default :py:obj:`None`.
+    :param array_like mask: The indices (or a boolean array) of the \
+           cadences to exclude from the fit, e.g. transits. The model is \
+           still evaluated at these cadences. Default :py:obj:`None`.
+    :param str form: Force the `primal` or `dual` form of the solver. \
+           Default :py:obj:`None` (choose automatically).
+    :param int max_memory: The maximum size in bytes of the blocks of PLD \
+           regressors generated while building the solver. The full \
+           regressor matrix is never held in memory. Default `2 ** 27` \
+           (128 MB).
+    :param pca: Replace the regressors of each order by their leading \
+           principal components: either the number of components, or the \
+           fraction of the variance to explain (see :py:class:`Solver`). \
+           The components are cached on the target and reused by \
+           subsequent fits. In this case, :py:attr:`target.weights` are \
+           the weights of the principal components. Default \
+           :py:obj:`None`.
+    :param int pca_max_rank: The maximum number of principal components \
+           per order. Default `200`.
+    :param float clip: The outlier threshold in units of the (robust) \
+           standard deviation of the residuals. Default `5`.
+    :param int maxiter: The maximum number of clipping rounds. Set to `0` \
+           to disable outlier clipping. Default `10`.
+    :param float gap: The minimum length of a data gap, in units of the \
+           median cadence, at which to split the light curve. Set to \
+           :py:obj:`None` to disable gap detection. Default `20`.
+    :param list breakpoints: The indices of the cadences at which to \
+           split the light curve, in addition to the gaps. Default \
+           :py:obj:`None`.
+    :param int threads: The number of threads in which to de-trend the \
+           segments. The BLAS libraries are limited to their share of the \
+           CPUs meanwhile (see :py:func:`everest3.utils.BLASThreads`). \
+           Default :py:obj:`None` (one per CPU, or one in the worker \
+           processes of a pool, see \
+           :py:func:`everest3.utils.DefaultThreads`).
+    :param kernel: A Gaussian process model of the correlated (e.g. \
+           stellar) noise. The PLD model is then the maximum a posteriori \
+           model given white plus GP noise, computed in :math:`O(N M^2)` \
+           (see :py:class:`Solver`). A copy of the kernel is fit to each \
+           segment, and the copies are assigned to \
+           :py:attr:`target.kernels`. Default :py:obj:`None`.
+    :type kernel: :py:class:`everest3.gp.Kernel`
+    :param bool optimize: Optimize the kernel parameters of each segment \
+           by maximizing the marginal likelihood? Default :py:obj:`True`.
+    
+    '''
+    
+    tstart = time.time()
+    segments = _segments(target, gap, breakpoints)
+    
+    # The fit mask
+    fit_mask = np.zeros(target.raw.ncads, dtype = bool)
+    if mask is not None:
+        fit_mask[np.asarray(mask)] = True
+    
+    def run(segment):
+        _detrend(segment, order, lam, fit_mask[segment.cadences], form, 
+                 max_memory, pca, pca_max_rank, clip, maxiter, 
+                 kernel = deepcopy(kernel), optimize = optimize)
+    
+    # De-trend the segments
+    if threads is None:
+        threads = DefaultThreads()
+    threads = min(threads, len(segments))
+    if threads > 1:
+        pool = ThreadPool(threads)
+        try:
+            with BLASThreads(max(1, cpu_count() // threads)):
+                pool.map(run, segments)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for segment in segments:
+            run(segment)
     
-    # Assign the model
-    target.model = np.zeros_like(target.time)
\ No newline at end of file
+    # Stitch them together
+    model = np.concatenate([segment.model for segment in segments])
+    model -= np.nanmedian(model)
+    outliers = []
+    history = []
+    for k, segment in enumerate(segments):
+        start = segment.cadences.start
+        outliers.append(segment.outliers + start)
+        for h in segment.clip_history:
+            history.append(dict(h, segment = k, clipped = 
+                                [c + start for c in h['clipped']]))
+    if isinstance(lam, string_types) and (lam == 'cv'):
+        target.cv = [segment.cv for segment in segments]
+    if kernel is not None:
+        target.kernels = [segment.kernel for segment in segments]
+    target.outliers = np.concatenate(outliers)
+    target.clip_history = history
+    target.weights = np.concatenate([segment.weights 
+                                     for segment in segments])
+    target.model = model
+    log.info('De-trended %d segment(s) in %d thread(s) in %.3f s.' % 
+             (len(segments), threads, time.time() - tstart))
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+report.py
+---------
+
+Campaign-level reports: the data validation summaries of all the targets of
+a campaign, streamed into a few multi-page PDFs, plus an HTML index of the
+targets with PNG thumbnails of their pages, sorted by scatter or by the
+improvement over the raw light curve. Reports are generated from the
+results saved by :py:meth:`Target.save` (e.g., by
+:py:func:`everest3.batch.run`), so nothing is re-de-trended.
+
+'''
+
+from __future__ import division, print_function, absolute_import, \
+                       unicode_literals
+from .constants import *
+from .utils import ReadHeader, BatchLogging, BatchLoggingActive, \
+                   StopBatchLogging
+import numpy as np
+import time
+import logging
+log = logging.getLogger(__name__)
+
+__all__ = ['report']
+
+#: The HTML index template
+_html = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>%(title)s</title>
+<style>
+body { font-family: sans-serif; font-size: 13px; }
+table { border-collapse: collapse; }
+th, td { padding: 2px 10px; text-align: right; border-bottom: 1px solid #ddd; }
+img { height: 120px; }
+</style>
+</head>
+<body>
+<h2>%(title)s</h2>
+<p>%(summary)s</p>
+<table>
+<tr><th>#</th><th>%(ID_str)s</th><th>%(mag_str)s</th><th>Raw CDPP (ppm)</th>
+<th>CDPP (ppm)</th><th>Improvement</th><th>DVS</th></tr>
+%(rows)s
+</table>
+</body>
+</html>
+"""
+
+#: An HTML index row
+_row = """<tr><td>%(rank)d</td><td>%(ID)s</td><td>%(mag).2f</td>
+<td>%(raw_scatter).1f</td><td>%(scatter).1f</td><td>%(improvement).2f</td>
+<td><a href="%(pdf)s#page=%(page)d">%(thumbnail)s</a></td></tr>"""
+
+def _scan(Target, ids, season):
+    '''
+    Returns the header metadata of the saved results of the targets,
+    skipping those that haven't been saved.
+    
+    '''
+    
+    rows = []
+    for ID in ids:
+        try:
+            star = Target(ID, season = season, quiet = True)
+            meta = ReadHeader(star.resfile)
+        except Exception as e:
+            log.warning('No saved results for target %s: %s' % (ID, e))
+            continue
+        meta['improvement'] = meta['raw_scatter'] / meta['scatter'] \
+                              if meta['scatter'] > 0 else np.nan
+        rows.append(meta)
+    return rows
+
+def report(ids = None, campaign = None, mission = 'k2', path = None,
+           sort = 'scatter', pages_per_file = 500, thumbnails = True,
+           thumbnail_dpi = 24):
+    '''
+    Generates a report of the de-trending of many targets. The DVS pages
+    are drawn on a single reused page template (see
+    :py:func:`everest3.dvs.template`) and written to the PDFs one at a
+    time, so memory use does not grow with the number of targets. Targets
+    without saved results, or whose pages can't be drawn, are logged and
+    left out. Logging is switched to :py:func:`everest3.utils.BatchLogging`
+    mode for the duration of the report (unless it is active already), so
+    loading each target doesn't reset the log handlers. The files are:
+        
+        - `report-001.pdf`, `report-002.pdf`, ...: The DVS pages, in order.
+        - `thumbnails/<ID>.png`: The thumbnail of each page.
+        - `index.html`: A table of the targets, with links to their pages.
+    
+    :param ids: The IDs of the targets. Default :py:obj:`None`.
+    :param int campaign: The season (campaign) of the targets. If `ids` is \
+           :py:obj:`None`, all targets of this campaign in the mission's \
+           offline index are included. Default :py:obj:`None`.
+    :param str mission: The mission module. Default `k2`.
+    :param str path: The output directory. Default :py:obj:`None`, in \
+           which case a directory named after the mission and campaign in \
+           the :py:obj:`EVEREST_DATA_DIR` is used.
+    :param str sort: Sort the targets by `scatter` (ascending), \
+           `improvement` (the ratio of the raw to the de-trended scatter, \
+           descending), `mag` or `ID`. Default `scatter`.
+    :param int pages_per_file: The maximum number of pages per PDF. \
+           Default `500`.
+    :param bool thumbnails: Save PNG thumbnails of the pages? Default \
+           :py:obj:`True`.
+    :param float thumbnail_dpi: The resolution of the thumbnails. \
+           Default `24`.
+    
+    :returns: The path to the HTML index.
+    
+    '''
+    
+    stop_logging = not BatchLoggingActive()
+    BatchLogging()
+    try:
+        return _report(ids, campaign, mission, path, sort, pages_per_file, 
+                       thumbnails, thumbnail_dpi)
+    finally:
+        if stop_logging:
+            StopBatchLogging()
+
+def _report(ids, campaign, mission, path, sort, pages_per_file, thumbnails,
+            thumbnail_dpi):
+    '''
+    Generates the report (see :py:func:`report`).
+    
+    '''
+    
+    from matplotlib.backends.backend_pdf import PdfPages
+    from .batch import _mission
+    from .dvs import template
+    tstart = time.time()
+    module = _mission(mission)
+    if ids is None:
+        assert campaign is not None, \
+               "Either `ids` or `campaign` must be provided."
+        ids = module.targets(campaign)
+    if path is None:
+        path = os.path.join(EVEREST_DATA_DIR, 'reports', mission if
+                            campaign is None else '%s-c%02d' % (mission,
+                                                                campaign))
+    if not os.path.exists(os.path.join(path, 'thumbnails')):
+        os.makedirs(os.path.join(path, 'thumbnails'))
+    
+    # Sort the targets
+    rows = _scan(module.Target, ids, campaign)
+    key, reverse = dict(scatter = ('scatter', False),
+                        improvement = ('improvement', True),
+                        mag = ('mag', False), ID = ('ID', False))[sort]
+    valid = lambda row: (key == 'ID') or np.isfinite(row[key])
+    rows = sorted([row for row in rows if valid(row)], 
+                  key = lambda row: row[key], reverse = reverse) + \
+           [row for row in rows if not valid(row)]
+    
+    # Stream the pages
+    pdf = None
+    html = []
+    done = []
+    try:
+        for row in rows:
+            try:
+                star = module.Target.load(row['ID'], row['season'],
+                                          quiet = True)
+                page = template(layout = star.dvs_layout)
+                try:
+                    star._draw_dvs(page)
+                    if len(done) % pages_per_file == 0:
+                        if pdf is not None:
+                            pdf.close()
+                        name = 'report-%03d.pdf' % (len(done) // 
+                                                    pages_per_file + 1)
+                        pdf = PdfPages(os.path.join(path, name))
+                    pdf.savefig(page.fig)
+                    if thumbnails:
+                        thumbnail = os.path.join('thumbnails', '%s.png' %
+                                                 row['ID'])
+                        page.fig.savefig(os.path.join(path, thumbnail),
+                                         dpi = thumbnail_dpi)
+                finally:
+                    page.clear()
+            except Exception as e:
+                log.error('Unable to add target %s to the report: %s' % 
+                          (row['ID'], e))
+                continue
+            html.append(_row % dict(row, rank = len(done) + 1, pdf = name,
+                                    page = len(done) % pages_per_file + 1,
+                                    thumbnail = '<img src="%s">' % thumbnail
+                                    if thumbnails else 'PDF'))
+            done.append(row)
+    finally:
+        if pdf is not None:
+            pdf.close()
+    rows = done
+    
+    # The index
+    mission_name = getattr(module, 'name', mission)
+    title = '%s de-trending report' % mission_name + \
+            ('' if campaign is None else ', campaign %d' % campaign)
+    summary = '%d targets. Median CDPP: %.1f ppm (raw: %.1f ppm).' % \
+              (len(rows), np.nanmedian([row['scatter'] for row in rows]),
+               np.nanmedian([row['raw_scatter'] for row in rows])) \
+              if len(rows) else 'No targets.'
+    index = os.path.join(path, 'index.html')
+    with open(index + '.tmp', 'w') as f:
+        f.write(_html % dict(title = title, summary = summary,
+                             ID_str = getattr(module, 'ID_str', 'ID'),
+                             mag_str = getattr(module, 'mag_str', 'mag'),
+                             rows = '\n'.join(html)))
+    os.rename(index + '.tmp', index)
+    log.info('Wrote a report of %d targets to %s in %.1f s.' % (len(rows),
+             path, time.time() - tstart))
+    return index
@@ -12,11 +12,22 @@ from __future__ import division, print_function, absolute_import, \
      unicode_literals
 import os
 import sys
+import json
+import struct
+import atexit
 import traceback
-import pdb
+from collections import OrderedDict
+import numpy as np
 import logging
+import logging.handlers
 log = logging.getLogger(__name__)
 
+#: The magic string at the start of an :py:obj:`everest3` array file
+_ARRAY_MAGIC = b'EVEREST3'
+
+#: The alignment (in bytes) of the arrays in an :py:obj:`everest3` array file
+_ARRAY_ALIGN = 64
+
 class _NoPILFilter(logging.Filter):
     '''
     The :py:obj:`PIL` image module has a nasty habit of sending all sorts of 
@@ -50,17 +61,244 @@ def _ExceptionHookPDB(exctype, value, tb):
     for line in traceback.format_tb(tb):
         log.error(line.replace('\n', ''))
     sys.__excepthook__(exctype, value, tb)
+    import pdb
     pdb.pm()
 
-def InitializeLogging(file_name = None, quiet = False, pdb = False):
+#: The format of the log file records
+_file_format = "%(asctime)s %(levelname)-5s [%(name)s.%(funcName)s()]: " + \
+               "%(message)s"
+
+#: The format of the batch log records
+_batch_format = "%(asctime)s %(levelname)-5s %(ID)s %(season)s " + \
+                "%(stage)s [%(name)s.%(funcName)s()]: %(message)s"
+
+#: The log record context of this process (see :py:func:`LogContext`)
+_log_context = dict(ID = '-', season = '-', stage = '-', logfile = None)
+
+#: The batch logging state of this process (see :py:func:`BatchLogging`)
+_batch_logging = {}
+
+class _ContextFilter(logging.Filter):
+    '''
+    Attaches the log record context (target ID, season, pipeline stage and
+    log file) of this process to the records.
+    
+    '''
+    
+    def filter(self, record):
+        for key, value in _log_context.items():
+            setattr(record, key, value)
+        return True
+
+class _TargetFileHandler(logging.Handler):
+    '''
+    Writes each record to the log file in its context, if any. At most 
+    `max_files` files are kept open at a time.
+    
     '''
-    A little routine to initialize the logging functionality.
+    
+    def __init__(self, max_files = 16):
+        '''
+        
+        '''
+        
+        super(_TargetFileHandler, self).__init__()
+        self.max_files = max_files
+        self._files = OrderedDict()
+        self.setFormatter(logging.Formatter(_file_format, 
+                                            datefmt = "%m/%d/%y %H:%M:%S"))
+    
+    def emit(self, record):
+        '''
+        
+        '''
+        
+        file_name = getattr(record, 'logfile', None)
+        if file_name is None:
+            return
+        try:
+            f = self._files.pop(file_name, None)
+            if f is None:
+                if not os.path.exists(os.path.dirname(file_name)):
+                    os.makedirs(os.path.dirname(file_name))
+                f = open(file_name, 'a')
+                if len(self._files) >= self.max_files:
+                    self._files.popitem(last = False)[1].close()
+            self._files[file_name] = f
+            f.write(self.format(record) + '\n')
+        except Exception:
+            self.handleError(record)
+    
+    def flush(self):
+        '''
+        
+        '''
+        
+        for f in self._files.values():
+            f.flush()
+    
+    def close(self):
+        '''
+        
+        '''
+        
+        for f in self._files.values():
+            f.close()
+        self._files.clear()
+        super(_TargetFileHandler, self).close()
+
+def SetLogContext(**context):
+    '''
+    Sets the context attached to the log records of this process while 
+    batch logging (see :py:func:`BatchLogging`) is active: the target `ID`,
+    the `season`, the pipeline `stage`, and the per-target `logfile`.
+    
+    :returns: The previous context.
+    
+    '''
+    
+    previous = dict(_log_context)
+    _log_context.update(context)
+    return previous
+
+class LogContext(object):
+    '''
+    A context manager that temporarily updates the log record context (see
+    :py:func:`SetLogContext`).
+    
+    '''
+    
+    def __init__(self, **context):
+        '''
+        
+        '''
+        
+        self.context = context
+    
+    def __enter__(self):
+        self.previous = SetLogContext(**self.context)
+        
+    def __exit__(self, type, value, traceback):
+        _log_context.clear()
+        _log_context.update(self.previous)
+
+def BatchLogging(queue = None, file_name = None, level = logging.INFO,
+                 screen_level = logging.WARNING, target_files = True):
+    '''
+    Initializes logging for batch runs, once per process. Instead of 
+    writing to files and to the screen, the root logger puts the records on
+    a queue, together with their context (see :py:func:`SetLogContext`), 
+    and returns immediately. The records are written by a background 
+    thread, which owns all the handlers, in the process that called this
+    function first. Other processes (e.g., the workers of a pool) should
+    call this function with the queue it returned, for instance as the pool
+    `initializer`. While batch logging is active, :py:func:`InitializeLogging`
+    only sets the record context, and never touches the handlers.
+    
+    :param queue: The :py:class:`multiprocessing.Queue` returned by the \
+           call in the parent process. Default :py:obj:`None`, in which \
+           case a new queue and writer thread are created.
+    :param str file_name: A log file for the records of all targets. \
+           Default :py:obj:`None`.
+    :param int level: The minimum level of the records. Default `INFO`.
+    :param int screen_level: The minimum level of the records printed to \
+           the screen (`stderr`). Default `WARNING`.
+    :param bool target_files: Also write the records of each target to its \
+           own log file? Default :py:obj:`True`.
+    
+    :returns: The queue.
+    
+    '''
+    
+    if BatchLoggingActive():
+        return _batch_logging['queue']
+    
+    # The writer
+    listener = None
+    if queue is None:
+        import multiprocessing
+        queue = multiprocessing.Queue(-1)
+        handlers = []
+        sh = logging.StreamHandler(sys.stderr)
+        sh.setLevel(screen_level)
+        sh.setFormatter(logging.Formatter(_batch_format, 
+                                          datefmt = "%m/%d/%y %H:%M:%S"))
+        handlers.append(sh)
+        if file_name is not None:
+            if not os.path.exists(os.path.dirname(os.path.abspath(file_name))):
+                os.makedirs(os.path.dirname(os.path.abspath(file_name)))
+            fh = logging.FileHandler(file_name)
+            fh.setFormatter(logging.Formatter(_batch_format, 
+                                              datefmt = "%m/%d/%y %H:%M:%S"))
+            handlers.append(fh)
+        if target_files:
+            handlers.append(_TargetFileHandler())
+        for handler in handlers:
+            handler.addFilter(_NoPILFilter())
+        listener = logging.handlers.QueueListener(queue, *handlers, 
+                                                  respect_handler_level = True)
+        listener.start()
+    
+    # The producer
+    root = logging.getLogger()
+    qh = logging.handlers.QueueHandler(queue)
+    qh.addFilter(_ContextFilter())
+    previous = (list(root.handlers), root.level)
+    root.handlers = [qh]
+    root.setLevel(level)
+    _batch_logging.clear()
+    _batch_logging.update(pid = os.getpid(), queue = queue, 
+                          listener = listener, previous = previous)
+    return queue
+
+def BatchLoggingActive():
+    '''
+    Returns :py:obj:`True` if batch logging is active in this process (see
+    :py:func:`BatchLogging`).
+    
+    '''
+    
+    return _batch_logging.get('pid') == os.getpid()
+
+def StopBatchLogging():
+    '''
+    Stops batch logging in this process (see :py:func:`BatchLogging`), 
+    writing out the records still on the queue if this process owns the 
+    writer thread, and restores the previous handlers of the root logger.
+    
+    '''
+    
+    if not BatchLoggingActive():
+        return
+    state = dict(_batch_logging)
+    _batch_logging.clear()
+    root = logging.getLogger()
+    root.handlers, level = state['previous']
+    root.setLevel(level)
+    if state['listener'] is not None:
+        state['listener'].stop()
+        for handler in state['listener'].handlers:
+            handler.close()
+
+atexit.register(StopBatchLogging)
+
+def InitializeLogging(file_name = None, quiet = False, pdb = False, 
+                      **context):
+    '''
+    A little routine to initialize the logging functionality. If batch 
+    logging is active in this process (see :py:func:`BatchLogging`), the
+    handlers are left alone, and `file_name` and the `context` are attached
+    to the log records instead (see :py:func:`SetLogContext`).
 
     :param str file_name: The name of the file to log to. \
            Default :py:obj:`None` (set internally by :py:mod:`everest`)
 
     '''
-  
+    
+    if BatchLoggingActive():
+        SetLogContext(logfile = file_name, stage = '-', **context)
+        return
+    
     # Initialize the logging
     root = logging.getLogger()
     root.handlers = []
@@ -102,4 +340,168 @@ def InitializeLogging(file_name = None, quiet = False, pdb = False):
     if pdb:
         sys.excepthook = _ExceptionHookPDB
     else:
-        sys.excepthook = _ExceptionHook
\ No newline at end of file
+        sys.excepthook = _ExceptionHook
+
+class _NoLimits(object):
+    '''
+    A stand-in for :py:class:`threadpoolctl.threadpool_limits` when it is 
+    not installed.
+    
+    '''
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        pass
+    
+    def restore_original_limits(self):
+        pass
+
+def BLASThreads(limit):
+    '''
+    Limits the number of threads used by the BLAS libraries to `limit`, 
+    either until the :py:meth:`restore_original_limits` method of the 
+    returned object is called or, if it is used as a context manager, for 
+    the duration of the block. This requires the optional 
+    :py:mod:`threadpoolctl` package, and is a no-op without it.
+    
+    '''
+    
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return _NoLimits()
+    return threadpool_limits(limits = limit, user_api = 'blas')
+
+def DefaultThreads():
+    '''
+    Returns the default number of threads for parallel computations: one 
+    per CPU, or just one in the (daemonic) worker processes of a pool, 
+    which are already one per CPU.
+    
+    '''
+    
+    import multiprocessing
+    if multiprocessing.current_process().daemon:
+        return 1
+    return multiprocessing.cpu_count()
+
+def Scatter(y, win = 13):
+    '''
+    Returns the scatter in parts per million of the light curve `y`, 
+    defined as the median standard deviation of consecutive chunks of 
+    `win` cadences, divided by the square root of `win`. For `K2` long 
+    cadence data, `win = 13` corresponds to the 6-hour CDPP. Non-finite 
+    values are ignored.
+    
+    :param ndarray y: The flux array.
+    :param int win: The number of cadences per chunk. Default `13`.
+    
+    '''
+    
+    y = np.asarray(y)
+    y = y[np.isfinite(y)]
+    nchunks = len(y) // win
+    if nchunks == 0:
+        return np.nan
+    y = y[:nchunks * win].reshape(nchunks, win) / np.median(y)
+    return 1.e6 * np.median(np.std(y, axis = 1)) / np.sqrt(win)
+
+def SaveArrays(file, meta, **arrays):
+    '''
+    Saves a set of arrays and a :py:obj:`dict` of metadata to a single 
+    binary file that can be memory-mapped by :py:func:`LoadArrays`. The file
+    consists of a short preamble, a JSON header with the metadata and the 
+    dtype, shape and offset of each array, and the raw array data, each 
+    array aligned to a 64-byte boundary. The file is written to a temporary
+    file first and then renamed.
+    
+    :param str file: The output file name.
+    :param dict meta: JSON-serializable metadata.
+    :param arrays: The arrays to save, as keyword arguments.
+    
+    '''
+    
+    # Lay out the arrays
+    arrays = dict([(name, np.ascontiguousarray(arr)) 
+                   for name, arr in arrays.items()])
+    layout = {}
+    offset = 0
+    for name in sorted(arrays):
+        layout[name] = dict(dtype = arrays[name].dtype.str, 
+                            shape = list(arrays[name].shape),
+                            offset = offset)
+        offset += -(-arrays[name].nbytes // _ARRAY_ALIGN) * _ARRAY_ALIGN
+    
+    # The header, padded so that the data starts on an aligned boundary
+    header = json.dumps(dict(meta = meta, arrays = layout)).encode('utf-8')
+    start = len(_ARRAY_MAGIC) + 8 + len(header)
+    start = -(-start // _ARRAY_ALIGN) * _ARRAY_ALIGN
+    header += b' ' * (start - len(_ARRAY_MAGIC) - 8 - len(header))
+    
+    # Write
+    if not os.path.exists(os.path.dirname(os.path.abspath(file))):
+        os.makedirs(os.path.dirname(os.path.abspath(file)))
+    with open(file + '.tmp', 'wb') as f:
+        f.write(_ARRAY_MAGIC)
+        f.write(struct.pack('<II', 1, len(header)))
+        f.write(header)
+        for name in sorted(arrays):
+            f.seek(start + layout[name]['offset'])
+            f.write(arrays[name].tobytes())
+        f.truncate(start + offset)
+    os.rename(file + '.tmp', file)
+
+def _ReadPreamble(f):
+    '''
+    Reads the preamble and header of an :py:obj:`everest3` array file.
+    
+    '''
+    
+    if f.read(len(_ARRAY_MAGIC)) != _ARRAY_MAGIC:
+        raise ValueError('Not an everest3 array file.')
+    version, length = struct.unpack('<II', f.read(8))
+    if version != 1:
+        raise ValueError('Unsupported everest3 array file version.')
+    return json.loads(f.read(length).decode('utf-8')), \
+           len(_ARRAY_MAGIC) + 8 + length
+
+def ReadHeader(file):
+    '''
+    Returns the metadata :py:obj:`dict` of a file written by 
+    :py:func:`SaveArrays`, reading only the header. This is the fast way
+    to scan many files for a single scalar quantity.
+    
+    '''
+    
+    with open(file, 'rb') as f:
+        return _ReadPreamble(f)[0]['meta']
+
+def LoadArrays(file, mmap = True):
+    '''
+    Loads a file written by :py:func:`SaveArrays`.
+    
+    :param str file: The file name.
+    :param bool mmap: Memory-map the arrays (read-only)? Otherwise they \
+           are read into memory. Default :py:obj:`True`.
+    
+    :returns: The metadata :py:obj:`dict` and a :py:obj:`dict` of arrays.
+    
+    '''
+    
+    with open(file, 'rb') as f:
+        header, start = _ReadPreamble(f)
+        arrays = {}
+        for name, info in header['arrays'].items():
+            dtype = np.dtype(info['dtype'])
+            shape = tuple(info['shape'])
+            if (not mmap) or (int(np.prod(shape)) == 0):
+                f.seek(start + info['offset'])
+                arrays[name] = np.fromfile(f, dtype = dtype, 
+                               count = int(np.prod(shape))).reshape(shape)
+            else:
+                arrays[name] = np.memmap(file, dtype = dtype, mode = 'r', 
+                                         offset = start + info['offset'], 
+                                         shape = shape)
+    return header['meta'], arrays
\ No newline at end of file
@@ -45,6 +45,11 @@ setup(name = 'everest3',
                           'kplr',
                           'astropy'
                          ],
+      entry_points = {
+                      'console_scripts': [
+                                          'everest3 = everest3.cli:main',
+                                         ],
+                     },
       include_package_data = True,
       zip_safe = False,
       test_suite='nose.collector',
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+synthetic.py
+------------
+
+Synthetic, offline targets for the tests. This module is also a mission
+module for :py:mod:`everest3.batch` and friends (`mission = 'synthetic'`).
+The targets keep their files in a subdirectory of :py:data:`path`, which
+the tests that run them point at a fresh temporary directory.
+
+'''
+
+from __future__ import division, print_function, absolute_import, unicode_literals
+from everest3.containers import TimeSeries
+from everest3 import containers
+import numpy as np
+import contextlib
+import tempfile
+import os
+
+#: The directory of the targets' files. Defaults to a temporary directory
+#: created on first use, so tests that run targets in worker processes 
+#: must set it first
+path = None
+
+@contextlib.contextmanager
+def k2_sandbox():
+    '''
+    Points the :py:mod:`everest3.k2` data directories at fresh temporary 
+    directories, and restores them (and the archive URL) on exit.
+    
+    '''
+    
+    from everest3 import k2
+    saved = k2.KPLR_ROOT, k2.path, k2.archive_url
+    k2.KPLR_ROOT = tempfile.mkdtemp()
+    k2.path = tempfile.mkdtemp()
+    try:
+        yield
+    finally:
+        k2.KPLR_ROOT, k2.path, k2.archive_url = saved
+
+def stamp(ncads = 100, ncols = 5, nrows = 6):
+    '''
+    A synthetic postage stamp with a few NaN pixels, and an aperture.
+    
+    '''
+    
+    np.random.seed(1)
+    flux = np.random.randn(ncads, ncols, nrows) + 100.
+    flux[3, 1, 2] = np.nan
+    error = np.abs(np.random.randn(ncads, ncols, nrows))
+    aperture = np.zeros((ncols, nrows), dtype = 'int32')
+    aperture[1:4, 2:5] = 1
+    return TimeSeries(np.arange(ncads, dtype = 'float64'), flux, error), \
+           aperture
+
+def jitter_stamp(ncads = 600, ncols = 6, nrows = 6, seed = 3):
+    '''
+    A synthetic postage stamp of a star whose PSF jitters across the
+    pixels, plus a little white noise.
+    
+    '''
+    
+    np.random.seed(seed)
+    time = np.linspace(0, 30, ncads)
+    x0 = 2.5 + 0.3 * np.sin(2 * np.pi * time / 6.) + \
+         0.05 * np.random.randn(ncads)
+    y0 = 2.5 + 0.2 * np.cos(2 * np.pi * time / 4.)
+    i, j = np.meshgrid(np.arange(ncols), np.arange(nrows), indexing = 'ij')
+    psf = np.exp(-((i[None] - x0[:, None, None]) ** 2 +
+                   (j[None] - y0[:, None, None]) ** 2) / (2 * 0.8 ** 2))
+    flux = 1e6 * psf / (2 * np.pi * 0.8 ** 2) + 5.
+    error = np.sqrt(flux)
+    flux += error * np.random.randn(*flux.shape)
+    return TimeSeries(time, flux, error)
+
+class Mission(object):
+    '''
+    A stand-in for the attributes of a mission module.
+    
+    '''
+    
+    name = 'Synthetic'
+    ID_str = 'ID'
+    mag_str = 'mag'
+    time_unit = 'days'
+    flux_unit = 'counts'
+
+class StampTarget(containers.Target):
+    '''
+    A minimal offline target backed by a synthetic postage stamp.
+    
+    '''
+    
+    mission = Mission
+    
+    @property
+    def path(self):
+        global path
+        if path is None:
+            path = tempfile.mkdtemp()
+        return os.path.join(path, str(self.ID))
+    
+    def get_raw_data(self):
+        self.raw, _ = stamp()
+        self.mag = np.nan
+    
+    def get_aperture(self):
+        self.aperture = stamp()[1]
+
+class JitterTarget(StampTarget):
+    '''
+    A synthetic target with pointing jitter systematics.
+    
+    '''
+    
+    def get_raw_data(self):
+        self.raw = jitter_stamp()
+        self.mag = np.nan
+    
+    def get_aperture(self):
+        self.aperture = np.zeros((6, 6), dtype = 'int32')
+        self.aperture[2:4, 1:5] = 1
+
+class Target(JitterTarget):
+    '''
+    The target of the mission. Target `13` always fails.
+    
+    '''
+    
+    def get_raw_data(self):
+        if self.ID == 13:
+            raise ValueError('Unlucky target.')
+        super(Target, self).get_raw_data()
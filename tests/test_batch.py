@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+test_batch.py
+-------------
+
+'''
+
+from __future__ import division, print_function, absolute_import, unicode_literals
+from everest3 import batch
+import synthetic
+import subprocess
+import tempfile
+import sys
+import os
+
+def test_batch():
+    '''
+    Test the batch runner and its ledger
+    
+    '''
+    
+    synthetic.path = tempfile.mkdtemp()
+    file = os.path.join(tempfile.mkdtemp(), 'ledger.db')
+    summary = batch.run(ids = [10, 11, 12, 13], mission = 'synthetic', 
+                        workers = 2, ledger = file, until = 'model', 
+                        save = False, order = 2)
+    assert summary == {'done': 3, 'failed': 1}
+    ledger = batch.Ledger(file)
+    jobs = dict([(job['ID'], job) for job in ledger.jobs()])
+    assert jobs[13]['attempts'] == 3
+    assert 'Unlucky target' in jobs[13]['error']
+    assert all([jobs[ID]['time'] > 0 for ID in (10, 11, 12)])
+    
+    # An interrupted job is resumed; done jobs are skipped
+    proc = subprocess.Popen([sys.executable, '-c', 'pass'])
+    proc.wait()
+    with ledger.db as db:
+        db.execute('UPDATE jobs SET status = ?, pid = ? WHERE id = 12', 
+                   ('running', proc.pid))
+    ledger.add('synthetic', [14])
+    summary = batch.run(ids = [10, 11, 12, 14], mission = 'synthetic', 
+                        workers = 1, ledger = ledger, until = 'model', 
+                        save = False)
+    assert summary == {'done': 4, 'failed': 1}
+    jobs = dict([(job['ID'], job) for job in ledger.jobs()])
+    assert jobs[10]['attempts'] == 1
+    assert jobs[12]['attempts'] == 2
+    
+    # A job that went stale on its last attempt has failed
+    with ledger.db as db:
+        db.execute('UPDATE jobs SET status = ?, attempts = 3, started = 0 '
+                   'WHERE id = 11', ('running',))
+    assert ledger.claim() is None
+    jobs = dict([(job['ID'], job) for job in ledger.jobs()])
+    assert jobs[11]['status'] == 'failed'
+    assert 'worker died' in jobs[11]['error']
+    
+    # Claims are exclusive
+    assert ledger.claim() is None
+    ledger.add('synthetic', [15, 16])
+    assert ledger.claim()[1] == 15
+    assert ledger.claim()[1] == 16
+    assert ledger.claim() is None
+
+def test_resume_model():
+    '''
+    Test that resumed targets reuse the model checkpoints
+    
+    '''
+    
+    import json
+    synthetic.path = tempfile.mkdtemp()
+    path = tempfile.mkdtemp()
+    file = os.path.join(path, 'metrics.jsonl')
+    ledger = batch.Ledger(os.path.join(path, 'ledger.db'))
+    kwargs = dict(mission = 'synthetic', workers = 1, ledger = ledger, 
+                  until = 'model', save = False, order = 2, 
+                  metrics_file = file)
+    assert batch.run(ids = [40], **kwargs) == {'done': 1}
+    ledger.reset('synthetic', [40])
+    assert batch.run(ids = [40], max_memory = 2 ** 20, **kwargs) == \
+           {'done': 1}
+    with open(file, 'r') as f:
+        stages = [json.loads(line)['stage'] for line in f]
+    assert stages.count('model') == 1
+    
+    # Different arguments re-fit the model
+    ledger.reset('synthetic', [40])
+    kwargs['order'] = 1
+    assert batch.run(ids = [40], **kwargs) == {'done': 1}
+    with open(file, 'r') as f:
+        stages = [json.loads(line)['stage'] for line in f]
+    assert stages.count('model') == 2
+
+def test_logging():
+    '''
+    Test the batch logging of the runner
+    
+    '''
+    
+    import logging
+    from everest3 import utils
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    synthetic.path = tempfile.mkdtemp()
+    path = tempfile.mkdtemp()
+    file = os.path.join(path, 'batch.log')
+    summary = batch.run(ids = [20, 21, 13], mission = 'synthetic', 
+                        workers = 2, ledger = os.path.join(path, 'ledger.db'),
+                        until = 'model', save = False, order = 2, 
+                        max_attempts = 1, log_file = file)
+    assert summary == {'done': 2, 'failed': 1}
+    
+    # The handlers are restored
+    assert not utils.BatchLoggingActive()
+    assert root.handlers == handlers
+    
+    # The records of the workers are tagged with their target and stage...
+    with open(file, 'r') as f:
+        lines = f.readlines()
+    assert any([' 20 ' in line and ' model ' in line for line in lines])
+    assert any([' 13 ' in line and 'Target 13 failed' in line 
+                for line in lines])
+    
+    # ...and also written to the log files of the targets
+    for ID in (20, 21):
+        with open(os.path.join(synthetic.path, str(ID), '%d.log' % ID)) as f:
+            text = f.read()
+        assert 'Initializing everest3' in text
+        assert (' 2%d ' % (1 - ID % 2)) not in text
+
+def test_profile():
+    '''
+    Test the metrics and profiles of the batch runner
+    
+    '''
+    
+    import json
+    synthetic.path = tempfile.mkdtemp()
+    path = tempfile.mkdtemp()
+    file = os.path.join(path, 'metrics.jsonl')
+    summary = batch.run(ids = [30, 31, 32], mission = 'synthetic', 
+                        workers = 2, ledger = os.path.join(path, 'ledger.db'),
+                        until = 'design', save = False, metrics_file = file,
+                        profile = 2)
+    assert summary == {'done': 3}
+    with open(file, 'r') as f:
+        records = [json.loads(line) for line in f]
+    assert sorted([(r['ID'], r['stage']) for r in records]) == \
+           [(ID, stage) for ID in (30, 31, 32) 
+            for stage in ('aperture', 'design', 'raw')]
+    
+    # Only the slowest targets' profiles are kept
+    profiles = os.listdir(os.path.join(path, 'ledger-profiles'))
+    assert len(profiles) == 2
+    assert all([p.endswith('.prof') for p in profiles])
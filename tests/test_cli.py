@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+test_cli.py
+-----------
+
+'''
+
+from __future__ import division, print_function, absolute_import, unicode_literals
+from everest3 import cli, batch
+import synthetic
+import tempfile
+import os
+
+def test_cli():
+    '''
+    Test the command line interface
+    
+    '''
+    
+    dir = tempfile.mkdtemp()
+    synthetic.path = tempfile.mkdtemp()
+    file = os.path.join(dir, 'ledger.db')
+    ids = os.path.join(dir, 'ids.txt')
+    with open(ids, 'w') as f:
+        print('# EPIC ID', file = f)
+        print('11,foo', file = f)
+        print('12', file = f)
+    args = ['--mission', 'synthetic', '--ledger', file, '-j', '1',
+            '--order', '2']
+    assert cli.main(['detrend', '10', ids] + args) == 0
+    assert batch.Ledger(file).summary() == {'done': 3}
+    assert cli.main(['detrend', '13'] + args) == 1
+    
+    # Completed targets are skipped unless clobbered (target 13 is still
+    # failed, hence the exit codes)
+    finished = lambda: dict([(j['ID'], j['finished']) for j in 
+                             batch.Ledger(file).jobs()])[10]
+    t = finished()
+    assert cli.main(['detrend', '10'] + args) == 1
+    assert finished() == t
+    assert cli.main(['detrend', '10', '--clobber'] + args) == 1
+    assert finished() > t
+    assert cli.main(['status', '--ledger', file, '--failed']) == 0
+    assert cli.main(['report', '10', '11', '--mission', 'synthetic', '-o', 
+                     dir]) == 0
+    assert os.path.exists(os.path.join(dir, 'index.html'))
+    
+    # Usage errors exit with code 2; errors at run time propagate
+    try:
+        cli.main(['detrend', 'foo'] + args)
+    except SystemExit as e:
+        assert e.code == 2
+    else:
+        raise AssertionError('Expected a usage error.')
+    run = batch.run
+    def broken(**kwargs):
+        raise ValueError('Broken.')
+    batch.run = broken
+    try:
+        cli.main(['detrend', '10'] + args)
+    except ValueError as e:
+        assert str(e) == 'Broken.'
+    else:
+        raise AssertionError('Expected a ValueError.')
+    finally:
+        batch.run = run
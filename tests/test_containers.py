@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+test_containers.py
+------------------
+
+'''
+
+from __future__ import division, print_function, absolute_import, unicode_literals
+from everest3.containers import TimeSeries
+from everest3.utils import ReadHeader
+from multiprocessing import Pool
+from synthetic import stamp, StampTarget
+import numpy as np
+import tempfile
+import pickle
+import gc
+import os
+
+def test_pixel_flux():
+    '''
+    Test the vectorized, cached aperture gather
+    
+    '''
+    
+    ts, aperture = stamp()
+    ap = np.where(aperture & 1)
+    expected = np.array([p[ap] for p in ts.flux])
+    assert np.array_equal(ts.pixel_flux(aperture), expected, equal_nan = True)
+    assert ts.pixel_flux(aperture) is ts.pixel_flux(aperture.copy())
+    assert ts.pixel_flux().shape == (ts.ncads, ts.ncols * ts.nrows)
+    
+    # Modifying the aperture in place yields a new matrix
+    aperture[0, 0] = 1
+    assert ts.pixel_flux(aperture).shape == (ts.ncads, 10)
+    
+    # Reassigning the flux invalidates the cache
+    ts.flux = ts.flux + 1
+    assert np.allclose(ts.pixel_flux(aperture)[:, 1:], expected[:, :] + 1, 
+                       equal_nan = True)
+    assert np.allclose(ts.pixel_error(aperture)[:, 1:], 
+                       np.array([p[ap] for p in ts.error]))
+
+def test_sap_fluxes():
+    '''
+    Test the batched SAP flux of many apertures
+    
+    '''
+    
+    ts, aperture = stamp()
+    ts.error[5, 2, 3] = np.nan
+    apertures = np.random.randint(0, 2, (20, ts.ncols, ts.nrows))
+    apertures[0] = aperture
+    flux, error = ts.sap_fluxes(apertures)
+    assert flux.shape == error.shape == (ts.ncads, 20)
+    for k, ap in enumerate(apertures):
+        assert np.allclose(flux[:, k], ts.sap_flux(ap))
+        assert np.allclose(error[:, k], ts.sap_error(ap))
+
+def test_target_cache():
+    '''
+    Test the memoized light curve products on the target
+    
+    '''
+    
+    star = StampTarget(1, quiet = True, checkpoint = False)
+    flux = star.flux
+    hits = star.cache_info['hits']
+    assert star.flux is flux
+    assert star.cache_info['hits'] == hits + 1
+    assert np.allclose(star.sap_flux, np.nansum(star.raw.pixel_flux(
+                       star.aperture), axis = 1))
+    
+    # Reassigning the model only invalidates the de-trended flux
+    misses = star.cache_info['misses']
+    star.model = np.ones_like(star.time)
+    assert np.allclose(star.flux, star.sap_flux - 1)
+    assert star.cache_info['misses'] == misses + 1
+    sap = star.sap_flux
+    assert star.cache_info['misses'] == misses + 1
+    
+    # Reassigning the aperture invalidates everything
+    star.aperture = np.ones_like(star.aperture)
+    assert star.sap_flux is not sap
+    assert star.norm_pixel_flux.shape == (star.raw.ncads, 30)
+
+def test_memmap():
+    '''
+    Test the lazily loaded, memory-mapped time series
+    
+    '''
+    
+    ts, aperture = stamp()
+    path = tempfile.mkdtemp()
+    ts.to_npy(path)
+    mm = TimeSeries.from_npy(path)
+    assert (mm.ncads, mm.ncols, mm.nrows) == (ts.ncads, ts.ncols, ts.nrows)
+    assert isinstance(mm._flux, str)
+    assert np.allclose(mm.sap_flux(aperture), ts.sap_flux(aperture))
+    assert isinstance(mm.flux, np.memmap)
+    assert np.array_equal(mm.error, ts.error)
+
+def _worker(args):
+    '''
+    Returns the SAP flux of a shared time series in a worker process, and
+    whether its flux array is attached to the parent's memory block.
+    
+    '''
+    
+    ts, aperture = args
+    return ts.sap_flux(aperture), ts._flux.name, ts.flux.flags.writeable
+
+def test_shared():
+    '''
+    Test the shared memory time series
+    
+    '''
+    
+    ts, aperture = stamp()
+    sap = ts.sap_flux(aperture)
+    ts.share()
+    assert ts.shared and np.array_equal(ts.sap_flux(aperture), sap)
+    name = ts._flux.name
+    assert len(pickle.dumps(ts)) < ts.flux.nbytes // 10
+    
+    # The workers attach to the same memory, read-only
+    pool = Pool(2)
+    try:
+        for res, n, writeable in pool.map(_worker, [(ts, aperture)] * 4):
+            assert np.array_equal(res, sap) and (n == name) and not writeable
+    finally:
+        pool.close()
+        pool.join()
+    
+    # The blocks are destroyed with the arrays, but existing views survive
+    flux = ts.flux
+    ts.flux = np.array(flux)
+    gc.collect()
+    if os.path.exists('/dev/shm'):
+        assert not os.path.exists(os.path.join('/dev/shm', name.lstrip('/')))
+    assert np.array_equal(flux, ts.flux, equal_nan = True)
+    ts.unshare()
+    assert not ts.shared
+
+def test_pipeline():
+    '''
+    Test the lazy, checkpointed de-trending pipeline
+    
+    '''
+    
+    class Star(StampTarget):
+        path = tempfile.mkdtemp()
+        calls = []
+        def get_aperture(self):
+            self.calls.append('aperture')
+            super(Star, self).get_aperture()
+    
+    # Nothing runs until it's needed
+    star = Star(2, quiet = True)
+    assert star.completed == ()
+    star.run(until = 'model')
+    assert star.completed == ('raw', 'aperture', 'design', 'model')
+    assert Star.calls == ['aperture']
+    
+    weights = star.weights
+    history = star.clip_history
+    
+    # A new instance resumes from the checkpoints, with the results of the
+    # fit that aren't part of the model
+    star = Star(2, quiet = True, stages = ('model',))
+    assert star.completed == ('model',)
+    assert np.array_equal(star.weights, weights)
+    assert star.clip_history == history
+    assert np.array_equal(star.aperture, stamp()[1])
+    assert Star.calls == ['aperture']
+    
+    # Forcing a re-run recomputes (and re-checkpoints) everything
+    star.run(until = 'model', force = True)
+    assert Star.calls == ['aperture', 'aperture']
+    assert star._read_manifest() == ['aperture', 'model']
+    
+    # The model is keyed on the de-trending arguments (except for those 
+    # that don't change it)
+    star = Star(2, quiet = True)
+    star.run(until = 'model', max_memory = 2 ** 20)
+    assert star.completed == ('model',)
+    star.run(until = 'model', order = 2)
+    assert star.completed == ('raw', 'aperture', 'design', 'model')
+    assert Star.calls == ['aperture', 'aperture']
+    star = Star(2, quiet = True)
+    star.run(until = 'model', order = 2)
+    assert star.completed == ('model',)
+    star = Star(2, quiet = True, stages = ('model',))
+    assert star.completed == ('raw', 'aperture', 'design', 'model')
+    assert Star.calls == ['aperture', 'aperture']
+    
+    # Checkpoints are discarded when the raw data change
+    class Changed(Star):
+        raw_fingerprint = 'changed'
+    star = Changed(2, quiet = True, stages = ('model',))
+    assert star.completed == ('raw', 'aperture', 'design', 'model')
+    assert Star.calls == ['aperture', 'aperture', 'aperture']
+    assert star._load_manifest()['raw'] == 'changed'
+
+def test_downstream():
+    '''
+    Test that changing a stage invalidates the later ones
+    
+    '''
+    
+    star = StampTarget(6, quiet = True, checkpoint = False)
+    star.run(until = 'model')
+    assert star.design.shape[1] == 9
+    
+    # A new aperture means a new design matrix and model
+    star.aperture = np.ones_like(star.aperture)
+    assert star.completed == ('raw', 'aperture')
+    assert not hasattr(star, '_pld_segments')
+    star.run(until = 'model')
+    assert star.design.shape[1] == 30
+    assert np.isfinite(star.scatter)
+    
+    # Re-running the model means a new DVS
+    star.run(until = 'dvs')
+    star.detrend(order = 1)
+    assert 'dvs' not in star.completed
+    os.utime(star.dvsfile, (0, 0))
+    star.run(until = 'dvs')
+    assert os.path.getmtime(star.dvsfile) > 0
+
+def test_save_load():
+    '''
+    Test saving and loading the de-trending results
+    
+    '''
+    
+    class Star(StampTarget):
+        def get_raw_data(self):
+            raise Exception('The raw data should not be accessed.')
+        @property
+        def season(self):
+            if self._season is None:
+                raise Exception('The season should not be looked up.')
+            return self._season
+        @season.setter
+        def season(self, value):
+            self._season = value
+    
+    star = StampTarget(4, season = 3, quiet = True, checkpoint = False)
+    star.model = np.linspace(-1, 1, star.raw.ncads)
+    star.weights = np.arange(5.)
+    star.mag = None
+    star.save()
+    assert ReadHeader(star.resfile)['scatter'] == star.scatter
+    assert np.isnan(ReadHeader(star.resfile)['mag'])
+    
+    loaded = Star.load(4, 3, quiet = True)
+    assert loaded.season == 3
+    assert isinstance(loaded.model, np.memmap)
+    assert np.array_equal(loaded.flux, star.flux, equal_nan = True)
+    assert np.array_equal(loaded.weights, star.weights)
+    assert loaded.raw_scatter == star.raw_scatter
+
+def test_metrics():
+    '''
+    Test the per-stage instrumentation of the pipeline
+    
+    '''
+    
+    import json
+    star = StampTarget(5, quiet = True, checkpoint = False)
+    star.metrics_file = os.path.join(tempfile.mkdtemp(), 'metrics.jsonl')
+    star.trace_memory = True
+    star.profile = True
+    star.run(until = 'design')
+    assert sorted(star.metrics) == ['aperture', 'design', 'raw']
+    raw = star.metrics['raw']
+    assert raw['wall'] >= 0 and raw['cpu'] >= 0 and not raw['failed']
+    assert raw['arrays']['flux'] == star.raw.flux.nbytes
+    assert star.metrics['design']['arrays']['design'] == star.design.nbytes
+    assert star.metrics['design']['traced_peak'] > 0
+    assert star.profiler.getstats()
+    
+    # The resident memory before and after each stage (on Linux)
+    if os.path.exists('/proc/self/statm'):
+        assert raw['rss_start'] > 0 and raw['rss_end'] > 0
+        assert np.isclose(raw['rss_delta'], raw['rss_end'] - raw['rss_start'])
+    
+    # One JSON record per stage
+    with open(star.metrics_file, 'r') as f:
+        records = [json.loads(line) for line in f]
+    assert [r['stage'] for r in records] == ['raw', 'aperture', 'design']
+    assert all([r['ID'] == 5 for r in records])
+    
+    # Switched off at runtime
+    design = star.metrics['design']
+    star.record_metrics = False
+    star.run(until = 'design', force = True)
+    assert star.metrics['design'] is design
+    with open(star.metrics_file, 'r') as f:
+        assert len(f.readlines()) == 3
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+test_dvs.py
+-----------
+
+'''
+
+from __future__ import division, print_function, absolute_import, unicode_literals
+from everest3 import dvs, batch
+import synthetic
+from matplotlib._pylab_helpers import Gcf
+import numpy as np
+import tempfile
+import os
+
+def test_template():
+    '''
+    Test the reusable DVS page template
+    
+    '''
+    
+    nfigs = Gcf.get_num_fig_managers()
+    page = dvs.template()
+    naxes = len(page.fig.axes)
+    page.raw.plot(np.arange(10), np.arange(10))
+    page.fig.add_axes([0.1, 0.1, 0.1, 0.1])
+    page.fig.text(0.5, 0.5, 'Hello')
+    assert dvs.template() is page
+    assert len(page.fig.axes) == naxes and not len(page.fig.texts)
+    assert not len(page.raw.lines)
+    assert not page.header.axison
+    assert Gcf.get_num_fig_managers() == nfigs
+
+def test_decimate():
+    '''
+    Test the light curve decimation
+    
+    '''
+    
+    np.random.seed(3)
+    t = np.linspace(0, 10, 50000)
+    y = np.random.randn(len(t))
+    y[123] = 50.
+    y[(t > 5) & (t < 5.05)] -= 10.
+    y[17] = np.nan
+    
+    # One point per occupied pixel: the same pixels are covered
+    inds = dvs.decimate(t, y, 200, 100)
+    assert len(inds) < 0.2 * len(t) and (123 in inds) and (17 not in inds)
+    good = np.flatnonzero(np.isfinite(y))
+    lo, hi = np.min(y[good]), np.max(y[good])
+    pixels = lambda i: set(zip((t[i] * (200 / 10.)).astype(int).clip(0, 199),
+                               ((y[i] - lo) * (100 / (hi - lo)))
+                               .astype(int).clip(0, 99)))
+    assert pixels(inds) == pixels(good)
+    
+    # The extrema of each column
+    inds = dvs.decimate(t, y, 200)
+    assert len(inds) <= 400 and (123 in inds)
+    assert np.sum((t[inds] > 5) & (t[inds] < 5.05)) >= 2
+    
+    # Short light curves are left alone
+    assert len(dvs.decimate(t[:100], y[:100], 200)) == 99
+
+def test_render():
+    '''
+    Test the parallel DVS rendering
+    
+    '''
+    
+    synthetic.path = tempfile.mkdtemp()
+    batch.run(ids = [10, 11], mission = 'synthetic', workers = 1, 
+              ledger = os.path.join(synthetic.path, 'ledger.db'), 
+              until = 'model', order = 2)
+    times = dvs.render([10, 11, 12], mission = 'synthetic', workers = 2)
+    assert times[10] > 0 and times[11] > 0
+    assert os.path.exists(synthetic.Target(10, quiet = True).dvsfile)
+    
+    # Targets that weren't de-trended and saved aren't run
+    assert times[12] is None
+    assert not os.path.exists(os.path.join(synthetic.path, '12', 'stages'))
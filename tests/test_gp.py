@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+test_gp.py
+----------
+
+'''
+
+from __future__ import division, print_function, absolute_import, unicode_literals
+from everest3 import gp
+import numpy as np
+
+def test_factor():
+    '''
+    Test the semiseparable factorization against a dense one
+    
+    '''
+    
+    np.random.seed(1)
+    t = np.sort(np.random.uniform(0, 10, 300))
+    var = np.random.uniform(0.1, 0.3, 300)
+    kernel = gp.Kernel(gp.ExpTerm(1., 0.5), gp.Matern32Term(0.7, 2.))
+    C = kernel(t[:, None] - t[None, :]) + np.diag(var)
+    factor = gp.Factor(kernel, t, var)
+    y = np.random.randn(300, 3)
+    assert np.allclose(factor.log_det, np.linalg.slogdet(C)[1])
+    assert np.allclose(factor.solve(y), np.linalg.solve(C, y))
+    assert np.allclose(factor.solve(y[:, 0]), np.linalg.solve(C, y[:, 0]))
+    
+    # Whitening, in one go or in chunks
+    z, _ = factor.whiten(y)
+    assert np.allclose(np.dot(z.T, z), np.dot(y.T, np.linalg.solve(C, y)))
+    z1, state = factor.whiten(y[:120])
+    z2, _ = factor.whiten(y[120:], state)
+    assert np.allclose(np.vstack([z1, z2]), z)
+    
+    # Small blocks, and chunks that start and end inside them
+    small = gp.Factor(kernel, t, var, block_size = 7)
+    assert np.allclose(small.log_det, factor.log_det)
+    assert np.allclose(small.solve(y), np.linalg.solve(C, y))
+    chunks, state = [], None
+    for a, b in [(0, 3), (3, 5), (5, 40), (40, 41), (41, 300)]:
+        zi, state = small.whiten(y[a:b], state)
+        chunks.append(zi)
+    assert np.allclose(np.vstack(chunks), z)
+    
+    # Not positive definite
+    try:
+        gp.Factor(kernel, t, -var - 10.)
+    except np.linalg.LinAlgError:
+        pass
+    else:
+        raise AssertionError('Expected a LinAlgError.')
+    
+    # The parameters
+    kernel.log_params = kernel.log_params + 1
+    assert np.allclose(np.exp(kernel.terms[1].log_params), [0.7 * np.e, 
+                                                            2. * np.e])
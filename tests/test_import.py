@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+test_import.py
+--------------
+
+'''
+
+from __future__ import division, print_function, absolute_import, unicode_literals
+import subprocess
+import tempfile
+import sys
+import os
+
+def test_import():
+    '''
+    Test that importing everest3 is lazy and free of side effects
+    
+    '''
+    
+    data = os.path.join(tempfile.mkdtemp(), 'everest3')
+    env = dict(os.environ, EVEREST3_DATA_DIR = data)
+    code = "import sys, everest3, everest3.k2, everest3.containers; " \
+           "print(' '.join(sorted(sys.modules)))"
+    modules = subprocess.check_output([sys.executable, '-c', code], 
+                                      env = env).decode().split()
+    for module in ['matplotlib', 'kplr', 'astropy', 'pyfits', 'pdb']:
+        assert module not in modules, \
+               "`%s` was imported by `import everest3`." % module
+    assert not os.path.exists(data)
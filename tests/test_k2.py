@@ -8,6 +8,18 @@ test_k2.py
 
 from __future__ import division, print_function, absolute_import, unicode_literals
 import everest3
+import numpy as np
+import astropy.io.fits as fits
+from synthetic import k2_sandbox
+from six.moves.BaseHTTPServer import HTTPServer
+from six.moves.SimpleHTTPServer import SimpleHTTPRequestHandler
+from six.moves.socketserver import ThreadingMixIn
+import threading
+import tempfile
+import os
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
 
 def test_k2():
     '''
@@ -17,4 +29,163 @@ def test_k2():
     
     star = everest3.k2.Target(205071984)
     star.detrend()
-    star.plot_dvs()
\ No newline at end of file
+    star.plot_dvs()
+
+
+def _fake_tpf(root, ID, campaign, ncads = 50, ncols = 4, nrows = 5, 
+              star = 0.):
+    '''
+    Writes a minimal synthetic `K2` target pixel file under `root`, with
+    a star of total flux `star` jittering about the center of the stamp.
+    
+    '''
+    
+    file = os.path.join(root, 'data', 'k2', 'target_pixel_files', str(ID), 
+                        'ktwo%09d-c%02d_lpd-targ.fits.gz' % (ID, campaign))
+    if not os.path.exists(os.path.dirname(file)):
+        os.makedirs(os.path.dirname(file))
+    np.random.seed(ID % 1000)
+    i, j = np.meshgrid(np.arange(ncols), np.arange(nrows), indexing = 'ij')
+    x0 = (ncols - 1) / 2. + 0.3 * np.random.randn(ncads, 1, 1)
+    y0 = (nrows - 1) / 2. + 0.3 * np.random.randn(ncads, 1, 1)
+    psf = star / (2 * np.pi) * np.exp(-((i - x0) ** 2 + (j - y0) ** 2) / 2.)
+    cols = [fits.Column(name = 'TIME', format = 'D', 
+                        array = np.arange(ncads) * 0.02),
+            fits.Column(name = 'FLUX', format = '%dE' % (ncols * nrows), 
+                        dim = '(%d,%d)' % (nrows, ncols),
+                        array = 100 + psf + 
+                                np.random.randn(ncads, ncols, nrows)),
+            fits.Column(name = 'FLUX_ERR', format = '%dE' % (ncols * nrows),
+                        dim = '(%d,%d)' % (nrows, ncols),
+                        array = np.ones((ncads, ncols, nrows))),
+            fits.Column(name = 'QUALITY', format = 'J', 
+                        array = np.zeros(ncads, dtype = 'int32'))]
+    primary = fits.PrimaryHDU()
+    primary.header['KEPMAG'] = 12.5
+    fits.HDUList([primary, fits.BinTableHDU.from_columns(cols)]) \
+        .writeto(file, overwrite = True)
+    return file
+
+def test_raw_cache():
+    '''
+    Test the processed raw data cache
+    
+    '''
+    
+    with k2_sandbox():
+        tpf = _fake_tpf(everest3.k2.KPLR_ROOT, 201000001, 1)
+        star = everest3.k2.Target(201000001, season = 1, quiet = True)
+        assert star.raw.flux.shape == (50, 4, 5)
+        assert star.mag == 12.5
+        assert os.path.exists(os.path.join(star.raw_cache, 'meta.json'))
+        
+        # The second load comes straight from the cache
+        mtime = os.path.getmtime(os.path.join(star.raw_cache, 'flux.npy'))
+        star = everest3.k2.Target(201000001, season = 1, quiet = True)
+        assert isinstance(star.raw.flux, np.memmap)
+        assert mtime == os.path.getmtime(os.path.join(star.raw_cache, 
+                                                      'flux.npy'))
+        star.run(until = 'aperture')
+        star = everest3.k2.Target(201000001, season = 1, quiet = True,
+                                  stages = ('aperture',))
+        assert star.completed == ('aperture',)
+        
+        # A modified TPF triggers a rebuild, and invalidates the checkpoints
+        _fake_tpf(everest3.k2.KPLR_ROOT, 201000001, 1, ncads = 60)
+        star = everest3.k2.Target(201000001, season = 1, quiet = True,
+                                  stages = ('aperture',))
+        assert star.completed == ('raw', 'aperture')
+        assert star.raw.ncads == 60
+        star = everest3.k2.Target(201000001, season = 1, quiet = True,
+                                  stages = ('aperture',))
+        assert star.completed == ('aperture',)
+
+def test_aperture():
+    '''
+    Test the optimal aperture search
+    
+    '''
+    
+    with k2_sandbox():
+        _fake_tpf(everest3.k2.KPLR_ROOT, 201000003, 1, ncads = 200, 
+                  ncols = 9, nrows = 10, star = 1e5)
+        star = everest3.k2.Target(201000003, season = 1, quiet = True)
+        image = np.median(star.raw.flux, axis = 0)
+        apertures = everest3.k2.candidate_apertures(image)
+        assert len(apertures) > 2
+        assert all([ap[4, 4] or ap[4, 5] for ap in apertures])
+        
+        # The best candidate has the lowest scatter
+        aperture = star.aperture
+        assert 1 < aperture.sum() < 90
+        scatter = lambda ap: everest3.utils.Scatter(star.raw.sap_flux(ap))
+        assert np.isclose(scatter(aperture), 
+                          min([scatter(ap) for ap in apertures]))
+
+def test_campaign_index():
+    '''
+    Test the offline EPIC-to-campaign index
+    
+    '''
+    
+    with k2_sandbox():
+        _fake_tpf(everest3.k2.KPLR_ROOT, 201000002, 1)
+        _fake_tpf(everest3.k2.KPLR_ROOT, 201000002, 10)
+        target_list = os.path.join(everest3.k2.path, 'K2Campaign2targets.csv')
+        with open(target_list, 'w') as f:
+            f.write('EPIC ID, RA (J2000) [deg], Dec (J2000) [deg], mag\n')
+            f.write('204000003, 246.1, -22.4, 13.2\n')
+        assert everest3.k2.build_index(target_list, campaign = 2) == 3
+        assert everest3.k2.campaigns(201000002) == \
+               [(1, 'ktwo201000002-c01_lpd-targ.fits.gz'), 
+                (10, 'ktwo201000002-c10_lpd-targ.fits.gz')]
+        assert everest3.k2.campaigns(1) == []
+        
+        # The season is found without a network round trip
+        star = everest3.k2.Target(201000002, quiet = True)
+        assert star.season == 1
+
+def test_prefetch():
+    '''
+    Test bulk downloading of target pixel files from a local mirror
+    
+    '''
+    
+    with k2_sandbox():
+        
+        # Build the mirror with the same layout as the archive
+        mirror = tempfile.mkdtemp()
+        ids = [201000010, 201000011, 201099999]
+        for ID in ids[:2]:
+            file = _fake_tpf(mirror, ID, 1)
+            everest3.k2.archive_url = mirror + '/'
+            dest = everest3.k2._tpf_url(ID, 1)
+            if not os.path.exists(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+            os.rename(file, dest)
+        
+        # Serve it
+        class Handler(SimpleHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            def translate_path(self, path):
+                return os.path.join(mirror, path.lstrip('/'))
+            def log_message(self, *args):
+                pass
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target = server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        everest3.k2.archive_url = 'http://127.0.0.1:%d/' % server.server_port
+        
+        try:
+            res = everest3.k2.prefetch(ids, 1, max_concurrency = 2, 
+                                       retries = 1)
+            assert res['downloaded'] == ids[:2]
+            assert res['failed'] == ids[2:]
+            star = everest3.k2.Target(201000010, quiet = True)
+            assert star.season == 1
+            assert star.raw.ncads == 50
+            res = everest3.k2.prefetch(ids[:2], 1)
+            assert res['skipped'] == ids[:2]
+        finally:
+            server.shutdown()
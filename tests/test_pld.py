@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+test_pld.py
+-----------
+
+'''
+
+from __future__ import division, print_function, absolute_import, unicode_literals
+from everest3.containers import TimeSeries
+from everest3 import pld
+from synthetic import jitter_stamp, JitterTarget
+import numpy as np
+
+def test_detrend():
+    '''
+    Test the PLD de-trending on a synthetic target
+    
+    '''
+    
+    star = JitterTarget(10, quiet = True, checkpoint = False)
+    star.detrend(order = 2)
+    assert star.scatter < 0.2 * star.raw_scatter
+    assert star.weights.shape == (8 + 36,)
+    
+    # The primal and dual forms are equivalent
+    model = np.array(star.model)
+    star.detrend(order = 2, form = 'dual')
+    assert np.allclose(star.model, model, rtol = 1e-6, 
+                       atol = 1e-6 * np.std(model))
+    
+    # Masked cadences are excluded from the fit, but still modeled
+    star.detrend(order = 2, mask = np.arange(100, 150))
+    assert np.all(np.isfinite(star.model))
+    assert star.scatter < 0.2 * star.raw_scatter
+
+def test_blocks():
+    '''
+    Test the streaming construction of the PLD regressors
+    
+    '''
+    
+    pix = jitter_stamp(ncads = 50).pixel_flux()[:, 12:24]
+    fpix = pix / pix.sum(axis = 1)[:, None]
+    X = pld.regressors(fpix, 3)
+    blocks = list(pld.regressor_blocks(fpix, 3, 100))
+    assert len(blocks) == int(np.ceil(X.shape[1] / 100.))
+    assert np.array_equal(np.hstack([x for cols, x in blocks]), X)
+    
+    # A tiny memory budget gives the same model
+    y = pix.sum(axis = 1) - pix.sum(axis = 1).mean()
+    var = np.ones(50)
+    for form in ['primal', 'dual']:
+        m1, _ = pld.Solver(fpix, y, var, 2, form = form).solve([1., 1.])
+        m2, _ = pld.Solver(fpix, y, var, 2, form = form, 
+                           max_memory = 1000).solve([1., 1.])
+        assert np.allclose(m1, m2, atol = 1e-8 * np.std(y))
+
+def test_pca():
+    '''
+    Test the principal component reduction of the PLD regressors
+    
+    '''
+    
+    star = JitterTarget(10, quiet = True, checkpoint = False)
+    star.detrend(order = 3)
+    full = np.array(star.model)
+    
+    # A rank-limited fit is almost as good as the full fit
+    star.detrend(order = 3, pca = 20)
+    assert star.weights.shape == (8 + 20 + 20,)
+    assert star.scatter < 0.2 * star.raw_scatter
+    assert np.std(star.model - full) < 0.05 * np.std(full)
+    
+    # The basis is cached on the target and reused
+    cache = star._pld_segments['segments'][0]._pld_cache
+    basis = cache['basis'][(3, 20, 200)]
+    star.detrend(order = 3, pca = 20, lam = [1., 1., 1.])
+    assert cache['basis'][(3, 20, 200)] is basis
+    
+    # An explained variance threshold
+    star.detrend(order = 3, pca = 0.999)
+    assert star.weights.shape[0] < 8 + 36 + 120
+    assert star.scatter < 0.2 * star.raw_scatter
+
+def test_cross_validate():
+    '''
+    Test the cross-validation of the PLD prior
+    
+    '''
+    
+    star = JitterTarget(10, quiet = True, checkpoint = False)
+    star.detrend(order = 2, lam = 'cv')
+    assert star.cv[0]['scatter'].shape == (2, 21, 5)
+    assert star.scatter < 0.2 * star.raw_scatter
+    
+    # The held-out residuals match explicit fits without each fold
+    fpix, y, var, good, fit_mask = pld._prepare(star)
+    folds = np.array_split(np.arange(star.raw.ncads), 4)
+    for form in ['primal', 'dual']:
+        solver = pld.Solver(fpix, y, var, 2, form = form)
+        lam = star.cv[0]['lam']
+        lambda_arr = [0.1 * lam[1], 10 * lam[1]]
+        resid = solver.validate(1, lam, lambda_arr, folds)
+        for i, l in enumerate(lambda_arr):
+            for v in folds:
+                mask = np.zeros(star.raw.ncads, dtype = bool)
+                mask[v] = True
+                model, _ = solver.solve([lam[0], l], mask = mask)
+                assert np.allclose(resid[i, v], y[v] - model[v], 
+                                   atol = 1e-6 * np.std(y))
+
+def test_clip():
+    '''
+    Test the iterative outlier clipping
+    
+    '''
+    
+    class _OutlierTarget(JitterTarget):
+        def get_raw_data(self):
+            super(_OutlierTarget, self).get_raw_data()
+            flux = np.array(self.raw.flux)
+            flux[[50, 300, 301], 2:4, 2:4] *= 1.01
+            self.raw = TimeSeries(self.raw.time, flux, self.raw.error)
+    
+    star = _OutlierTarget(10, quiet = True, checkpoint = False)
+    star.detrend(order = 2)
+    assert set([50, 300, 301]) <= set(star.outliers)
+    assert len(star.clip_history) >= 1
+    assert star.scatter < 0.2 * star.raw_scatter
+    
+    # The down-dated solutions match the direct solutions
+    fpix, y, var, good, fit_mask = pld._prepare(star)
+    base = np.zeros_like(good)
+    base[:100] = True
+    mask = np.array(base)
+    mask[[150, 300, 450]] = True
+    for form in ['primal', 'dual']:
+        solver = pld.Solver(fpix, y, var, 2, form = form)
+        m1, w1 = solver.solve([1e-2, 1e-2], mask = mask)
+        m2, w2 = solver.solve([1e-2, 1e-2], mask = mask, base = base)
+        assert np.allclose(m1, m2, atol = 1e-8 * np.std(y))
+
+def test_segments():
+    '''
+    Test the segment-parallel de-trending
+    
+    '''
+    
+    class _GapTarget(JitterTarget):
+        def get_raw_data(self):
+            super(_GapTarget, self).get_raw_data()
+            time = np.array(self.raw.time)
+            time[250:] += 2.
+            self.raw = TimeSeries(time, self.raw.flux, self.raw.error)
+    
+    star = _GapTarget(10, quiet = True, checkpoint = False)
+    assert star.raw.segments() == [slice(0, 250), slice(250, 600)]
+    assert star.raw.segments(breakpoints = [400]) == \
+           [slice(0, 250), slice(250, 400), slice(400, 600)]
+    assert star.raw.segments(gap = None, breakpoints = [20]) == \
+           [slice(0, 600)]
+    
+    # Threaded and serial fits agree
+    star.detrend(order = 2, threads = 2)
+    assert star.weights.shape == (2 * (8 + 36),)
+    assert star.scatter < 0.2 * star.raw_scatter
+    model = np.array(star.model)
+    star.detrend(order = 2, threads = 1)
+    assert np.allclose(star.model, model)
+    
+    # Each segment is an independent fit
+    star.detrend(order = 2, breakpoints = [400], gap = None, maxiter = 0)
+    seg = pld._Segment(star, slice(400, 600))
+    pld._detrend(seg, 2, None, None, None, 2 ** 27, None, 200, 5., 0)
+    delta = star.model[400:] - seg.model
+    assert np.allclose(delta, delta[0])
+    
+    # One thread per CPU, but not in the workers of a pool
+    from everest3.utils import DefaultThreads, BLASThreads
+    from multiprocessing import Pool, cpu_count
+    assert DefaultThreads() == cpu_count()
+    pool = Pool(1)
+    try:
+        assert pool.apply(DefaultThreads) == 1
+    finally:
+        pool.close()
+        pool.join()
+    with BLASThreads(1):
+        star.detrend(order = 2, threads = 2)
+    assert np.allclose(star.model, model)
+
+def test_gp():
+    '''
+    Test the PLD de-trending with a GP noise model
+    
+    '''
+    
+    from everest3 import gp
+    
+    # The GP solution is the dense generalized least squares solution
+    star = JitterTarget(10, quiet = True, checkpoint = False)
+    t = np.array(star.raw.time)
+    fpix, y, var, good, fit_mask = pld._prepare(star, t = t)
+    kernel = gp.Kernel(gp.Matern32Term(1e3, 2.))
+    lam = [1e-2, 1e-2]
+    mask = np.zeros_like(good)
+    mask[100:150] = True
+    solver = pld.Solver(fpix, y, var, 2, kernel = kernel, t = t, 
+                        max_memory = 10000)
+    model, w = solver.solve(lam, mask = mask)
+    X = np.hstack([pld.regressors(fpix, n) - pld.regressors(fpix, n)
+                   .mean(axis = 0) for n in (1, 2)])
+    train = ~mask
+    C = kernel(t[train][:, None] - t[train][None, :]) + np.diag(var[train])
+    CX = np.linalg.solve(C, X[train])
+    prior = np.concatenate([np.ones(8) / lam[0], np.ones(36) / lam[1]])
+    w0 = np.linalg.solve(np.dot(X[train].T, CX) + np.diag(prior), 
+                         np.dot(CX.T, y[train]))
+    assert np.allclose(model, np.dot(X, w0), atol = 1e-6 * np.std(y))
+    
+    # The log likelihood
+    S = C + np.dot(X[train] * np.concatenate([lam[0] * np.ones(8), 
+                                              lam[1] * np.ones(36)]), 
+                   X[train].T)
+    ll = -0.5 * (np.dot(y[train], np.linalg.solve(S, y[train])) + 
+                 np.linalg.slogdet(S)[1] + train.sum() * np.log(2 * np.pi))
+    assert np.allclose(solver.log_likelihood(lam, mask = mask), ll)
+    assert solver.optimize(lam, mask = mask) >= ll
+    
+    # De-trend a variable star
+    class _VariableTarget(JitterTarget):
+        def get_raw_data(self):
+            super(_VariableTarget, self).get_raw_data()
+            time = np.array(self.raw.time)
+            flux = np.array(self.raw.flux) * \
+                   (1 + 0.01 * np.sin(2 * np.pi * time / 9.))[:, None, None]
+            self.raw = TimeSeries(time, flux, self.raw.error)
+    
+    star = _VariableTarget(10, quiet = True, checkpoint = False)
+    star.detrend(order = 2, kernel = gp.Kernel(gp.Matern32Term(1e3, 1.)))
+    assert len(star.kernels) == 1
+    assert star.kernels[0].terms[0].log_params[1] > 0
+    assert np.all(np.isfinite(star.model))
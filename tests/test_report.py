@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+test_report.py
+--------------
+
+'''
+
+from __future__ import division, print_function, absolute_import, unicode_literals
+from everest3 import batch, report
+import synthetic
+import logging
+import tempfile
+import re
+import os
+
+def test_report():
+    '''
+    Test the campaign report
+    
+    '''
+    
+    synthetic.path = tempfile.mkdtemp()
+    file = os.path.join(tempfile.mkdtemp(), 'ledger.db')
+    batch.run(ids = [20, 21, 22], mission = 'synthetic', workers = 1, 
+              ledger = file, until = 'model', order = 2)
+    path = tempfile.mkdtemp()
+    index = report.report(ids = [20, 21, 22, 23], mission = 'synthetic',
+                          path = path, sort = 'improvement', 
+                          pages_per_file = 2)
+    assert sorted(os.listdir(path)) == ['index.html', 'report-001.pdf', 
+                                        'report-002.pdf', 'thumbnails']
+    assert sorted(os.listdir(os.path.join(path, 'thumbnails'))) == \
+           ['20.png', '21.png', '22.png']
+    with open(index, 'r') as f:
+        html = f.read()
+    assert html.count('<tr>') == 4 and 'report-002.pdf#page=1' in html
+    improvement = [float(x) for x in 
+                   re.findall(r'<td>([0-9.]+)</td>\n<td><a', html)]
+    assert len(improvement) == 3
+    assert improvement == sorted(improvement, reverse = True)
+    
+    # Targets that can't be loaded are left out of the report
+    resfile = synthetic.Target(22, quiet = True).resfile
+    with open(resfile, 'r+b') as f:
+        f.truncate(os.path.getsize(resfile) // 2)
+    handlers = list(logging.getLogger().handlers)
+    path = tempfile.mkdtemp()
+    index = report.report(ids = [20, 21, 22], mission = 'synthetic',
+                          path = path, pages_per_file = 2, 
+                          thumbnails = False)
+    assert sorted(os.listdir(path)) == ['index.html', 'report-001.pdf', 
+                                        'thumbnails']
+    with open(index, 'r') as f:
+        assert f.read().count('<tr>') == 3
+    assert logging.getLogger().handlers == handlers